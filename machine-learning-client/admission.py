@@ -0,0 +1,178 @@
+"""
+Admission control for the /predict endpoint.
+
+At most max_in_flight predictions run at once. Requests beyond that wait in
+a bounded queue per priority class; interactive requests are always admitted
+before bulk ones. A request is rejected straight away when its queue is full,
+or after max_wait seconds in the queue, so callers get a fast 503 with a
+Retry-After estimate instead of timing out on work nobody will read.
+
+Queue depth, in-flight count, admissions and rejections are exported in the
+Prometheus text format for autoscaling.
+"""
+
+import math
+import os
+import threading
+import time
+from collections import Counter, deque
+from contextlib import contextmanager
+
+# Priority classes, highest first
+PRIORITIES = ("interactive", "bulk")
+
+
+class Overloaded(Exception):
+    """Raised when a request is not admitted."""
+
+    def __init__(self, reason, retry_after):
+        super().__init__(f"Request rejected: {reason}")
+        self.reason = reason
+        self.retry_after = retry_after
+
+
+class AdmissionController:  # pylint: disable=too-many-instance-attributes
+    """Bounded concurrency with bounded, priority-ordered wait queues."""
+
+    def __init__(self, max_in_flight=2, queue_limits=None, max_wait=5.0):
+        """
+        Args:
+            max_in_flight (int): Predictions allowed to run at once.
+            queue_limits (dict): Waiting requests allowed per priority class.
+            max_wait (float): Seconds a request may wait before being rejected.
+        """
+        self.max_in_flight = max_in_flight
+        self.queue_limits = {"interactive": 8, "bulk": 2, **(queue_limits or {})}
+        self.max_wait = max_wait
+        self.in_flight = 0
+        self.service_seconds = None
+        self.admitted = Counter()
+        self.rejected = Counter()
+        self._queues = {priority: deque() for priority in PRIORITIES}
+        self._condition = threading.Condition()
+
+    @classmethod
+    def from_env(cls):
+        """Build a controller from the ADMISSION_* environment variables."""
+        return cls(
+            max_in_flight=int(os.getenv("ADMISSION_MAX_IN_FLIGHT", "2")),
+            queue_limits={
+                "interactive": int(os.getenv("ADMISSION_QUEUE_INTERACTIVE", "8")),
+                "bulk": int(os.getenv("ADMISSION_QUEUE_BULK", "2")),
+            },
+            max_wait=float(os.getenv("ADMISSION_MAX_WAIT", "5")),
+        )
+
+    def _head(self):
+        """Return the ticket of the next request to admit, or None."""
+        for priority in PRIORITIES:
+            if self._queues[priority]:
+                return self._queues[priority][0]
+        return None
+
+    def queue_depth(self, priority):
+        """Return the number of requests waiting in a priority class."""
+        return len(self._queues[priority])
+
+    def _retry_after(self):
+        """Estimate the seconds until the current backlog has drained."""
+        backlog = self.in_flight + sum(len(queue) for queue in self._queues.values())
+        per_request = self.service_seconds or 1.0
+        return max(1, math.ceil(backlog * per_request / max(1, self.max_in_flight)))
+
+    def acquire(self, priority, timeout=None):
+        """
+        Wait for a slot to run a prediction.
+
+        Args:
+            priority (str): One of PRIORITIES.
+            timeout (float): Seconds to wait at most, if less than max_wait.
+
+        Raises:
+            Overloaded: If the queue is full or the wait exceeds max_wait.
+        """
+        with self._condition:
+            if self.in_flight < self.max_in_flight and self._head() is None:
+                self.in_flight += 1
+                self.admitted[priority] += 1
+                return
+            queue = self._queues[priority]
+            if len(queue) >= self.queue_limits[priority]:
+                self.rejected[priority, "queue_full"] += 1
+                raise Overloaded("queue_full", self._retry_after())
+
+            ticket = object()
+            queue.append(ticket)
+            max_wait = self.max_wait if timeout is None else min(self.max_wait, timeout)
+            deadline = time.monotonic() + max_wait
+            try:
+                while self._head() is not ticket or (
+                    self.in_flight >= self.max_in_flight
+                ):
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        self.rejected[priority, "timeout"] += 1
+                        raise Overloaded("timeout", self._retry_after())
+                    self._condition.wait(remaining)
+            finally:
+                queue.remove(ticket)
+                self._condition.notify_all()
+            self.in_flight += 1
+            self.admitted[priority] += 1
+
+    def release(self, elapsed):
+        """Free a slot after a prediction that took elapsed seconds."""
+        with self._condition:
+            self.in_flight -= 1
+            if self.service_seconds is None:
+                self.service_seconds = elapsed
+            else:
+                self.service_seconds += 0.2 * (elapsed - self.service_seconds)
+            self._condition.notify_all()
+
+    @contextmanager
+    def admit(self, priority="interactive", timeout=None):
+        """
+        Context manager that holds a slot for the duration of a prediction.
+
+        Unknown priority classes are treated as interactive. See acquire.
+
+        Raises:
+            Overloaded: If the request is not admitted.
+        """
+        if priority not in self._queues:
+            priority = PRIORITIES[0]
+        self.acquire(priority, timeout)
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.release(time.perf_counter() - start)
+
+    def metrics(self):
+        """Return the admission metrics in the Prometheus text format."""
+        with self._condition:
+            lines = [
+                "# TYPE ml_admission_in_flight gauge",
+                f"ml_admission_in_flight {self.in_flight}",
+                "# TYPE ml_admission_queue_depth gauge",
+            ]
+            lines += [
+                f'ml_admission_queue_depth{{priority="{priority}"}} '
+                f"{self.queue_depth(priority)}"
+                for priority in PRIORITIES
+            ]
+            lines.append("# TYPE ml_admission_admitted_total counter")
+            lines += [
+                f'ml_admission_admitted_total{{priority="{priority}"}} '
+                f"{self.admitted[priority]}"
+                for priority in PRIORITIES
+            ]
+            lines.append("# TYPE ml_admission_rejected_total counter")
+            lines += [
+                f'ml_admission_rejected_total{{priority="{priority}",'
+                f'reason="{reason}"}} {self.rejected[priority, reason]}'
+                for priority in PRIORITIES
+                for reason in ("queue_full", "timeout")
+            ]
+        return "\n".join(lines) + "\n"
@@ -1,24 +1,57 @@
 """
 This module performs flower classification using a pre-trained ResNet50 model.
-It includes functions to load the flower class names, initialize the model, 
+It includes functions to load the flower class names, initialize the model,
 transform images, and predict the flower name based on an input image.
 """
 
 import os
 import json
+import time
 import torch
 from torchvision import transforms
 from PIL import Image
-import torchvision
 from flask import Flask, jsonify, request, send_from_directory
 from flask_cors import CORS
 from werkzeug.utils import secure_filename
 from dotenv import load_dotenv
 
+from admission import AdmissionController, Overloaded
+from architectures import build_model, read_checkpoint
+from deadline import (
+    DEADLINE_HEADER,
+    DeadlineExceeded,
+    DeadlineStats,
+    parse_deadline,
+    seconds_left,
+)
+from request_profiling import init_profiling, profiled_forward
+from shared_files import (
+    SHARED_UPLOADS_ROOT,
+    InvalidReference,
+    mapped_file,
+    resolve_reference,
+)
+from tta import LatencyBudget, build_views
+
 load_dotenv()
 
 # Initialize Flask app
 app = Flask(__name__)
+init_profiling(app)
+
+# Checkpoint to serve: the ResNet50 from train.py or a distilled student
+MODEL_PATH = os.getenv("MODEL_PATH", "flower_classification_resnet.pth")
+
+# Test-time augmentation: TTA_VIEWS > 1 averages the logits of several views,
+# dropping views when TTA_LATENCY_BUDGET_MS would be exceeded under load
+TTA_VIEWS = int(os.getenv("TTA_VIEWS", "1"))
+TTA_BUDGET = LatencyBudget(TTA_VIEWS, float(os.getenv("TTA_LATENCY_BUDGET_MS", "0")))
+
+# Bounds concurrent and queued predictions; X-Priority picks the queue
+ADMISSION = AdmissionController.from_env()
+
+# Counts work dropped or wasted because the caller's deadline had passed
+DEADLINES = DeadlineStats()
 
 
 def load_flower_names():
@@ -32,35 +65,27 @@ def load_flower_names():
         return json.load(file)
 
 
-def load_model():
+def load_model(model_path=None):
     """
-    Load and initialize the ResNet50 model for flower classification.
+    Load and initialize the flower classification model.
+
+    Args:
+        model_path (str): Checkpoint to load; defaults to MODEL_PATH. Both
+            the original ResNet50 checkpoint and students saved by
+            `train.py --distill` are supported.
 
     Returns:
-        torch.nn.Module: A ResNet50 model with the last layer modified for 102 classes.
+        torch.nn.Module: The model, with its last layer sized for 102 classes.
     """
-    # Initialize the model architecture with ResNet50
-    model = torchvision.models.resnet50(
-        weights=torchvision.models.ResNet50_Weights.IMAGENET1K_V2
-    )
-
-    # Modify the last fully connected layer to match the number of classes
-    num_classes = 102
-    model.fc = torch.nn.Linear(model.fc.in_features, num_classes)
+    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+    arch, state_dict = read_checkpoint(model_path or MODEL_PATH, map_location=device)
 
-    # Load the saved model's state_dict into the modified model
-    model.load_state_dict(
-        torch.load(
-            "flower_classification_resnet.pth",
-            map_location=torch.device("cuda" if torch.cuda.is_available() else "cpu"),
-        )
-    )
+    # Initialize the model architecture and load the saved weights into it
+    model = build_model(arch)
+    model.load_state_dict(state_dict)
 
-    # Set the model to evaluation mode
+    # Set the model to evaluation mode on the appropriate device (CPU or GPU)
     model.eval()
-
-    # Move the model to the appropriate device (CPU or GPU)
-    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
     model = model.to(device)
 
     return model
@@ -71,7 +96,7 @@ def transform_image(image_path):
     Apply image transformations to prepare the input image for the model.
 
     Args:
-        image_path (str): Path to the image file.
+        image_path (str): Path to the image file, or a binary file object.
 
     Returns:
         torch.Tensor: Transformed image tensor with added batch dimension.
@@ -87,28 +112,45 @@ def transform_image(image_path):
     return transform(image).unsqueeze(0)  # Add batch dimension
 
 
-def predict_plant(image_path):
+def predict_plant(image_path, deadline=None):
     """
     Predict the plant name from an input image.
 
     Args:
-        image_path (str): Path to the image file.
+        image_path (str): Path to the image file, or a binary file object.
+        deadline (float): Unix time after which the result is not needed.
 
     Returns:
         str: Predicted plant name.
-    """
-    # Preprocess the image
-    image_tensor = transform_image(image_path)
 
-    # Move the image to the same device as the model (CPU or GPU)
+    Raises:
+        DeadlineExceeded: If the deadline passes before the forward pass.
+    """
     device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
-    image_tensor = image_tensor.to(device)
+    DEADLINES.check(deadline, "preprocess")
+    start = time.perf_counter()
+
+    if TTA_VIEWS > 1:
+        # Run every view in one batched forward pass and average the logits,
+        # leaving out views that would not finish before the deadline
+        remaining = seconds_left(deadline)
+        num_views = TTA_BUDGET.views(None if remaining is None else remaining * 1000)
+        image = Image.open(image_path).convert("RGB")
+        image_tensor = build_views(image, num_views).to(device)
+        DEADLINES.check(deadline, "forward")
+        with torch.no_grad(), profiled_forward(), TTA_BUDGET.track(num_views):
+            outputs = TRAINED_MODEL(image_tensor).mean(dim=0, keepdim=True)
+    else:
+        # Preprocess the image and move it to the model's device
+        image_tensor = transform_image(image_path).to(device)
+        DEADLINES.check(deadline, "forward")
+        with torch.no_grad(), profiled_forward():
+            outputs = TRAINED_MODEL(image_tensor)
+    DEADLINES.finish(deadline, time.perf_counter() - start)
 
     # Get the model's predictions
-    with torch.no_grad():
-        outputs = TRAINED_MODEL(image_tensor)
-        _, predicted_class = torch.max(outputs, 1)
-        predicted_class_id = predicted_class.item() + 1  # Adjust for zero-based index
+    _, predicted_class = torch.max(outputs, 1)
+    predicted_class_id = predicted_class.item() + 1  # Adjust for zero-based index
 
     # Map the predicted class ID to the plant name
     plant_name = FLOWER_CLASS_NAMES.get(str(predicted_class_id), "Unknown plant")
@@ -125,9 +167,47 @@ def predict():
     """
     Predicts the plant name from an uploaded image file.
 
+    Requests are admitted by priority class (X-Priority: interactive or
+    bulk) and rejected with a 503 and Retry-After when the server is
+    saturated. Requests whose X-Request-Deadline passes before the
+    prediction is computed are dropped with a 504.
+
     Returns:
         Response: JSON response containing the predicted plant name.
     """
+    deadline = parse_deadline(request.headers.get(DEADLINE_HEADER))
+    try:
+        DEADLINES.check(deadline, "queue")
+        with ADMISSION.admit(
+            request.headers.get("X-Priority", "interactive"), seconds_left(deadline)
+        ):
+            return classify_upload(deadline)
+    except DeadlineExceeded as error:
+        return jsonify({"error": "Deadline exceeded", "stage": error.stage}), 504
+    except Overloaded as error:
+        remaining = seconds_left(deadline)
+        if remaining is not None and remaining <= 0:
+            DEADLINES.drop("queue")
+            return jsonify({"error": "Deadline exceeded", "stage": "queue"}), 504
+        response = jsonify({"error": "Server overloaded", "reason": error.reason})
+        response.status_code = 503
+        response.headers["Retry-After"] = str(error.retry_after)
+        return response
+
+
+def classify_upload(deadline=None):
+    """
+    Saves the uploaded image to a temporary file and classifies it.
+
+    A JSON body is a reference to a photo on the shared uploads volume
+    instead, see classify_shared_file.
+
+    Returns:
+        tuple: JSON response and status code.
+    """
+    if request.is_json:
+        return classify_shared_file(request.get_json(silent=True), deadline)
+
     if "image" not in request.files:
         return jsonify({"error": "No image uploaded"}), 400
 
@@ -139,7 +219,7 @@ def predict():
 
     try:
         # Predict the plant name
-        plant_name = predict_plant(image_path)
+        plant_name = predict_plant(image_path, deadline)
     finally:
         # Clean up the temporary file
         if os.path.exists(image_path):
@@ -148,6 +228,44 @@ def predict():
     return jsonify({"plant_name": plant_name}), 200
 
 
+def classify_shared_file(reference, deadline=None):
+    """
+    Classifies a photo on the shared uploads volume in place.
+
+    Args:
+        reference (dict): {"path": path relative to SHARED_UPLOADS_ROOT,
+            "size": expected size in bytes}.
+        deadline (float): Unix time after which the result is not needed.
+
+    Returns:
+        tuple: JSON response and status code.
+    """
+    if not SHARED_UPLOADS_ROOT:
+        return jsonify({"error": "Shared uploads are not enabled"}), 400
+    try:
+        path = resolve_reference(SHARED_UPLOADS_ROOT, reference)
+        with mapped_file(path) as image_file:
+            plant_name = predict_plant(image_file, deadline)
+    except InvalidReference as error:
+        return jsonify({"error": str(error)}), 400
+    return jsonify({"plant_name": plant_name}), 200
+
+
+@app.route("/metrics")
+def metrics():
+    """
+    Exposes admission and deadline metrics for autoscaling.
+
+    Returns:
+        Response: Metrics in the Prometheus text format.
+    """
+    return (
+        ADMISSION.metrics() + DEADLINES.metrics(),
+        200,
+        {"Content-Type": "text/plain; version=0.0.4"},
+    )
+
+
 @app.route("/uploads/<filename>")
 def uploaded_file(filename):
     """
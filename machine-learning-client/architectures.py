@@ -0,0 +1,72 @@
+"""
+Classifier architectures and checkpoint files for flower classification.
+
+The original checkpoint (flower_classification_resnet.pth) holds only the
+state_dict of a ResNet50 whose `fc` layer was replaced for 102 classes.
+Checkpoints written by save_checkpoint also record the architecture, so a
+smaller student trained by `train.py --distill` can be served by the same
+load_model() in app.py.
+"""
+
+import torch
+import torchvision
+from torch import nn
+
+NUM_CLASSES = 102
+
+ARCHITECTURES = ("resnet50", "resnet18", "mobilenet_v3_large", "mobilenet_v3_small")
+
+
+def build_model(arch, num_classes=NUM_CLASSES, pretrained=False):
+    """
+    Build a classifier with its last layer sized for num_classes.
+
+    Args:
+        arch (str): One of ARCHITECTURES.
+        num_classes (int): Number of output classes.
+        pretrained (bool): Start from the ImageNet weights (for training).
+
+    Returns:
+        torch.nn.Module: The model.
+    """
+    if arch not in ARCHITECTURES:
+        raise ValueError(f"Unknown architecture: {arch}")
+    model = getattr(torchvision.models, arch)(weights="DEFAULT" if pretrained else None)
+    if arch.startswith("resnet"):
+        model.fc = nn.Linear(model.fc.in_features, num_classes)
+    else:
+        model.classifier[-1] = nn.Linear(model.classifier[-1].in_features, num_classes)
+    return model
+
+
+def save_checkpoint(model, arch, path, split=None):
+    """
+    Save a model's weights together with its architecture.
+
+    Args:
+        split (str): Id of the train/test split the model was trained on,
+            if it was trained on part of the dataset.
+    """
+    checkpoint = {"arch": arch, "state_dict": model.state_dict()}
+    if split is not None:
+        checkpoint["split"] = split
+    torch.save(checkpoint, path)
+
+
+def checkpoint_split(path):
+    """Return the split id recorded by save_checkpoint, or None."""
+    checkpoint = torch.load(path, map_location="cpu")
+    return checkpoint.get("split") if "state_dict" in checkpoint else None
+
+
+def read_checkpoint(path, map_location=None):
+    """
+    Read a checkpoint written by save_checkpoint, or a bare ResNet50 state_dict.
+
+    Returns:
+        tuple: (architecture name, state_dict)
+    """
+    checkpoint = torch.load(path, map_location=map_location)
+    if "state_dict" in checkpoint:
+        return checkpoint["arch"], checkpoint["state_dict"]
+    return "resnet50", checkpoint
@@ -0,0 +1,268 @@
+"""
+Micro-benchmarks for the inference stages of the ML client.
+
+Times transform_image and the TRAINED_MODEL forward pass across batch sizes,
+thread counts and backends (eager, TorchScript, dynamically quantized), writes
+the results as JSON and optionally fails when a stage regresses past a
+threshold against a stored baseline.
+
+Usage:
+    python benchmark.py --output bench.json
+    python benchmark.py --baseline bench_baseline.json --threshold 0.15
+"""
+
+import argparse
+import copy
+import json
+import os
+import sys
+import time
+
+import torch
+
+DEFAULT_IMAGE_DIR = os.path.join("data", "flowers-102", "jpg")
+BACKENDS = ("eager", "torchscript", "quantized")
+
+
+def time_callable(func, repeats=10, warmup=2):
+    """
+    Call func repeatedly and return the wall time of each timed call.
+
+    Args:
+        func (callable): Zero-argument function to time.
+        repeats (int): Number of timed calls.
+        warmup (int): Number of untimed calls made first.
+
+    Returns:
+        list: Seconds taken by each timed call.
+    """
+    for _ in range(warmup):
+        func()
+    samples = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        func()
+        samples.append(time.perf_counter() - start)
+    return samples
+
+
+def summarize(samples, items=1):
+    """
+    Summarize timing samples.
+
+    Args:
+        samples (list): Seconds per call.
+        items (int): Number of images processed per call.
+
+    Returns:
+        dict: Median and p95 in milliseconds plus images per second.
+    """
+    ordered = sorted(samples)
+    median = ordered[len(ordered) // 2]
+    p95 = ordered[min(len(ordered) - 1, int(len(ordered) * 0.95))]
+    return {
+        "median_ms": round(median * 1000, 3),
+        "p95_ms": round(p95 * 1000, 3),
+        "images_per_s": round(items / median, 2) if median else 0.0,
+    }
+
+
+def build_backend(model, backend, example):
+    """
+    Prepare model for the given backend.
+
+    Args:
+        model (torch.nn.Module): Eager model in evaluation mode.
+        backend (str): One of BACKENDS.
+        example (torch.Tensor): Example input used for tracing.
+
+    Returns:
+        torch.nn.Module: Model ready to be called.
+    """
+    if backend == "eager":
+        return model
+    if backend == "torchscript":
+        with torch.no_grad():
+            return torch.jit.freeze(torch.jit.trace(model, example))
+    if backend == "quantized":
+        # Dynamic quantization only covers Linear layers, i.e. the fc head
+        return torch.ao.quantization.quantize_dynamic(
+            copy.deepcopy(model), {torch.nn.Linear}, dtype=torch.qint8
+        )
+    raise ValueError(f"Unknown backend: {backend}")
+
+
+def sample_image_paths(image_dir, limit):
+    """
+    List up to limit .jpg images in image_dir.
+
+    Raises:
+        ValueError: If the directory is missing or holds no .jpg images.
+    """
+    try:
+        names = sorted(f for f in os.listdir(image_dir) if f.endswith(".jpg"))
+    except OSError as error:
+        raise ValueError(f"Cannot read the image directory {image_dir}") from error
+    if not names or limit < 1:
+        raise ValueError(f"No .jpg images found in {image_dir}")
+    return [os.path.join(image_dir, name) for name in names[:limit]]
+
+
+def bench_transform(transform_image, image_paths, repeats):
+    """
+    Time transform_image over the sample images.
+
+    Raises:
+        ValueError: If there are no images to transform.
+    """
+    if not image_paths:
+        raise ValueError("No images to benchmark transform_image with")
+    state = {"index": 0}
+
+    def run():
+        transform_image(image_paths[state["index"] % len(image_paths)])
+        state["index"] += 1
+
+    return summarize(time_callable(run, repeats=repeats))
+
+
+def bench_forward(model, backends, batch_sizes, thread_counts, repeats):
+    """
+    Time the forward pass for every backend, batch size and thread count.
+
+    Returns:
+        dict: Results keyed by "forward/<backend>/bs=<n>/threads=<t>".
+    """
+    results = {}
+    model = model.to("cpu").eval()
+    example = torch.randn(1, 3, 224, 224)
+    original_threads = torch.get_num_threads()
+    try:
+        for backend in backends:
+            prepared = build_backend(model, backend, example)
+            for threads in thread_counts:
+                torch.set_num_threads(threads)
+                for batch_size in batch_sizes:
+                    batch = torch.randn(batch_size, 3, 224, 224)
+
+                    def run(net=prepared, inputs=batch):
+                        with torch.inference_mode():
+                            net(inputs)
+
+                    key = f"forward/{backend}/bs={batch_size}/threads={threads}"
+                    results[key] = summarize(
+                        time_callable(run, repeats=repeats, warmup=1), batch_size
+                    )
+                    print(f"{key}: {results[key]}")
+    finally:
+        torch.set_num_threads(original_threads)
+    return results
+
+
+def compare_to_baseline(results, baseline, threshold):
+    """
+    Find stages whose median latency regressed past threshold.
+
+    Args:
+        results (dict): Current results keyed by stage.
+        baseline (dict): Stored results keyed by stage.
+        threshold (float): Allowed relative slowdown, e.g. 0.1 for 10%.
+
+    Returns:
+        list: Human-readable descriptions of each regression.
+    """
+    regressions = []
+    for key, current in results.items():
+        previous = baseline.get(key)
+        if not previous or not previous["median_ms"]:
+            continue
+        ratio = current["median_ms"] / previous["median_ms"]
+        if ratio > 1 + threshold:
+            regressions.append(
+                f"{key}: {previous['median_ms']}ms -> {current['median_ms']}ms "
+                f"(+{(ratio - 1) * 100:.1f}%)"
+            )
+    return regressions
+
+
+def parse_int_list(value):
+    """Parse a comma-separated list of integers."""
+    return [int(item) for item in value.split(",") if item]
+
+
+def parse_args(argv=None):
+    """Parse command-line arguments."""
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n", maxsplit=1)[0])
+    parser.add_argument(
+        "--batch-sizes", type=parse_int_list, default="1,2,4,8,16,32,64"
+    )
+    parser.add_argument("--threads", type=parse_int_list, default=str(os.cpu_count()))
+    parser.add_argument(
+        "--backends", type=lambda v: v.split(","), default=",".join(BACKENDS)
+    )
+    parser.add_argument("--repeats", type=int, default=10)
+    parser.add_argument("--images", type=int, default=16)
+    parser.add_argument("--image-dir", default=DEFAULT_IMAGE_DIR)
+    parser.add_argument("--output", default="bench.json")
+    parser.add_argument("--baseline", help="fail on regressions against this file")
+    parser.add_argument(
+        "--threshold",
+        type=float,
+        default=0.1,
+        help="allowed relative slowdown against the baseline",
+    )
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    """
+    Run the benchmarks and compare against the baseline if one is given.
+
+    Returns:
+        int: Process exit code, 1 when a regression was found and 2 when
+            there are no sample images.
+    """
+    args = parse_args(argv)
+    try:
+        image_paths = sample_image_paths(args.image_dir, args.images)
+    except ValueError as error:
+        print(f"Error: {error}", file=sys.stderr)
+        return 2
+    # Importing app loads TRAINED_MODEL, so keep it out of module import
+    import app  # pylint: disable=import-outside-toplevel
+
+    results = {
+        "transform": bench_transform(app.transform_image, image_paths, args.repeats)
+    }
+    results.update(
+        bench_forward(
+            app.TRAINED_MODEL,
+            args.backends,
+            args.batch_sizes,
+            args.threads,
+            args.repeats,
+        )
+    )
+
+    report = {
+        "torch": torch.__version__,
+        "cpu_count": os.cpu_count(),
+        "results": results,
+    }
+    with open(args.output, "w", encoding="utf-8") as file_handle:
+        json.dump(report, file_handle, indent=2)
+    print(f"Results written to {args.output}")
+
+    if args.baseline:
+        with open(args.baseline, encoding="utf-8") as file_handle:
+            baseline = json.load(file_handle)["results"]
+        regressions = compare_to_baseline(results, baseline, args.threshold)
+        for regression in regressions:
+            print(f"REGRESSION {regression}")
+        if regressions:
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
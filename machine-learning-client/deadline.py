@@ -0,0 +1,121 @@
+"""
+Request deadlines for the /predict endpoint.
+
+The web app sends the absolute time (Unix seconds) after which it will have
+given up on a prediction in the X-Request-Deadline header. The deadline is
+checked after queueing, before preprocessing and before the forward pass,
+and work whose caller is gone is dropped instead of computed. The clocks of
+the two services are assumed to be in sync (they share a host or NTP).
+
+DeadlineStats counts the work dropped at each stage (compute saved) and the
+predictions that finished after their deadline (compute wasted), exported in
+the Prometheus text format next to the admission metrics.
+"""
+
+import threading
+import time
+from collections import Counter
+
+DEADLINE_HEADER = "X-Request-Deadline"
+
+# Stages at which an expired request is dropped, in request order
+STAGES = ("queue", "preprocess", "forward")
+
+
+class DeadlineExceeded(Exception):
+    """Raised when a request's deadline passes before a stage starts."""
+
+    def __init__(self, stage):
+        super().__init__(f"Deadline exceeded before {stage}")
+        self.stage = stage
+
+
+def parse_deadline(value):
+    """
+    Parse an X-Request-Deadline header value.
+
+    Returns:
+        float: The deadline in Unix seconds, or None if absent or invalid.
+    """
+    try:
+        return float(value) if value else None
+    except ValueError:
+        return None
+
+
+def seconds_left(deadline, now=None):
+    """Return the seconds until deadline, or None for no deadline."""
+    if deadline is None:
+        return None
+    return deadline - (time.time() if now is None else now)
+
+
+class DeadlineStats:
+    """Counts compute saved by dropping expired work and compute wasted on it."""
+
+    def __init__(self):
+        self.dropped = Counter()
+        self.completed = 0
+        self.compute_seconds = 0.0
+        self.wasted = 0
+        self.wasted_seconds = 0.0
+        self._lock = threading.Lock()
+
+    def check(self, deadline, stage, now=None):
+        """
+        Drop the request if its deadline has passed before stage.
+
+        Raises:
+            DeadlineExceeded: If the deadline has passed.
+        """
+        remaining = seconds_left(deadline, now)
+        if remaining is not None and remaining <= 0:
+            self.drop(stage)
+            raise DeadlineExceeded(stage)
+
+    def drop(self, stage):
+        """Count a request dropped before stage."""
+        with self._lock:
+            self.dropped[stage] += 1
+
+    def finish(self, deadline, elapsed, now=None):
+        """
+        Count a completed prediction that took elapsed seconds of compute.
+
+        Returns:
+            bool: True if it finished in time, False if the work was wasted.
+        """
+        remaining = seconds_left(deadline, now)
+        in_time = remaining is None or remaining > 0
+        with self._lock:
+            self.completed += 1
+            self.compute_seconds += elapsed
+            if not in_time:
+                self.wasted += 1
+                self.wasted_seconds += elapsed
+        return in_time
+
+    def metrics(self):
+        """Return the deadline metrics in the Prometheus text format."""
+        with self._lock:
+            # Dropped requests would have cost about as much as completed ones
+            mean_compute = (
+                self.compute_seconds / self.completed if self.completed else 0
+            )
+            lines = ["# TYPE ml_deadline_dropped_total counter"]
+            lines += [
+                f'ml_deadline_dropped_total{{stage="{stage}"}} {self.dropped[stage]}'
+                for stage in STAGES
+            ]
+            lines += [
+                "# TYPE ml_deadline_saved_seconds_estimate gauge",
+                "ml_deadline_saved_seconds_estimate "
+                f"{sum(self.dropped.values()) * mean_compute:.3f}",
+                "# TYPE ml_deadline_completed_total counter",
+                f"ml_deadline_completed_total {self.completed}",
+                "# TYPE ml_deadline_wasted_total counter",
+                f"ml_deadline_wasted_total {self.wasted}",
+                "# TYPE ml_deadline_wasted_seconds_total counter",
+                f"ml_deadline_wasted_seconds_total {self.wasted_seconds:.3f}",
+            ]
+        return "\n".join(lines) + "\n"
@@ -0,0 +1,273 @@
+"""
+Opt-in request profiling for the ML client.
+
+This is a copy of web-app/request_profiling.py, as the two services build
+from separate Docker contexts, with torch.profiler traces of the forward
+pass in place of the web app's tracemalloc sections. Keep the two in step.
+
+A request is profiled when it carries the X-Profile header set to
+PROFILE_TOKEN, or at random for a PROFILE_SAMPLE_RATE fraction of requests.
+Profiled requests get a cProfile report (or pyinstrument, when installed and
+PROFILE_ENGINE=pyinstrument) plus a torch.profiler trace of every
+profiled_forward() block they pass through. Reports are written to
+PROFILE_DIR, which keeps the newest PROFILE_MAX_REPORTS of them, and listed
+at /_profiles for requests carrying the token; without PROFILE_TOKEN they
+are only on disk. When neither trigger is configured no hooks are
+registered, so there is no per-request overhead.
+
+Profiling never fails a request: errors of the profiler are logged and the
+request is served without its report. Only one forward pass is traced at a
+time; overlapping profiled requests get no trace of theirs.
+"""
+
+import cProfile
+import hmac
+import io
+import mimetypes
+import json
+import os
+import pstats
+import random
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from urllib.parse import urlencode
+
+import torch
+from flask import g, has_request_context, request
+from werkzeug.exceptions import NotFound
+from werkzeug.security import safe_join
+
+try:
+    import pyinstrument
+except ImportError:  # pragma: no cover - optional dependency
+    pyinstrument = None
+
+PROFILE_HEADER = "X-Profile"
+
+# torch.profiler can only be active once per process
+TRACE_LOCK = threading.Lock()
+
+
+def init_profiling(app):
+    """
+    Register the profiling hooks and index routes if profiling is configured.
+
+    Args:
+        app (Flask): The app to instrument.
+
+    Returns:
+        bool: True if profiling hooks were registered.
+    """
+    token = os.getenv("PROFILE_TOKEN")
+    sample_rate = float(os.getenv("PROFILE_SAMPLE_RATE", "0"))
+    if not token and sample_rate <= 0:
+        return False
+
+    profile_dir = os.path.abspath(os.getenv("PROFILE_DIR", "profiles"))
+    max_reports = int(os.getenv("PROFILE_MAX_REPORTS", "200"))
+    engine = os.getenv("PROFILE_ENGINE", "cprofile")
+    if engine == "pyinstrument" and pyinstrument is None:
+        print("pyinstrument is not installed, falling back to cProfile")
+        engine = "cprofile"
+    os.makedirs(profile_dir, exist_ok=True)
+
+    @app.before_request
+    def start_profile():
+        if request.path.startswith("/_profiles"):
+            return
+        requested = token and request.headers.get(PROFILE_HEADER) == token
+        if not requested and random.random() >= sample_rate:
+            return
+        g.profile_id = (
+            f"{time.strftime('%Y%m%d-%H%M%S')}-{request.endpoint}-"
+            f"{uuid.uuid4().hex[:8]}"
+        )
+        g.profile_dir = profile_dir
+        g.profile_sections = []
+        g.profile_start = time.perf_counter()
+        try:
+            g.profile = start_profiler(engine)
+        except (RuntimeError, ValueError) as error:
+            # e.g. another profiler is already active on this thread
+            print(f"Could not start the profiler: {error}")
+
+    @app.after_request
+    def stop_profile(response):
+        profiler = g.pop("profile", None)
+        if profiler is None:
+            return response
+        title = f"{request.method} {request.path} -> {response.status_code}"
+        try:
+            profile_id = write_profile(profile_dir, engine, profiler, title)
+            prune_profiles(profile_dir, max_reports)
+        except (OSError, RuntimeError, ValueError) as error:
+            print(f"Could not write the profile: {error}")
+            return response
+        response.headers["X-Profile-Id"] = profile_id
+        return response
+
+    @app.route("/_profiles")
+    def profile_index():
+        # Links carry the token, as a browser following them sends no header
+        query = urlencode({"token": check_token(token)})
+        names = sorted(os.listdir(profile_dir), reverse=True)
+        links = "".join(
+            f'<li><a href="/_profiles/{name}?{query}">{name}</a></li>'
+            for name in names
+            if name.endswith(".txt")
+        )
+        return f"<h1>Profiles</h1><ul>{links}</ul>"
+
+    @app.route("/_profiles/<path:filename>")
+    def profile_file(filename):
+        check_token(token)
+        path = safe_join(profile_dir, filename)
+        if path is None or not os.path.isfile(path):
+            raise NotFound()
+        with open(path, "rb") as file_handle:
+            content = file_handle.read()
+        content_type = mimetypes.guess_type(path)[0] or "application/octet-stream"
+        return content, 200, {"Content-Type": content_type}
+
+    return True
+
+
+def check_token(token):
+    """
+    Abort with 404 unless the request carries the profiling token.
+
+    Profiles expose code paths and timings, so they are never served when no
+    token is configured (sampling-only setups keep them on disk).
+
+    Returns:
+        str: The token the request carried.
+    """
+    supplied = request.headers.get(PROFILE_HEADER) or request.args.get("token")
+    if not token or not supplied or not hmac.compare_digest(supplied, token):
+        raise NotFound()
+    return supplied
+
+
+def prune_profiles(profile_dir, max_reports):
+    """Delete the files of all but the newest max_reports profiles."""
+    reports = sorted(
+        (entry for entry in os.scandir(profile_dir) if entry.name.endswith(".txt")),
+        key=lambda entry: entry.stat().st_mtime,
+        reverse=True,
+    )
+    stale = {entry.name[: -len(".txt")] for entry in reports[max_reports:]}
+    if not stale:
+        return
+    for entry in os.scandir(profile_dir):
+        if entry.name.split(".", 1)[0] in stale:
+            try:
+                os.remove(entry.path)
+            except FileNotFoundError:
+                pass  # Pruned by a concurrent request
+
+
+def start_profiler(engine):
+    """Create and start a profiler for the given engine."""
+    if engine == "pyinstrument":
+        profiler = pyinstrument.Profiler()
+        profiler.start()
+        return profiler
+    profiler = cProfile.Profile()
+    profiler.enable()
+    return profiler
+
+
+def write_profile(profile_dir, engine, profiler, title):
+    """
+    Stop profiler and write its report and a text summary to profile_dir.
+
+    Args:
+        title (str): The request and response status, heading the summary.
+
+    Returns:
+        str: The profile id used as the file name prefix.
+    """
+    elapsed_ms = (time.perf_counter() - g.profile_start) * 1000
+    profile_id = g.profile_id
+    base = os.path.join(profile_dir, profile_id)
+
+    if engine == "pyinstrument":
+        profiler.stop()
+        with open(f"{base}.html", "w", encoding="utf-8") as file_handle:
+            file_handle.write(profiler.output_html())
+        stacks = profiler.output_text()
+    else:
+        profiler.disable()
+        profiler.dump_stats(f"{base}.prof")
+        buffer = io.StringIO()
+        pstats.Stats(profiler, stream=buffer).sort_stats("cumulative").print_stats(30)
+        stacks = buffer.getvalue()
+
+    with open(f"{base}.txt", "w", encoding="utf-8") as file_handle:
+        file_handle.write(f"{title} in {elapsed_ms:.1f}ms\n\n")
+        file_handle.write("Sections:\n")
+        file_handle.write(json.dumps(g.profile_sections, indent=2))
+        file_handle.write("\n\n")
+        file_handle.write(stacks)
+    return profile_id
+
+
+@contextmanager
+def profiled_forward(name="forward"):
+    """
+    Capture a torch.profiler trace of a block in a profiled request.
+
+    The Chrome trace is written next to the request's profile as
+    <profile id>.<name>.trace.json. Does nothing unless the current request
+    is being profiled and no other block is being traced.
+
+    Args:
+        name (str): Label of the block in the profile summary.
+    """
+    if not has_request_context() or g.get("profile") is None:
+        yield
+        return
+    if not TRACE_LOCK.acquire(blocking=False):
+        print(f"Could not trace {name}: another forward pass is being traced")
+        yield
+        return
+
+    activities = [torch.profiler.ProfilerActivity.CPU]
+    if torch.cuda.is_available():
+        activities.append(torch.profiler.ProfilerActivity.CUDA)
+    torch_profiler = torch.profiler.profile(
+        activities=activities, record_shapes=True, profile_memory=True
+    )
+    try:
+        torch_profiler.start()
+    except RuntimeError as error:
+        TRACE_LOCK.release()
+        print(f"Could not trace {name}: {error}")
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        try:
+            torch_profiler.stop()
+            elapsed_ms = (time.perf_counter() - start) * 1000
+            trace_name = f"{g.profile_id}.{name}.trace.json"
+            torch_profiler.export_chrome_trace(os.path.join(g.profile_dir, trace_name))
+            top_ops = torch_profiler.key_averages().table(
+                sort_by="self_cpu_time_total", row_limit=10
+            )
+            g.profile_sections.append(
+                {
+                    "name": name,
+                    "ms": round(elapsed_ms, 3),
+                    "trace": trace_name,
+                    "top_ops": top_ops.splitlines(),
+                }
+            )
+        except (OSError, RuntimeError) as error:
+            print(f"Could not write the trace of {name}: {error}")
+        finally:
+            TRACE_LOCK.release()
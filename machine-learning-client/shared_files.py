@@ -0,0 +1,75 @@
+"""
+Shared-volume transport for /predict.
+
+When the web app and the ML client mount the same uploads volume, the web
+app posts a JSON reference to the stored photo instead of uploading it:
+
+    {"path": "<name relative to the uploads root>", "size": <bytes>}
+
+The ML client resolves the reference under SHARED_UPLOADS_ROOT, checks that
+it stays inside the root and still has the expected size, and decodes the
+file straight from a read-only memory map, so the photo is neither
+multipart-encoded nor copied to /tmp. Uploads are never rewritten (their
+names are unique), so the size is a cheap guard against a stale or
+truncated reference without hashing the file again.
+"""
+
+import mmap
+import os
+from contextlib import contextmanager
+
+SHARED_UPLOADS_ROOT = os.getenv("SHARED_UPLOADS_ROOT")
+
+
+class InvalidReference(ValueError):
+    """Raised for a reference that does not name a valid shared upload."""
+
+
+def resolve_reference(root, reference):
+    """
+    Resolve a photo reference to a file inside the shared root.
+
+    Args:
+        root (str): The shared uploads directory.
+        reference (dict): {"path": relative path, "size": optional byte count}.
+
+    Returns:
+        str: The real path of the referenced file.
+
+    Raises:
+        InvalidReference: If the path is missing, escapes the root (including
+            through symlinks), is not a regular file or has another size.
+    """
+    if not isinstance(reference, dict) or not isinstance(reference.get("path"), str):
+        raise InvalidReference("Reference must be an object with a path")
+    relative = reference["path"]
+    if not relative or os.path.isabs(relative):
+        raise InvalidReference("Reference path must be relative")
+
+    real_root = os.path.realpath(root)
+    path = os.path.realpath(os.path.join(real_root, relative))
+    if os.path.commonpath([real_root, path]) != real_root or path == real_root:
+        raise InvalidReference("Reference path is outside the shared root")
+    if not os.path.isfile(path):
+        raise InvalidReference("Referenced file does not exist")
+    size = reference.get("size")
+    if size is not None and os.path.getsize(path) != size:
+        raise InvalidReference("Referenced file has an unexpected size")
+    return path
+
+
+@contextmanager
+def mapped_file(path):
+    """
+    Context manager that maps a file read-only.
+
+    Yields:
+        mmap.mmap: A file-like view of the file, usable with PIL.Image.open.
+    """
+    with open(path, "rb") as file_handle:
+        try:
+            mapped = mmap.mmap(file_handle.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError as error:  # Empty files cannot be mapped
+            raise InvalidReference("Referenced file is empty") from error
+    with mapped:
+        yield mapped
@@ -0,0 +1,80 @@
+"""
+Unit tests for the admission.py admission controller.
+"""
+
+import threading
+import time
+
+import pytest
+
+from admission import AdmissionController, Overloaded
+
+
+def wait_for(condition, timeout=2.0):
+    """Poll condition until it is true or timeout seconds pass."""
+    deadline = time.monotonic() + timeout
+    while not condition() and time.monotonic() < deadline:
+        time.sleep(0.005)
+    return condition()
+
+
+def test_rejects_when_queue_full():
+    """Test a request is rejected at once when its queue is full."""
+    controller = AdmissionController(max_in_flight=1, queue_limits={"bulk": 0})
+    with controller.admit("interactive"):
+        with pytest.raises(Overloaded) as error:
+            with controller.admit("bulk"):
+                pass
+    assert error.value.reason == "queue_full"
+    assert error.value.retry_after >= 1
+    assert controller.rejected["bulk", "queue_full"] == 1
+    assert controller.in_flight == 0
+
+
+def test_rejects_after_max_wait():
+    """Test a queued request is rejected once it has waited max_wait."""
+    controller = AdmissionController(max_in_flight=1, max_wait=0.05)
+    with controller.admit():
+        with pytest.raises(Overloaded) as error:
+            with controller.admit():
+                pass
+    assert error.value.reason == "timeout"
+    assert controller.queue_depth("interactive") == 0
+    assert (
+        'ml_admission_rejected_total{priority="interactive",reason="timeout"} 1'
+        in controller.metrics()
+    )
+
+
+def test_interactive_admitted_before_bulk():
+    """Test a waiting interactive request overtakes an earlier bulk one."""
+    controller = AdmissionController(max_in_flight=1, max_wait=2)
+    order = []
+
+    def run(priority):
+        with controller.admit(priority):
+            order.append(priority)
+
+    controller.acquire("interactive")
+    bulk = threading.Thread(target=run, args=("bulk",))
+    bulk.start()
+    assert wait_for(lambda: controller.queue_depth("bulk") == 1)
+    interactive = threading.Thread(target=run, args=("interactive",))
+    interactive.start()
+    assert wait_for(lambda: controller.queue_depth("interactive") == 1)
+    controller.release(0.01)
+    bulk.join()
+    interactive.join()
+    assert order == ["interactive", "bulk"]
+    assert 'ml_admission_admitted_total{priority="bulk"} 1' in controller.metrics()
+
+
+def test_timeout_shortens_wait():
+    """Test a timeout below max_wait bounds the time spent queued."""
+    controller = AdmissionController(max_in_flight=1, max_wait=10)
+    start = time.monotonic()
+    with controller.admit():
+        with pytest.raises(Overloaded):
+            with controller.admit(timeout=0.05):
+                pass
+    assert time.monotonic() - start < 1
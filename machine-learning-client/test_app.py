@@ -155,7 +155,7 @@ def test_predict_route(request, monkeypatch):
     # Explicitly retrieve the fixture without passing it as a parameter
     flask_test_app = request.getfixturevalue("create_flask_test_app")
 
-    def mock_predict_plant(_):
+    def mock_predict_plant(_image_path, _deadline=None):
         """Mock predict_plant to return a valid result."""
         return "Mocked Flower"
 
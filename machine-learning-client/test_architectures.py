@@ -0,0 +1,41 @@
+"""
+Unit tests for the architectures.py model and checkpoint helpers.
+"""
+
+import pytest
+import torch
+
+from architectures import build_model, read_checkpoint, save_checkpoint
+
+
+@pytest.mark.parametrize("arch", ["resnet18", "mobilenet_v3_small"])
+def test_build_model_has_102_outputs(arch):
+    """Test every architecture's last layer is sized for the flower classes."""
+    model = build_model(arch).eval()
+    with torch.no_grad():
+        assert model(torch.randn(1, 3, 224, 224)).shape == (1, 102)
+
+
+def test_build_model_rejects_unknown_architecture():
+    """Test an unknown architecture name raises ValueError."""
+    with pytest.raises(ValueError):
+        build_model("vgg16")
+
+
+def test_checkpoint_round_trip(tmp_path):
+    """Test a saved student records its architecture and weights."""
+    model = build_model("mobilenet_v3_small")
+    path = tmp_path / "student.pth"
+    save_checkpoint(model, "mobilenet_v3_small", path)
+    arch, state_dict = read_checkpoint(path)
+    assert arch == "mobilenet_v3_small"
+    build_model(arch).load_state_dict(state_dict)
+
+
+def test_read_bare_state_dict_as_resnet50(tmp_path):
+    """Test the original checkpoint format (a bare state_dict) is a ResNet50."""
+    path = tmp_path / "teacher.pth"
+    torch.save({"fc.weight": torch.zeros(102, 2048)}, path)
+    arch, state_dict = read_checkpoint(path)
+    assert arch == "resnet50"
+    assert state_dict["fc.weight"].shape == (102, 2048)
@@ -0,0 +1,83 @@
+"""
+Unit tests for the benchmark.py inference micro-benchmarks.
+"""
+
+import pytest
+import torch
+
+from benchmark import (
+    bench_forward,
+    bench_transform,
+    build_backend,
+    compare_to_baseline,
+    main,
+    sample_image_paths,
+    summarize,
+    time_callable,
+)
+
+
+def small_model():
+    """Build a tiny classifier that accepts 224x224 RGB input."""
+    return torch.nn.Sequential(
+        torch.nn.Conv2d(3, 4, kernel_size=7, stride=4),
+        torch.nn.AdaptiveAvgPool2d((1, 1)),
+        torch.nn.Flatten(),
+        torch.nn.Linear(4, 102),
+    ).eval()
+
+
+def test_time_callable_counts_repeats():
+    """Test time_callable returns one sample per timed call."""
+    calls = []
+    samples = time_callable(lambda: calls.append(1), repeats=3, warmup=2)
+    assert len(samples) == 3
+    assert len(calls) == 5
+
+
+def test_summarize_images_per_second():
+    """Test summarize reports throughput for the batch size."""
+    stats = summarize([0.5, 0.5, 0.5], items=4)
+    assert stats["median_ms"] == 500.0
+    assert stats["images_per_s"] == 8.0
+
+
+def test_build_backends_match_eager():
+    """Test TorchScript and quantized backends produce comparable outputs."""
+    model = small_model()
+    example = torch.randn(2, 3, 224, 224)
+    expected = model(example)
+    for backend in ("torchscript", "quantized"):
+        output = build_backend(model, backend, example)(example)
+        assert output.shape == expected.shape
+
+
+def test_bench_forward_keys():
+    """Test bench_forward times every backend, batch size and thread count."""
+    results = bench_forward(small_model(), ["eager"], [1, 2], [1], repeats=1)
+    assert set(results) == {
+        "forward/eager/bs=1/threads=1",
+        "forward/eager/bs=2/threads=1",
+    }
+
+
+def test_compare_to_baseline():
+    """Test regressions past the threshold are reported."""
+    baseline = {"transform": {"median_ms": 10.0}, "forward": {"median_ms": 10.0}}
+    results = {"transform": {"median_ms": 10.5}, "forward": {"median_ms": 13.0}}
+    regressions = compare_to_baseline(results, baseline, 0.1)
+    assert len(regressions) == 1
+    assert regressions[0].startswith("forward")
+
+
+def test_empty_image_dir(tmp_path, capsys):
+    """Test a directory without images is a clear error, not a crash."""
+    (tmp_path / "notes.txt").write_text("no images here")
+    with pytest.raises(ValueError, match="No .jpg images"):
+        sample_image_paths(str(tmp_path), 16)
+    with pytest.raises(ValueError, match="Cannot read"):
+        sample_image_paths(str(tmp_path / "missing"), 16)
+    with pytest.raises(ValueError):
+        bench_transform(lambda path: None, [], repeats=1)
+    assert main(["--image-dir", str(tmp_path), "--output", "unused.json"]) == 2
+    assert "No .jpg images found" in capsys.readouterr().err
@@ -0,0 +1,41 @@
+"""
+Unit tests for the deadline.py request deadline helpers.
+"""
+
+import pytest
+
+from deadline import DeadlineExceeded, DeadlineStats, parse_deadline, seconds_left
+
+
+def test_parse_deadline():
+    """Test header values parse to Unix seconds, and bad values to None."""
+    assert parse_deadline("1700000000.5") == 1700000000.5
+    assert parse_deadline(None) is None
+    assert parse_deadline("soon") is None
+    assert seconds_left(None) is None
+    assert seconds_left(110.0, now=100.0) == 10.0
+
+
+def test_check_drops_expired_requests():
+    """Test an expired request is dropped and counted at its stage."""
+    stats = DeadlineStats()
+    stats.check(None, "queue")
+    stats.check(200.0, "preprocess", now=100.0)
+    with pytest.raises(DeadlineExceeded) as error:
+        stats.check(100.0, "forward", now=100.5)
+    assert error.value.stage == "forward"
+    assert stats.dropped == {"forward": 1}
+
+
+def test_finish_counts_wasted_compute():
+    """Test predictions finishing after their deadline count as wasted."""
+    stats = DeadlineStats()
+    assert stats.finish(200.0, 0.5, now=100.0)
+    assert not stats.finish(100.0, 1.5, now=101.0)
+    stats.drop("queue")
+    metrics = stats.metrics()
+    assert "ml_deadline_completed_total 2" in metrics
+    assert "ml_deadline_wasted_total 1" in metrics
+    assert "ml_deadline_wasted_seconds_total 1.500" in metrics
+    assert 'ml_deadline_dropped_total{stage="queue"} 1' in metrics
+    assert "ml_deadline_saved_seconds_estimate 1.000" in metrics
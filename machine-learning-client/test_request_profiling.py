@@ -0,0 +1,80 @@
+"""
+Tests for the opt-in request profiling hooks of the ML client.
+"""
+
+import os
+from unittest.mock import patch
+
+import torch
+from flask import Flask
+
+from request_profiling import init_profiling, profiled_forward
+
+
+def make_app():
+    """Create a small app with one route that runs a forward pass."""
+    app = Flask(__name__)
+    model = torch.nn.Linear(8, 2)
+
+    @app.route("/forward")
+    def forward():
+        with torch.no_grad(), profiled_forward():
+            model(torch.randn(4, 8))
+        return "ok"
+
+    return app
+
+
+def test_profiled_forward_writes_trace(tmp_path):
+    """Test a profiled request records a torch.profiler trace of the forward pass."""
+    app = make_app()
+    env = {"PROFILE_TOKEN": "secret", "PROFILE_DIR": str(tmp_path)}
+    with patch.dict(os.environ, env, clear=True):
+        assert init_profiling(app) is True
+    client = app.test_client()
+
+    assert "X-Profile-Id" not in client.get("/forward").headers
+    response = client.get("/forward", headers={"X-Profile": "secret"})
+    profile_id = response.headers["X-Profile-Id"]
+    assert (tmp_path / f"{profile_id}.forward.trace.json").exists()
+    summary = (tmp_path / f"{profile_id}.txt").read_text(encoding="utf-8")
+    assert '"name": "forward"' in summary
+
+    assert client.get("/_profiles").status_code == 404
+    index = client.get("/_profiles", headers={"X-Profile": "secret"})
+    link = f"/_profiles/{profile_id}.txt?token=secret"
+    assert f'href="{link}"'.encode() in index.data
+    assert client.get(link).data.decode() == summary
+
+
+def test_profiles_need_a_token(tmp_path):
+    """Test sampled profiles are pruned and never served without a token."""
+    app = make_app()
+    env = {
+        "PROFILE_SAMPLE_RATE": "1",
+        "PROFILE_DIR": str(tmp_path),
+        "PROFILE_MAX_REPORTS": "1",
+    }
+    with patch.dict(os.environ, env, clear=True):
+        init_profiling(app)
+    client = app.test_client()
+    profile_ids = [client.get("/forward").headers["X-Profile-Id"] for _ in range(2)]
+
+    assert client.get(f"/_profiles/{profile_ids[-1]}.txt").status_code == 404
+    assert not list(tmp_path.glob(f"{profile_ids[0]}.*"))
+    assert (tmp_path / f"{profile_ids[-1]}.forward.trace.json").exists()
+
+
+def test_trace_failure_does_not_fail_request(tmp_path):
+    """Test a request is still served when its forward pass cannot be traced."""
+    app = make_app()
+    env = {"PROFILE_SAMPLE_RATE": "1", "PROFILE_DIR": str(tmp_path)}
+    with patch.dict(os.environ, env, clear=True):
+        init_profiling(app)
+    with patch("torch.profiler.profile.start", side_effect=RuntimeError("busy")):
+        response = app.test_client().get("/forward")
+    assert response.status_code == 200
+    summary = (tmp_path / f"{response.headers['X-Profile-Id']}.txt").read_text(
+        encoding="utf-8"
+    )
+    assert '"name": "forward"' not in summary
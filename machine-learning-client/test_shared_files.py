@@ -0,0 +1,56 @@
+"""
+Unit tests for the shared_files.py shared-volume transport.
+"""
+
+import os
+
+import pytest
+from PIL import Image
+
+from shared_files import InvalidReference, mapped_file, resolve_reference
+
+
+@pytest.fixture(name="root")
+def root_fixture(tmp_path):
+    """A shared root holding one JPEG, next to a file outside the root."""
+    root = tmp_path / "uploads"
+    root.mkdir()
+    Image.new("RGB", (32, 32), color="green").save(root / "photo.jpg")
+    (tmp_path / "secret.txt").write_text("secret", encoding="utf-8")
+    return root
+
+
+def test_resolve_and_decode_in_place(root):
+    """Test a valid reference resolves and decodes from the memory map."""
+    size = os.path.getsize(root / "photo.jpg")
+    path = resolve_reference(str(root), {"path": "photo.jpg", "size": size})
+    with mapped_file(path) as image_file:
+        image = Image.open(image_file).convert("RGB")
+    assert image.size == (32, 32)
+
+
+@pytest.mark.parametrize(
+    "reference",
+    [
+        None,
+        {"path": ""},
+        {"path": "../secret.txt"},
+        {"path": "/etc/passwd"},
+        {"path": "missing.jpg"},
+        {"path": "photo.jpg", "size": 1},
+        {"path": "link.txt"},
+    ],
+)
+def test_invalid_references_rejected(root, reference):
+    """Test references outside the root, missing or resized are rejected."""
+    os.symlink(root.parent / "secret.txt", root / "link.txt")
+    with pytest.raises(InvalidReference):
+        resolve_reference(str(root), reference)
+
+
+def test_empty_file_rejected(root):
+    """Test an empty file cannot be mapped."""
+    (root / "empty.jpg").write_bytes(b"")
+    with pytest.raises(InvalidReference):
+        with mapped_file(str(root / "empty.jpg")):
+            pass
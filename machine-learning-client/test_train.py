@@ -0,0 +1,99 @@
+"""
+Unit tests for the distillation helpers in train.py.
+"""
+
+import sys
+from unittest.mock import MagicMock, patch
+
+import pytest
+import torch
+from torch.utils.data import DataLoader, TensorDataset
+
+from architectures import build_model, save_checkpoint
+from train import (
+    CpuFastPath,
+    check_teacher_split,
+    cpu_supports_bf16,
+    distillation_loss,
+    measure_rss,
+    peak_rss_mb,
+    split_id,
+    split_indices,
+    train_one_epoch,
+)
+
+
+def test_distillation_loss_matches_teacher():
+    """Test the soft-target term vanishes when the student matches the teacher."""
+    logits = torch.tensor([[2.0, 0.5, -1.0], [0.1, 0.2, 3.0]])
+    labels = torch.tensor([0, 2])
+    soft_only = distillation_loss(logits, logits, labels, temperature=4, alpha=1)
+    assert soft_only.item() < 1e-6
+    other = torch.zeros_like(logits)
+    assert distillation_loss(other, logits, labels, temperature=4, alpha=1) > 0
+    hard_only = distillation_loss(logits, other, labels, temperature=4, alpha=0)
+    assert torch.isclose(hard_only, torch.nn.functional.cross_entropy(logits, labels))
+
+
+def test_split_indices_without_setid(tmp_path):
+    """Test the fallback split is a fixed 80/20 partition of all images."""
+    train, test = split_indices(100, split_file=str(tmp_path / "missing.mat"))
+    assert len(train) == 80 and len(test) == 20
+    assert sorted(train + test) == list(range(100))
+    assert split_indices(100, split_file=str(tmp_path / "missing.mat"))[1] == test
+
+
+def test_check_teacher_split(tmp_path):
+    """Test a teacher is accepted only if it records the distillation split."""
+    model = build_model("mobilenet_v3_small")
+    path = tmp_path / "teacher.pth"
+    save_checkpoint(model, "mobilenet_v3_small", path, split=split_id([3, 1, 2]))
+    check_teacher_split(path, [1, 2, 3])
+    with pytest.raises(ValueError):
+        check_teacher_split(path, [1, 2, 4])
+    save_checkpoint(model, "mobilenet_v3_small", path)
+    with pytest.raises(ValueError):
+        check_teacher_split(path, [1, 2, 3])
+
+
+def test_measure_rss(tmp_path):
+    """Test peak RSS is measured in a separate process from a checkpoint."""
+    path = tmp_path / "student.pth"
+    save_checkpoint(build_model("mobilenet_v3_small"), "mobilenet_v3_small", path)
+    assert measure_rss(str(path)) > 0
+
+
+def test_peak_rss_without_resource_module(tmp_path):
+    """Test peak RSS is reported as unknown where resource is missing (Windows)."""
+    path = tmp_path / "student.pth"
+    save_checkpoint(build_model("mobilenet_v3_small"), "mobilenet_v3_small", path)
+    with patch.dict(sys.modules, {"resource": None}):
+        assert peak_rss_mb(str(path)) is None
+
+
+def test_cpu_supports_bf16(tmp_path):
+    """Test bf16 is detected from the CPU flags and off when they are unknown."""
+    cpuinfo = tmp_path / "cpuinfo"
+    cpuinfo.write_text("processor\t: 0\nflags\t\t: fpu avx2 avx512f\n")
+    assert not cpu_supports_bf16(str(cpuinfo))
+    cpuinfo.write_text("flags\t\t: fpu avx2 avx512f amx_bf16\n")
+    assert cpu_supports_bf16(str(cpuinfo))
+    assert not cpu_supports_bf16(str(tmp_path / "missing"))
+
+
+def test_train_one_epoch_accumulates_gradients():
+    """Test the optimizer steps once per accumulated group and on the last batch."""
+    model = torch.nn.Sequential(
+        torch.nn.Conv2d(3, 4, 3), torch.nn.Flatten(), torch.nn.Linear(4 * 6 * 6, 2)
+    ).to(memory_format=torch.channels_last)
+    loader = DataLoader(
+        TensorDataset(torch.randn(10, 3, 8, 8), torch.randint(2, (10,))),
+        batch_size=2,
+    )
+    optimizer = MagicMock(wraps=torch.optim.SGD(model.parameters(), lr=0.1))
+    fast = CpuFastPath(bf16=True, channels_last=True, accumulation_steps=2)
+    loss = train_one_epoch(
+        model, loader, torch.nn.CrossEntropyLoss(), optimizer, fast=fast
+    )
+    assert loss > 0
+    assert optimizer.step.call_count == 3  # batches 2, 4 and the last one
@@ -0,0 +1,61 @@
+"""
+Unit tests for the tta.py test-time augmentation helpers.
+"""
+
+import torch
+from PIL import Image
+
+from tta import VIEW_NAMES, LatencyBudget, build_views, make_view
+
+
+def test_make_view_sizes():
+    """Test every view is a 224x224 image."""
+    image = Image.new("RGB", (640, 480), color="yellow")
+    for name in VIEW_NAMES:
+        assert make_view(image, name).size == (224, 224)
+
+
+def test_build_views_batch_shape():
+    """Test build_views stacks the requested number of views and clamps it."""
+    image = Image.new("RGB", (300, 200), color="purple")
+    assert build_views(image, 3).shape == (3, 3, 224, 224)
+    assert build_views(image, 100).shape == (len(VIEW_NAMES), 3, 224, 224)
+    assert build_views(image, 0).shape == (1, 3, 224, 224)
+
+
+def test_flip_view_mirrors_full_view():
+    """Test the flip view is the mirror image of the full view."""
+    image = Image.new("RGB", (300, 200), color="orange")
+    view = build_views(image, 1)
+    flipped = build_views(image, 2)[1]
+    assert torch.allclose(view[0].flip(-1), flipped)
+
+
+def test_latency_budget_drops_views_under_load():
+    """Test the budget allows all views until forward passes get too slow."""
+    budget = LatencyBudget(max_views=8, budget_ms=100)
+    assert budget.views() == 8
+
+    budget.per_view_ms = 20.0
+    assert budget.views() == 5
+
+    budget.in_flight = 3
+    assert budget.views() == 1
+
+
+def test_latency_budget_tracks_per_view_cost():
+    """Test track records a per-view cost estimate."""
+    budget = LatencyBudget(max_views=4, budget_ms=1000)
+    with budget.track(4):
+        pass
+    assert budget.per_view_ms is not None
+    assert budget.in_flight == 0
+
+
+def test_latency_budget_respects_deadline():
+    """Test views that would not finish before the deadline are left out."""
+    budget = LatencyBudget(max_views=8)
+    budget.per_view_ms = 20.0
+    assert budget.views() == 8
+    assert budget.views(remaining_ms=50) == 2
+    assert budget.views(remaining_ms=1) == 1
@@ -1,20 +1,66 @@
 """
 This module trains a ResNet50 model on a flower dataset with 102 classes.
 It includes data loading, model setup, and training functions.
+
+With --distill it instead trains a small student (MobileNetV3 or ResNet18)
+on the soft targets of the trained ResNet50 teacher and writes a report
+comparing their accuracy, latency and memory use.
+
+Without CUDA, training can take a CPU fast path: bfloat16 autocast on CPUs
+with native bf16 instructions (AVX512-BF16 or AMX), channels_last tensors,
+an optional torch.compile, a tuned thread count and gradient accumulation.
+--benchmark-training measures its images/sec against the plain fp32 loop.
 """
 
+import argparse
+import hashlib
+import json
+import multiprocessing
 import os
+import sys
+import time
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor
+
 import scipy.io
 import numpy as np
 import torch
+import torch.nn.functional as F
 from torch import nn, optim
-from torch.utils.data import Dataset, DataLoader
+from torch.utils.data import Dataset, DataLoader, Subset, TensorDataset
 from torchvision import models, transforms
 from PIL import Image
 from tqdm import tqdm
 
+from architectures import (
+    ARCHITECTURES,
+    NUM_CLASSES,
+    build_model,
+    checkpoint_split,
+    read_checkpoint,
+    save_checkpoint,
+)
+
 device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
 
+IMG_DIR = "data/flowers-102/jpg"
+LABEL_FILE = "data/flowers-102/imagelabels.mat"
+SPLIT_FILE = "data/flowers-102/setid.mat"
+TEACHER_PATH = "flower_classification_resnet.pth"
+
+NORMALIZE = transforms.Normalize([0.485, 0.456, 0.406], [0.229, 0.224, 0.225])
+
+# CPU fast path settings; the defaults are the plain fp32 eager loop
+CpuFastPath = namedtuple(
+    "CpuFastPath",
+    ["bf16", "channels_last", "compile", "threads", "accumulation_steps"],
+    defaults=[False, False, False, None, 1],
+)
+
+# /proc/cpuinfo flags of CPUs that compute in bfloat16 natively; elsewhere
+# bf16 autocast is emulated and slower than fp32
+BF16_CPU_FLAGS = {"avx512_bf16", "amx_bf16"}
+
 
 def load_labels(mat_file):
     """
@@ -63,7 +109,64 @@ class FlowerDataset(Dataset):
         return image, label
 
 
-def train_one_epoch(model, train_loader, criterion, optimizer, scaler=None):
+def cpu_supports_bf16(cpuinfo_path="/proc/cpuinfo"):
+    """
+    Check whether the CPU has native bfloat16 instructions.
+
+    Returns:
+        bool: True on CPUs with AVX512-BF16 or AMX; False elsewhere, including
+            when the CPU flags cannot be read (non-Linux hosts).
+    """
+    try:
+        with open(cpuinfo_path, encoding="utf-8") as file:
+            for line in file:
+                if line.startswith("flags"):
+                    return not BF16_CPU_FLAGS.isdisjoint(line.split(":", 1)[1].split())
+    except OSError:
+        pass
+    return False
+
+
+def cpu_fast_path(args):
+    """
+    Build the CPU fast path settings from the command line arguments.
+
+    bf16 is only enabled on CPUs that support it natively, and neither bf16
+    nor channels_last is used when training on CUDA, which has its own
+    mixed-precision path.
+
+    Returns:
+        CpuFastPath: The settings.
+    """
+    on_cpu = device.type == "cpu"
+    return CpuFastPath(
+        bf16=on_cpu and args.cpu_fast and cpu_supports_bf16(),
+        channels_last=on_cpu and args.cpu_fast,
+        compile=args.compile,
+        threads=args.threads,
+        accumulation_steps=args.accumulation_steps,
+    )
+
+
+def prepare_model(model, fast):
+    """
+    Apply the thread count, memory format and compilation of the fast path.
+
+    Returns:
+        nn.Module: The model to train (a compiled wrapper with fast.compile).
+    """
+    if fast.threads:
+        torch.set_num_threads(fast.threads)
+    if fast.channels_last:
+        model = model.to(memory_format=torch.channels_last)
+    if fast.compile:
+        model = torch.compile(model)
+    return model
+
+
+def train_one_epoch(  # pylint: disable=too-many-arguments,too-many-positional-arguments
+    model, train_loader, criterion, optimizer, scaler=None, fast=CpuFastPath()
+):
     """
     Train the model for one epoch.
 
@@ -73,39 +176,52 @@ def train_one_epoch(model, train_loader, criterion, optimizer, scaler=None):
         criterion (nn.Module): Loss function.
         optimizer (torch.optim.Optimizer): Optimizer for training.
         scaler (torch.cuda.amp.GradScaler, optional): Scaler for mixed-precision training.
+        fast (CpuFastPath, optional): bf16 autocast, channels_last inputs and
+            gradient accumulation over fast.accumulation_steps batches.
 
     Returns:
         float: Average loss over the epoch.
     """
     model.train()
     running_loss = 0.0
+    steps = max(1, fast.accumulation_steps)
 
-    for images, labels in tqdm(train_loader, desc="Training", unit="batch"):
-        images, labels = images.to(device), labels.to(device)
+    # Zero the parameter gradients
+    optimizer.zero_grad()
 
-        # Zero the parameter gradients
-        optimizer.zero_grad()
+    for batch, (images, labels) in enumerate(
+        tqdm(train_loader, desc="Training", unit="batch"), start=1
+    ):
+        images, labels = images.to(device), labels.to(device)
+        if fast.channels_last:
+            images = images.contiguous(memory_format=torch.channels_last)
 
         # Forward pass with or without mixed precision
         if scaler:
             with torch.cuda.amp.autocast():
                 outputs = model(images)
                 loss = criterion(outputs, labels)
-            scaler.scale(loss).backward()
-            scaler.step(optimizer)
-            scaler.update()
         else:
-            outputs = model(images)
-            loss = criterion(outputs, labels)
-            loss.backward()
-            optimizer.step()
+            with torch.autocast("cpu", dtype=torch.bfloat16, enabled=fast.bf16):
+                outputs = model(images)
+                loss = criterion(outputs, labels)
+
+        # Gradients of the accumulated batches add up to one averaged step
+        (scaler.scale(loss / steps) if scaler else loss / steps).backward()
+        if batch % steps == 0 or batch == len(train_loader):
+            if scaler:
+                scaler.step(optimizer)
+                scaler.update()
+            else:
+                optimizer.step()
+            optimizer.zero_grad()
 
         running_loss += loss.item() * images.size(0)
 
     return running_loss / len(train_loader.dataset)
 
 
-def create_dataloader(img_dir, labels, transform):
+def create_dataloader(img_dir, labels, transform, indices=None):
     """
     Create a DataLoader for the flower dataset.
 
@@ -113,49 +229,68 @@ def create_dataloader(img_dir, labels, transform):
         img_dir (str): Path to the image directory.
         labels (np.ndarray): Array of image labels.
         transform (callable): Transformation to apply to each image.
+        indices (list, optional): Load only these images.
 
     Returns:
         DataLoader: DataLoader instance for the dataset.
     """
     dataset = FlowerDataset(img_dir, labels, transform=transform)
+    if indices is not None:
+        dataset = Subset(dataset, indices)
     return DataLoader(
         dataset,
         batch_size=32,
         shuffle=True,
         num_workers=4 if torch.cuda.is_available() else 0,
-        pin_memory=True,
+        pin_memory=torch.cuda.is_available(),
     )
 
 
-def main():
+def teacher_model(num_classes, pretrained=True):
     """
-    Main function for setting up the dataset, model, and training process.
+    Build a ResNet50 whose backbone is frozen and whose classifier is new.
+
+    Returns:
+        nn.Module: The model, on device.
     """
-    img_dir = "data/flowers-102/jpg"
-    label_file = "data/flowers-102/imagelabels.mat"
-    labels = load_labels(label_file)
+    model = models.resnet50(
+        weights=models.ResNet50_Weights.DEFAULT if pretrained else None
+    )
+    for param in model.parameters():
+        param.requires_grad = False
+
+    model.fc = nn.Linear(model.fc.in_features, num_classes)
+    return model.to(device)
+
+
+def train_teacher(fast=CpuFastPath()):
+    """
+    Fine-tune the classifier of a pre-trained ResNet50 and save it to TEACHER_PATH.
+
+    Trains on the training images of split_indices only, and records that
+    split in the checkpoint, so the test images stay unseen for distill().
+
+    Args:
+        fast (CpuFastPath, optional): CPU fast path settings.
+    """
+    labels = load_labels(LABEL_FILE)
 
     # Define data transformations
     transform = transforms.Compose(
         [
             transforms.Resize((224, 224)),
             transforms.ToTensor(),
-            transforms.Normalize([0.485, 0.456, 0.406], [0.229, 0.224, 0.225]),
+            NORMALIZE,
         ]
     )
 
-    # Create DataLoader
-    train_loader = create_dataloader(img_dir, labels, transform)
+    # Create DataLoader over the training split
+    train_indices, test_indices = split_indices(len(labels))
+    train_loader = create_dataloader(IMG_DIR, labels, transform, train_indices)
 
     # Load pre-trained ResNet model and modify the classifier
-    model = models.resnet50(weights=models.ResNet50_Weights.DEFAULT)
-    num_classes = len(np.unique(labels))
-
-    for param in model.parameters():
-        param.requires_grad = False
-
-    model.fc = nn.Linear(model.fc.in_features, num_classes)
-    model = model.to(device)
+    model = teacher_model(len(np.unique(labels)))
+    trained = prepare_model(model, fast)
 
     # Define loss function and optimizer
     criterion = nn.CrossEntropyLoss()
@@ -168,13 +303,395 @@ def main():
     epochs = 1
     for epoch in range(epochs):
         print(f"Epoch {epoch+1}/{epochs}")
-        epoch_loss = train_one_epoch(model, train_loader, criterion, optimizer, scaler)
+        epoch_loss = train_one_epoch(
+            trained, train_loader, criterion, optimizer, scaler, fast
+        )
         print(f"Epoch {epoch+1}/{epochs}, Loss: {epoch_loss:.4f}")
 
     # Save the trained model parameters
-    save_path = "flower_classification_resnet.pth"
-    torch.save(model.state_dict(), save_path)
-    print(f"Model parameters saved to {save_path}")
+    save_checkpoint(model, "resnet50", TEACHER_PATH, split=split_id(test_indices))
+    print(f"Model parameters saved to {TEACHER_PATH}")
+
+
+def training_throughput(fast, batch_size=32, batches=8, warmup=2):
+    """
+    Measure the training speed of the teacher setup on synthetic images.
+
+    Args:
+        fast (CpuFastPath): Settings to measure.
+        batch_size (int): Images per batch.
+        batches (int): Timed batches.
+        warmup (int): Untimed batches run first (includes compilation).
+
+    Returns:
+        float: Images per second.
+    """
+    model = prepare_model(teacher_model(NUM_CLASSES, pretrained=False), fast)
+    optimizer = optim.Adam(
+        (param for param in model.parameters() if param.requires_grad), lr=1e-4
+    )
+
+    def loader(num_batches):
+        images = torch.randn(num_batches * batch_size, 3, 224, 224)
+        labels = torch.randint(NUM_CLASSES, (num_batches * batch_size,))
+        return DataLoader(TensorDataset(images, labels), batch_size=batch_size)
+
+    criterion = nn.CrossEntropyLoss()
+    train_one_epoch(model, loader(warmup), criterion, optimizer, fast=fast)
+    timed = loader(batches)
+    start = time.perf_counter()
+    train_one_epoch(model, timed, criterion, optimizer, fast=fast)
+    return len(timed.dataset) / (time.perf_counter() - start)
+
+
+def benchmark_training(fast, **options):
+    """
+    Compare the images/sec of the fast path with the plain fp32 eager loop.
+
+    Returns:
+        dict: Images/sec of both loops and the speedup.
+    """
+    default_threads = torch.get_num_threads()
+    fast_speed = training_throughput(fast, **options)
+    torch.set_num_threads(default_threads)
+    baseline_speed = training_throughput(CpuFastPath(), **options)
+    report = {
+        "fast_path": fast._asdict(),
+        "baseline_images_per_sec": round(baseline_speed, 2),
+        "fast_images_per_sec": round(fast_speed, 2),
+        "speedup": round(fast_speed / baseline_speed, 2),
+    }
+    print(
+        f"fp32 eager: {baseline_speed:.1f} images/s, "
+        f"fast path: {fast_speed:.1f} images/s ({report['speedup']:.2f}x)"
+    )
+    return report
+
+
+def distillation_loss(student_logits, teacher_logits, labels, temperature, alpha):
+    """
+    Knowledge-distillation loss (Hinton et al.).
+
+    Args:
+        student_logits (torch.Tensor): Student outputs.
+        teacher_logits (torch.Tensor): Teacher outputs for the same images.
+        labels (torch.Tensor): Ground-truth class indices.
+        temperature (float): Softening temperature for both distributions.
+        alpha (float): Weight of the soft-target term; 1 - alpha weights
+            the cross-entropy with the labels.
+
+    Returns:
+        torch.Tensor: The loss.
+    """
+    soft_loss = F.kl_div(
+        F.log_softmax(student_logits / temperature, dim=1),
+        F.softmax(teacher_logits / temperature, dim=1),
+        reduction="batchmean",
+    ) * (temperature**2)
+    hard_loss = F.cross_entropy(student_logits, labels)
+    return alpha * soft_loss + (1 - alpha) * hard_loss
+
+
+def distill_one_epoch(student, teacher, train_loader, optimizer, args):
+    """
+    Train the student on the teacher's soft targets for one epoch.
+
+    Returns:
+        float: Average loss over the epoch.
+    """
+    student.train()
+    teacher.eval()
+    running_loss = 0.0
+
+    for images, labels in tqdm(train_loader, desc="Distilling", unit="batch"):
+        images, labels = images.to(device), labels.to(device)
+        with torch.no_grad():
+            teacher_logits = teacher(images)
+
+        optimizer.zero_grad()
+        loss = distillation_loss(
+            student(images), teacher_logits, labels, args.temperature, args.alpha
+        )
+        loss.backward()
+        optimizer.step()
+        running_loss += loss.item() * images.size(0)
+
+    return running_loss / len(train_loader.dataset)
+
+
+def split_indices(num_images, split_file=SPLIT_FILE):
+    """
+    Split the images into training and test indices.
+
+    Uses the official flowers-102 split when setid.mat is available
+    (train + validation images for training, the test images for testing),
+    and a fixed random 80/20 split otherwise.
+
+    Returns:
+        tuple: (train indices, test indices)
+    """
+    if os.path.exists(split_file):
+        split = scipy.io.loadmat(split_file)
+        train = np.concatenate([split["trnid"].squeeze(), split["valid"].squeeze()])
+        return (train - 1).tolist(), (split["tstid"].squeeze() - 1).tolist()
+    order = np.random.default_rng(0).permutation(num_images)
+    cut = int(num_images * 0.8)
+    return order[:cut].tolist(), order[cut:].tolist()
+
+
+def split_id(test_indices):
+    """Identify a train/test split by its test images."""
+    text = ",".join(str(index) for index in sorted(test_indices))
+    return hashlib.sha1(text.encode()).hexdigest()[:16]
+
+
+def check_teacher_split(checkpoint_path, test_indices):
+    """
+    Check a teacher checkpoint was trained without the test images.
+
+    Raises:
+        ValueError: If the checkpoint records no split or another one, as
+            the stock teacher trained on every image does.
+    """
+    if checkpoint_split(checkpoint_path) != split_id(test_indices):
+        raise ValueError(
+            f"{checkpoint_path} was not trained on the distillation split; "
+            "retrain the teacher with train.py"
+        )
+
+
+def evaluate(model, loader):
+    """
+    Compute the top-1 accuracy of a model.
+
+    Returns:
+        float: Fraction of correctly classified images.
+    """
+    model.eval()
+    correct = 0
+    with torch.no_grad():
+        for images, labels in tqdm(loader, desc="Evaluating", unit="batch"):
+            outputs = model(images.to(device))
+            correct += (outputs.argmax(dim=1).cpu() == labels).sum().item()
+    return correct / len(loader.dataset)
+
+
+def measure_latency(model, runs=30):
+    """
+    Median CPU latency of a single-image forward pass.
+
+    Returns:
+        float: Milliseconds per image.
+    """
+    model = model.to("cpu").eval()
+    image = torch.randn(1, 3, 224, 224)
+    timings = []
+    with torch.no_grad():
+        for run in range(runs + 3):
+            start = time.perf_counter()
+            model(image)
+            if run >= 3:  # Skip warm-up runs
+                timings.append((time.perf_counter() - start) * 1000)
+    model.to(device)
+    return float(np.median(timings))
+
+
+def peak_rss_mb(checkpoint_path):
+    """
+    Load a checkpoint and run one forward pass, as the ML client does.
+
+    Runs in a fresh process (see measure_rss), so the peak RSS it reports
+    belongs to this model alone plus the PyTorch runtime.
+
+    Returns:
+        float: Peak resident set size in MiB, or None where the resource
+            module is unavailable (Windows).
+    """
+    try:
+        import resource  # pylint: disable=import-outside-toplevel
+    except ImportError:
+        resource = None
+    arch, state_dict = read_checkpoint(checkpoint_path, map_location="cpu")
+    model = build_model(arch)
+    model.load_state_dict(state_dict)
+    model.eval()
+    with torch.no_grad():
+        model(torch.randn(1, 3, 224, 224))
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on macOS and KiB on Linux
+    return peak / 1024**2 if sys.platform == "darwin" else peak / 1024
+
+
+def measure_rss(checkpoint_path):
+    """Return peak_rss_mb(checkpoint_path) measured in a spawned process."""
+    context = multiprocessing.get_context("spawn")
+    with ProcessPoolExecutor(max_workers=1, mp_context=context) as executor:
+        return executor.submit(peak_rss_mb, checkpoint_path).result()
+
+
+def describe_model(name, arch, model, checkpoint_path, test_loader):
+    """Collect the report entry of one model."""
+    print(f"Measuring {name} ({arch})")
+    return {
+        "arch": arch,
+        "checkpoint": checkpoint_path,
+        "parameters": sum(param.numel() for param in model.parameters()),
+        "accuracy": evaluate(model, test_loader),
+        "latency_ms": measure_latency(model),
+        "peak_rss_mb": measure_rss(checkpoint_path),
+    }
+
+
+def distillation_loaders(labels, batch_size):
+    """
+    Create the training and test DataLoaders for distillation.
+
+    Training images are augmented; test images get the same preprocessing
+    as transform_image() in app.py.
+
+    Returns:
+        tuple: (train DataLoader, test DataLoader)
+    """
+    train_transform = transforms.Compose(
+        [
+            transforms.RandomResizedCrop(224, scale=(0.5, 1.0)),
+            transforms.RandomHorizontalFlip(),
+            transforms.ToTensor(),
+            NORMALIZE,
+        ]
+    )
+    test_transform = transforms.Compose(
+        [transforms.Resize((224, 224)), transforms.ToTensor(), NORMALIZE]
+    )
+    train_indices, test_indices = split_indices(len(labels))
+    loader_options = {
+        "batch_size": batch_size,
+        "num_workers": 4 if torch.cuda.is_available() else 0,
+        "pin_memory": torch.cuda.is_available(),
+    }
+    train_loader = DataLoader(
+        Subset(FlowerDataset(IMG_DIR, labels, train_transform), train_indices),
+        shuffle=True,
+        **loader_options,
+    )
+    test_loader = DataLoader(
+        Subset(FlowerDataset(IMG_DIR, labels, test_transform), test_indices),
+        **loader_options,
+    )
+    return train_loader, test_loader
+
+
+def print_report(report):
+    """Print the teacher and student entries of a report side by side."""
+    print(
+        f"{'':8} {'accuracy':>9} {'latency ms':>11} {'peak RSS MiB':>13} {'params':>11}"
+    )
+    for name in ("teacher", "student"):
+        entry = report[name]
+        rss = entry["peak_rss_mb"]
+        rss = "n/a" if rss is None else f"{rss:.0f}"
+        print(
+            f"{name:8} {entry['accuracy']:9.2%} {entry['latency_ms']:11.1f} "
+            f"{rss:>13} {entry['parameters']:11,}"
+        )
+
+
+def distill(args):
+    """
+    Train a student on the soft targets of the teacher and report on both.
+
+    Returns:
+        dict: The comparison report, also written to args.report.
+    """
+    train_loader, test_loader = distillation_loaders(
+        load_labels(LABEL_FILE), args.batch_size
+    )
+    check_teacher_split(args.teacher, test_loader.dataset.indices)
+
+    teacher_arch, state_dict = read_checkpoint(args.teacher, map_location=device)
+    teacher = build_model(teacher_arch)
+    teacher.load_state_dict(state_dict)
+    teacher = teacher.to(device).eval()
+
+    student = build_model(args.student, pretrained=True).to(device)
+    optimizer = optim.AdamW(student.parameters(), lr=args.lr, weight_decay=1e-4)
+    scheduler = optim.lr_scheduler.CosineAnnealingLR(optimizer, T_max=args.epochs)
+    for epoch in range(args.epochs):
+        epoch_loss = distill_one_epoch(student, teacher, train_loader, optimizer, args)
+        scheduler.step()
+        print(f"Epoch {epoch+1}/{args.epochs}, Loss: {epoch_loss:.4f}")
+
+    save_checkpoint(student, args.student, args.output)
+    print(f"Student saved to {args.output}")
+
+    report = {
+        "temperature": args.temperature,
+        "alpha": args.alpha,
+        "epochs": args.epochs,
+        "test_images": len(test_loader.dataset),
+        "teacher": describe_model(
+            "teacher", teacher_arch, teacher, args.teacher, test_loader
+        ),
+        "student": describe_model(
+            "student", args.student, student, args.output, test_loader
+        ),
+    }
+    with open(args.report, "w", encoding="utf-8") as file:
+        json.dump(report, file, indent=2)
+    print_report(report)
+    print(f"Report saved to {args.report}")
+    return report
+
+
+def main(argv=None):
+    """
+    Train the ResNet50 teacher, or with --distill a student from the teacher.
+    """
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument(
+        "--distill", action="store_true", help="train a student from the teacher"
+    )
+    parser.add_argument(
+        "--student",
+        default="mobilenet_v3_large",
+        choices=[arch for arch in ARCHITECTURES if arch != "resnet50"],
+    )
+    parser.add_argument("--teacher", default=TEACHER_PATH)
+    parser.add_argument("--output", default="flower_classification_student.pth")
+    parser.add_argument("--report", default="distill_report.json")
+    parser.add_argument("--epochs", type=int, default=10)
+    parser.add_argument("--batch-size", type=int, default=32)
+    parser.add_argument("--lr", type=float, default=1e-3)
+    parser.add_argument("--temperature", type=float, default=4.0)
+    parser.add_argument("--alpha", type=float, default=0.7)
+    parser.add_argument(
+        "--cpu-fast",
+        action="store_true",
+        help="without CUDA, use bf16 autocast (if supported) and channels_last",
+    )
+    parser.add_argument("--compile", action="store_true", help="use torch.compile")
+    parser.add_argument("--threads", type=int, help="intra-op threads for PyTorch")
+    parser.add_argument(
+        "--accumulation-steps",
+        type=int,
+        default=1,
+        help="batches per optimizer step when training the teacher",
+    )
+    parser.add_argument(
+        "--benchmark-training",
+        action="store_true",
+        help="compare the images/sec of the fast path with the fp32 loop",
+    )
+    args = parser.parse_args(argv)
+
+    if args.benchmark_training:
+        benchmark_training(cpu_fast_path(args), batch_size=args.batch_size)
+    elif args.distill:
+        distill(args)
+    else:
+        train_teacher(cpu_fast_path(args))
 
 
 if __name__ == "__main__":
@@ -0,0 +1,146 @@
+"""
+Test-time augmentation (TTA) for flower classification.
+
+Builds several views of one image (full frame, horizontal flip, center and
+corner crops, a zoomed crop) as a single batch so the model runs one batched
+forward pass, and keeps a latency budget that drops views under load.
+"""
+
+import math
+import threading
+import time
+from contextlib import contextmanager
+
+import torch
+from PIL import ImageOps
+from torchvision import transforms
+
+IMAGE_SIZE = 224
+
+# Views in the order they are dropped last to first when the budget is tight
+VIEW_NAMES = (
+    "full",
+    "flip",
+    "center",
+    "top_left",
+    "top_right",
+    "bottom_left",
+    "bottom_right",
+    "zoom",
+)
+
+to_normalized_tensor = transforms.Compose(
+    [
+        transforms.ToTensor(),
+        transforms.Normalize(mean=[0.485, 0.456, 0.406], std=[0.229, 0.224, 0.225]),
+    ]
+)
+
+
+def make_view(image, name):
+    """
+    Produce one 224x224 view of a PIL image.
+
+    Args:
+        image (PIL.Image.Image): RGB input image.
+        name (str): One of VIEW_NAMES.
+
+    Returns:
+        PIL.Image.Image: The view.
+    """
+    if name in ("full", "flip"):
+        view = image.resize((IMAGE_SIZE, IMAGE_SIZE))
+        return ImageOps.mirror(view) if name == "flip" else view
+    if name == "zoom":
+        scaled = image.resize((IMAGE_SIZE * 9 // 7, IMAGE_SIZE * 9 // 7))
+        return transforms.functional.center_crop(scaled, IMAGE_SIZE)
+
+    scaled_size = IMAGE_SIZE * 8 // 7
+    scaled = image.resize((scaled_size, scaled_size))
+    if name == "center":
+        return transforms.functional.center_crop(scaled, IMAGE_SIZE)
+    offset = scaled_size - IMAGE_SIZE
+    left = offset if name.endswith("right") else 0
+    top = offset if name.startswith("bottom") else 0
+    return scaled.crop((left, top, left + IMAGE_SIZE, top + IMAGE_SIZE))
+
+
+def build_views(image, num_views):
+    """
+    Build a batch of the first num_views views of an image.
+
+    Args:
+        image (PIL.Image.Image): RGB input image.
+        num_views (int): Number of views, clamped to 1..len(VIEW_NAMES).
+
+    Returns:
+        torch.Tensor: Normalized batch of shape (num_views, 3, 224, 224).
+    """
+    num_views = max(1, min(num_views, len(VIEW_NAMES)))
+    return torch.stack(
+        [
+            to_normalized_tensor(make_view(image, name))
+            for name in VIEW_NAMES[:num_views]
+        ]
+    )
+
+
+class LatencyBudget:
+    """
+    Chooses how many TTA views to run so a request fits a latency budget.
+
+    The cost of one view is tracked as an exponential moving average of
+    forward-pass time per view, normalized by the number of requests that
+    were sharing the CPU. The estimate for the next request is scaled back up
+    by the number of requests currently in flight.
+    """
+
+    def __init__(self, max_views, budget_ms=0.0, smoothing=0.2):
+        self.max_views = max(1, min(max_views, len(VIEW_NAMES)))
+        self.budget_ms = budget_ms
+        self.smoothing = smoothing
+        self.per_view_ms = None
+        self.in_flight = 0
+        self._lock = threading.Lock()
+
+    def views(self, remaining_ms=None):
+        """
+        Return the number of views the next request may use.
+
+        Args:
+            remaining_ms (float): Time left before the request's deadline, if
+                it has one; views that would not finish in time are left out.
+        """
+        with self._lock:
+            budgets = [
+                budget
+                for budget in (
+                    self.budget_ms if self.budget_ms > 0 else None,
+                    remaining_ms,
+                )
+                if budget is not None
+            ]
+            if not budgets or self.per_view_ms is None:
+                return self.max_views
+            load = max(1, self.in_flight + 1)
+            allowed = math.floor(min(budgets) / (self.per_view_ms * load))
+            return max(1, min(self.max_views, allowed))
+
+    @contextmanager
+    def track(self, num_views):
+        """Context manager that times a forward pass over num_views views."""
+        with self._lock:
+            self.in_flight += 1
+            concurrency = self.in_flight
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed_ms = (time.perf_counter() - start) * 1000
+            with self._lock:
+                self.in_flight -= 1
+                sample = elapsed_ms / (num_views * concurrency)
+                if self.per_view_ms is None:
+                    self.per_view_ms = sample
+                else:
+                    self.per_view_ms += self.smoothing * (sample - self.per_view_ms)
@@ -3,12 +3,15 @@ This module sets up the Flask application for the Plant Identifier project.
 """
 
 import os
+import io
 import base64
+import mimetypes
+import time
 import uuid
+from datetime import datetime, timezone
 
 from bson import ObjectId
 from dotenv import load_dotenv
-from werkzeug.security import generate_password_hash, check_password_hash
 from flask import (
     Flask,
     flash,
@@ -16,14 +19,74 @@ from flask import (
     render_template,
     redirect,
     make_response,
+    Response,
     session,
     url_for,
+    jsonify,
 )
+from PIL import Image, ImageOps, UnidentifiedImageError
 import pymongo
 import requests
 
+from auth_guard import AuthBusy, AuthGuard
+from history_export import (
+    EXPORT_FORMATS,
+    EXPORT_ZIP_MAX_ROWS,
+    ZIP_TOO_LARGE,
+    ZipExport,
+    archive_members,
+    byte_range,
+    coalesce,
+    csv_lines,
+    export_cursor,
+    export_headers,
+    export_row,
+    ndjson_line,
+)
+from live_updates import PredictionFeed
+from http_cache import Fragment, conditional_page, fragment_cache, init_http_cache
+from request_profiling import init_profiling, profiled_section
+from search import (
+    SearchIndexes,
+    ensure_search_indexes,
+    search_entries,
+    search_params,
+)
+from upload_gc import UPLOADS_DIR, options_from_env, start_sweeper
+from upload_limits import (
+    UploadLimiter,
+    UploadRejected,
+    usage_day,
+    usage_id,
+    usage_upsert,
+)
+from user_stats import (
+    begin_change,
+    cancel_change,
+    forget_prediction,
+    get_user_stats,
+    predictions_version,
+    record_prediction,
+)
+
 load_dotenv()
 
+# Uploads are downsized to this longest edge and re-encoded in UPLOAD_FORMAT
+UPLOAD_MAX_EDGE = int(os.getenv("UPLOAD_MAX_EDGE", "512"))
+UPLOAD_FORMAT = os.getenv("UPLOAD_FORMAT", "JPEG").upper()
+UPLOAD_QUALITY = int(os.getenv("UPLOAD_QUALITY", "85"))
+UPLOAD_KEEP_ORIGINAL = os.getenv("UPLOAD_KEEP_ORIGINAL", "false").lower() == "true"
+IMAGE_EXTENSIONS = {"JPEG": "jpg", "PNG": "png", "WEBP": "webp", "GIF": "gif"}
+
+# Seconds to wait for the ML client, sent along as an absolute deadline so
+# it can drop work that would finish after we have given up
+ML_TIMEOUT = 10
+DEADLINE_HEADER = "X-Request-Deadline"
+
+# "shared" sends the ML client a reference to the stored photo instead of the
+# photo itself; both containers must mount the uploads directory
+ML_TRANSPORT = os.getenv("ML_TRANSPORT", "multipart")
+
 
 def create_app():
     """Initializes and configures the Flask app."""
@@ -35,6 +98,23 @@ def create_app():
     print(f"MONGO_URI: {os.getenv('MONGO_URI')}")
     print(f"MONGO_DBNAME: {os.getenv('MONGO_DBNAME')}")
 
+    mongo_uri, mongo_dbname = mongo_settings()
+    connection = pymongo.MongoClient(mongo_uri)
+    db = connection[mongo_dbname]
+
+    init_http_cache(app)
+    register_routes(app, db)
+    init_profiling(app)
+
+    gc_interval = float(os.getenv("UPLOAD_GC_INTERVAL", "0"))
+    if gc_interval > 0:
+        start_sweeper(db, gc_interval, **options_from_env())
+
+    return app
+
+
+def mongo_settings():
+    """Reads the MongoDB URI and database name from the environment."""
     mongo_uri = os.getenv("MONGO_URI")
     mongo_dbname = os.getenv("MONGO_DBNAME")
 
@@ -42,13 +122,7 @@ def create_app():
         raise ValueError("MONGO_URI is not set in the environment variables.")
     if not mongo_dbname:
         raise ValueError("MONGO_DBNAME is not set in the environment variables.")
-
-    connection = pymongo.MongoClient(mongo_uri)
-    db = connection[mongo_dbname]
-
-    register_routes(app, db)
-
-    return app
+    return mongo_uri, mongo_dbname
 
 
 def register_routes(app, db):
@@ -56,10 +130,13 @@ def register_routes(app, db):
     register_home_routes(app, db)
     register_auth_routes(app, db)
     register_entry_routes(app, db)
+    register_search_routes(app, db)
 
 
 def register_home_routes(app, db):
     """Register routes for the home page and history."""
+    feed = PredictionFeed(db.predictions)
+    app.extensions["prediction_feed"] = feed
 
     @app.route("/")
     def home():
@@ -79,8 +156,60 @@ def register_home_routes(app, db):
         username = session.get("username")
         if not username:
             return redirect(url_for("login"))
-        user_results = list(db.predictions.find({"user": username}))
-        return render_template("history.html", results=user_results)
+        # Read before the predictions, so the fragment is never newer than it
+        version = predictions_version(db, username)
+        fragment = fragment_cache().get(("history", username), version)
+        if fragment is None:
+            user_results = list(db.predictions.find({"user": username}))
+            fragment = Fragment(
+                render_template("_history.html", results=user_results),
+                datetime.now(timezone.utc),
+                version,
+            )
+            fragment_cache().put(("history", username), username, fragment)
+        return conditional_page(
+            "history.html", fragment, stream_url=url_for("history_stream")
+        )
+
+    @app.route("/history/export.<fmt>")
+    def export_history(fmt):
+        """Stream the user's history as NDJSON, CSV or a ZIP with the photos."""
+        username = session.get("username")
+        if not username:
+            return redirect(url_for("login"))
+        if fmt not in EXPORT_FORMATS:
+            return handle_error("Unknown export format", 404)
+        if fmt == "zip":
+            members = archive_members(
+                export_cursor(db.predictions, username, EXPORT_ZIP_MAX_ROWS + 1),
+                UPLOADS_DIR,
+            )
+            if members is None:
+                return handle_error(ZIP_TOO_LARGE, 413)
+            return zip_response(ZipExport(members))
+        documents = export_cursor(db.predictions, username)
+        rows = (export_row(document) for document in documents)
+        lines = csv_lines(rows) if fmt == "csv" else map(ndjson_line, rows)
+        return Response(
+            coalesce(lines),
+            mimetype=EXPORT_FORMATS[fmt],
+            headers=export_headers(fmt),
+        )
+
+    @app.route("/history/stream")
+    def history_stream():
+        """Stream new and deleted predictions of the user as server-sent events."""
+        username = session.get("username")
+        if not username:
+            return handle_error("Not logged in", 401)
+        if not feed.accepting():
+            # Each stream holds a worker thread; the page works without it
+            return handle_error("Too many live streams", 503)
+        return Response(
+            feed.stream(username),
+            mimetype="text/event-stream",
+            headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+        )
 
     @app.route("/delete/<entry_id>", methods=["POST"])
     def delete_entry(entry_id):
@@ -88,21 +217,63 @@ def register_home_routes(app, db):
         username = session.get("username")
         if not username:
             return redirect(url_for("login"))
-        db.predictions.delete_one({"_id": ObjectId(entry_id), "user": username})
+        begin_change(db, username)
+        deleted = None
+        try:
+            deleted = db.predictions.find_one_and_delete(
+                {"_id": ObjectId(entry_id), "user": username}
+            )
+        finally:
+            if deleted:
+                forget_prediction(db, deleted)
+            else:
+                cancel_change(db, username)
+        if deleted:
+            fragment_cache().invalidate_user(username)
         flash("Entry deleted successfully", "success")
         return redirect(url_for("history"))
 
+    @app.route("/stats")
+    def stats():
+        username = session.get("username")
+        if not username:
+            return redirect(url_for("login"))
+        return render_template(
+            "stats.html", user=username, stats=get_user_stats(db, username)
+        )
+
+    @app.route("/api/stats")
+    def stats_api():
+        username = session.get("username")
+        if not username:
+            return handle_error("Not logged in", 401)
+        return jsonify(get_user_stats(db, username))
+
 
 def register_auth_routes(app, db):
     """Register authentication-related routes."""
+    guard = AuthGuard.from_env()
 
     @app.route("/login", methods=["GET", "POST"])
     def login():
         if request.method == "POST":
             username = request.form["username"]
             password = request.form["password"]
+            if not guard.allow(username, request.remote_addr):
+                flash("Too many attempts, please try again later.", "error")
+                return render_template("login.html"), 429
             user = db.users.find_one({"username": username})
-            if not user or not check_password_hash(user["password"], password):
+            try:
+                valid = user and guard.verify_password(user["password"], password)
+                if valid and guard.needs_rehash(user["password"]):
+                    db.users.update_one(
+                        {"_id": user["_id"]},
+                        {"$set": {"password": guard.hash_password(password)}},
+                    )
+            except AuthBusy:
+                flash("The server is busy, please try again.", "error")
+                return render_template("login.html"), 503
+            if not valid:
                 flash("Invalid username or password!", "error")
                 return render_template("login.html")
             session["username"] = username
@@ -119,10 +290,17 @@ def register_auth_routes(app, db):
         if request.method == "POST":
             username = request.form["username"]
             password = request.form["password"]
+            if not guard.allow(username, request.remote_addr):
+                flash("Too many attempts, please try again later.", "error")
+                return render_template("signup.html"), 429
             if db.users.find_one({"username": username}):
                 flash("Username already exists", "error")
                 return render_template("signup.html")
-            hashed_password = generate_password_hash(password)
+            try:
+                hashed_password = guard.hash_password(password)
+            except AuthBusy:
+                flash("The server is busy, please try again.", "error")
+                return render_template("signup.html"), 503
             db.users.insert_one({"username": username, "password": hashed_password})
             session["username"] = username
             return redirect(url_for("home"))
@@ -131,17 +309,32 @@ def register_auth_routes(app, db):
 
 def register_entry_routes(app, db):
     """Register routes for entry management."""
+    limiter = UploadLimiter.from_env(db.upload_counters)
+    if limiter.quota:
+        db.upload_usage.create_index("expires_at", expireAfterSeconds=0)
 
     @app.route("/upload", methods=["GET", "POST"])
     def upload():
         if request.method == "POST":
+            username = session.get("username")
             photo_data = request.form.get("photo")
             if not photo_data:
                 return handle_error("No photo data received", 400)
             try:
-                photo_binary = decode_photo(photo_data)
-                filepath, filename = save_photo(photo_binary)
+                limiter.check(username, request.remote_addr)
+                with profiled_section("decode_photo"):
+                    photo_binary = decode_photo(photo_data)
+                with profiled_section("save_photo"):
+                    normalized = normalize_photo(photo_binary)
+                    size = stored_size(normalized, photo_binary)
+                    if limiter.quota and username:
+                        check_storage(db, limiter.quota, username, size)
+                    filepath, filename = save_photo(photo_binary, normalized)
+                if limiter.quota and username:
+                    record_storage(db, limiter.quota, username, size)
                 process_photo(filepath, filename)
+            except UploadRejected as rejected:
+                return make_response(str(rejected), 429, rejected.headers())
             except (
                 ValueError,
                 IOError,
@@ -155,10 +348,26 @@ def register_entry_routes(app, db):
 
     @app.route("/results/<filename>")
     def results(filename):
-        result = db.predictions.find_one({"photo": filename})
-        if result:
-            return render_template("results.html", result=result)
-        return handle_error("Result not found", 404)
+        cache = fragment_cache()
+        key = ("results", filename)
+        fragment = cache.get(key, predictions_version(db, cache.owner(key)))
+        if fragment is None:
+            result = db.predictions.find_one({"photo": filename})
+            version = predictions_version(db, result.get("user")) if result else None
+            # Predictions are never modified, so a result page changes only
+            # when it is deleted; one deleted before the version was read
+            # must not be cached under it
+            if not result or (
+                version is not None
+                and not db.predictions.count_documents({"_id": result["_id"]}, limit=1)
+            ):
+                return handle_error("Result not found", 404)
+            created = result["_id"].generation_time if "_id" in result else None
+            fragment = Fragment(
+                render_template("_result.html", result=result), created, version
+            )
+            cache.put(key, result.get("user"), fragment)
+        return conditional_page("results.html", fragment)
 
     @app.route("/new_entry", methods=["GET", "POST"])
     def new_entry():
@@ -182,6 +391,32 @@ def register_entry_routes(app, db):
         )
 
 
+def register_search_routes(app, db):
+    """Register the search page and API."""
+    indexes = SearchIndexes()
+
+    def search_results():
+        if indexes.due():
+            indexes.update(ensure_search_indexes(db))
+        query, page = search_params(request.args)
+        return search_entries(
+            db, session["username"], query, page, text_ready=indexes.ready
+        )
+
+    @app.route("/search")
+    def search():
+        username = session.get("username")
+        if not username:
+            return redirect(url_for("login"))
+        return render_template("search.html", user=username, search=search_results())
+
+    @app.route("/api/search")
+    def search_api():
+        if not session.get("username"):
+            return handle_error("Not logged in", 401)
+        return jsonify(search_results())
+
+
 def decode_photo(photo_data):
     """Decodes base64 photo data."""
     try:
@@ -191,42 +426,166 @@ def decode_photo(photo_data):
         raise ValueError("Invalid photo data") from error
 
 
-def save_photo(photo_binary):
-    """Saves the decoded photo to the uploads directory."""
-    uploads_dir = os.path.join("static", "uploads")
+def normalize_photo(photo_binary):
+    """
+    Re-encodes a photo as a size-bounded derivative.
+
+    The real format is sniffed from the bytes, JPEGs are decoded at reduced
+    scale with draft mode, EXIF orientation is applied and the image is
+    downsized to UPLOAD_MAX_EDGE before being encoded as UPLOAD_FORMAT.
+
+    Returns:
+        tuple: (derivative bytes, derivative extension, original extension)
+    """
+    try:
+        image = Image.open(io.BytesIO(photo_binary))
+        original_format = image.format
+        if original_format == "JPEG":
+            image.draft("RGB", (UPLOAD_MAX_EDGE, UPLOAD_MAX_EDGE))
+        image = ImageOps.exif_transpose(image)
+        image.thumbnail((UPLOAD_MAX_EDGE, UPLOAD_MAX_EDGE))
+    except (UnidentifiedImageError, Image.DecompressionBombError, OSError) as error:
+        raise ValueError("Invalid photo data") from error
+
+    if UPLOAD_FORMAT == "JPEG" and image.mode != "RGB":
+        image = image.convert("RGB")
+    output = io.BytesIO()
+    image.save(output, format=UPLOAD_FORMAT, quality=UPLOAD_QUALITY)
+    return (
+        output.getvalue(),
+        IMAGE_EXTENSIONS.get(UPLOAD_FORMAT, UPLOAD_FORMAT.lower()),
+        IMAGE_EXTENSIONS.get(original_format, "bin"),
+    )
+
+
+def save_photo(photo_binary, normalized=None, uploads_dir=UPLOADS_DIR):
+    """
+    Normalizes the decoded photo and saves it to the uploads directory.
+
+    Args:
+        photo_binary (bytes): The decoded upload.
+        normalized (tuple): normalize_photo(photo_binary), if already done.
+        uploads_dir (str): Directory the photo is saved in.
+    """
+    if normalized is None:
+        normalized = normalize_photo(photo_binary)
+    derivative, extension, original_extension = normalized
     os.makedirs(uploads_dir, exist_ok=True)
-    filename = f"{uuid.uuid4()}.png"
+    photo_id = uuid.uuid4()
+    filename = f"{photo_id}.{extension}"
     filepath = os.path.join(uploads_dir, filename)
 
     with open(filepath, "wb") as file_handle:
-        file_handle.write(photo_binary)
-    print(f"File saved successfully: {filepath}")
+        file_handle.write(derivative)
+    print(
+        f"File saved successfully: {filepath} "
+        f"({len(photo_binary)} -> {len(derivative)} bytes)"
+    )
+
+    if UPLOAD_KEEP_ORIGINAL:
+        original_path = os.path.join(
+            uploads_dir, f"{photo_id}.original.{original_extension}"
+        )
+        with open(original_path, "wb") as file_handle:
+            file_handle.write(photo_binary)
 
     return filepath, filename
 
 
+def stored_size(normalized, photo_binary):
+    """Returns the bytes save_photo writes for a normalized upload."""
+    size = len(normalized[0])
+    return size + len(photo_binary) if UPLOAD_KEEP_ORIGINAL else size
+
+
+def check_storage(db, quota, username, size):
+    """Checks that size more bytes fit in the user's storage quota for today."""
+    day = usage_day()
+    used = quota.cached(username, day)
+    if used is None:
+        document = db.upload_usage.find_one({"_id": usage_id(username, day)})
+        used = document["bytes"] if document else 0
+        quota.remember(username, day, used)
+    quota.check(used, size)
+
+
+def record_storage(db, quota, username, size):
+    """Adds the bytes of a stored upload to the user's usage for today."""
+    day = usage_day()
+    document = db.upload_usage.find_one_and_update(**usage_upsert(username, day, size))
+    quota.remember(username, day, document["bytes"])
+
+
 def process_photo(filepath, filename):
     """Sends the photo to the ML client and saves the prediction to MongoDB."""
     ml_client_url = "http://ml-client:3001/predict"
-    with open(filepath, "rb") as file_handle:
-        files = {"image": (filename, file_handle, "image/png")}
+    headers = {DEADLINE_HEADER: f"{time.time() + ML_TIMEOUT:.3f}"}
+    if ML_TRANSPORT == "shared":
         response = requests.post(
-            ml_client_url, files=files, timeout=10
-        )  # Added timeout
-        response.raise_for_status()
-        result = response.json()
-        plant_name = result.get("plant_name", "Unknown")
-        res = {
-            "photo": filename,
-            "filepath": filepath,
-            "plant_name": plant_name,
-            "user": session.get("username"),
-        }
-
-        # Save the result to the database
-        db = get_db()
+            ml_client_url,
+            json=photo_reference(filepath, filename),
+            headers=headers,
+            timeout=ML_TIMEOUT,
+        )
+    else:
+        content_type = mimetypes.guess_type(filename)[0] or "application/octet-stream"
+        with open(filepath, "rb") as file_handle:
+            files = {"image": (filename, file_handle, content_type)}
+            response = requests.post(
+                ml_client_url, files=files, headers=headers, timeout=ML_TIMEOUT
+            )
+    response.raise_for_status()
+    result = response.json()
+    plant_name = result.get("plant_name", "Unknown")
+    res = {
+        "photo": filename,
+        "filepath": filepath,
+        "plant_name": plant_name,
+        "user": session.get("username"),
+    }
+
+    # Save the result to the database
+    db = get_db()
+    begin_change(db, res["user"])
+    try:
         db.predictions.insert_one(res)
-        print(f"Inserted prediction into MongoDB: {res}")
+    except pymongo.errors.PyMongoError:
+        cancel_change(db, res["user"])
+        raise
+    print(f"Inserted prediction into MongoDB: {res}")
+    record_prediction(db, res)
+    fragment_cache().invalidate_user(res["user"])
+
+
+def photo_reference(filepath, filename):
+    """Builds the shared-volume reference to a saved photo for the ML client."""
+    return {"path": filename, "size": os.path.getsize(filepath)}
+
+
+def zip_response(archive):
+    """Streams a ZIP export, or the part of it the Range header asks for."""
+    if archive.too_large:
+        return handle_error(ZIP_TOO_LARGE, 413)
+    span = byte_range(archive, request.range, request.if_range)
+    if span is None:
+        response = handle_error("Requested range not satisfiable", 416)
+        response.headers["Content-Range"] = f"bytes */{archive.length}"
+        return response
+    start, stop = span
+    response = Response(
+        archive.chunks(start, stop),
+        status=206 if stop - start < archive.length else 200,
+        mimetype=EXPORT_FORMATS["zip"],
+        headers={
+            **export_headers("zip"),
+            "Accept-Ranges": "bytes",
+        },
+    )
+    response.set_etag(archive.etag)
+    response.content_length = stop - start
+    if response.status_code == 206:
+        response.headers["Content-Range"] = f"bytes {start}-{stop - 1}/{archive.length}"
+    return response
 
 
 def handle_error(message, status_code):
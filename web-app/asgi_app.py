@@ -0,0 +1,700 @@
+"""
+Async (ASGI) serving mode for the Plant Identifier web app.
+
+Registers the same routes as app.py on Quart, using pymongo's
+AsyncMongoClient for MongoDB and an httpx.AsyncClient for the ML client, so
+a request that is waiting on either does not hold a thread. CPU-bound work
+(image normalization, password hashing) runs in worker threads.
+
+Background work shared with the Flask app, i.e. the live history feed, the
+cross-replica upload counter and the upload garbage collector, runs in
+threads with a blocking MongoClient to the same database.
+
+Run with:
+    hypercorn "asgi_app:create_async_app()" --bind 0.0.0.0:5000
+"""
+
+import asyncio
+import mimetypes
+import os
+import time
+from datetime import datetime, timezone
+
+import httpx
+import pymongo
+from bson import ObjectId
+from markupsafe import Markup
+from quart import (
+    Quart,
+    Response,
+    flash,
+    g,
+    jsonify,
+    make_response,
+    redirect,
+    render_template,
+    request,
+    session,
+    url_for,
+)
+from app import (
+    DEADLINE_HEADER,
+    ML_TIMEOUT,
+    ML_TRANSPORT,
+    decode_photo,
+    mongo_settings,
+    normalize_photo,
+    photo_reference,
+    save_photo,
+    stored_size,
+)
+from auth_guard import AuthBusy, AuthGuard
+from http_cache import Fragment, init_http_cache, revalidated
+from live_updates import PredictionFeed
+from request_profiling import init_profiling
+from history_export import (
+    EXPORT_CHUNK_SIZE,
+    EXPORT_COLUMNS,
+    EXPORT_BATCH_SIZE,
+    EXPORT_FORMATS,
+    EXPORT_ZIP_MAX_ROWS,
+    ZIP_TOO_LARGE,
+    ArchivePlan,
+    ZipExport,
+    byte_range,
+    csv_line,
+    export_cursor,
+    export_headers,
+    export_row,
+    ndjson_line,
+)
+from search import (
+    TEXT_INDEXES,
+    SearchIndexes,
+    clamp_page,
+    clean_query,
+    SEARCH_PAGE_SIZE,
+    match_limit,
+    results_page,
+    search_params,
+    search_query,
+    text_index,
+)
+from upload_gc import UPLOADS_DIR, options_from_env, start_sweeper
+from upload_limits import (
+    UploadLimiter,
+    UploadRejected,
+    usage_day,
+    usage_id,
+    usage_upsert,
+)
+from user_stats import (
+    REBUILD_ATTEMPTS,
+    REBUILD_RETRY_DELAY,
+    can_rebuild,
+    change_cancelled,
+    change_started,
+    is_built,
+    prediction_increment,
+    present_stats,
+    rebuild_pipeline,
+    summary_from_facets,
+)
+
+ML_CLIENT_URL = "http://ml-client:3001/predict"
+
+
+def create_async_app(db=None, http_client=None, sync_db=None):
+    """
+    Initializes and configures the Quart app.
+
+    Args:
+        db: Async database handle; created from MONGO_URI/MONGO_DBNAME if None.
+        http_client (httpx.AsyncClient): Client for the ML client; created
+            when the app starts serving if None.
+        sync_db: Blocking database handle for the background threads;
+            created from MONGO_URI/MONGO_DBNAME if None.
+
+    Returns:
+        Quart: The configured app.
+    """
+    app = Quart(__name__)
+    app.config["MAX_CONTENT_LENGTH"] = 5 * 1024 * 1024  # 5 MB limit
+    app.secret_key = os.getenv("SECRET_KEY")
+
+    if db is None or sync_db is None:
+        mongo_uri, mongo_dbname = mongo_settings()
+        if db is None:
+            db = pymongo.AsyncMongoClient(mongo_uri)[mongo_dbname]
+        if sync_db is None:
+            sync_db = pymongo.MongoClient(mongo_uri)[mongo_dbname]
+
+    clients = {"http": http_client}
+
+    @app.before_serving
+    async def open_http_client():
+        if clients["http"] is None:
+            clients["http"] = httpx.AsyncClient(
+                timeout=ML_TIMEOUT, limits=httpx.Limits(max_connections=None)
+            )
+
+    @app.after_serving
+    async def close_http_client():
+        if http_client is None and clients["http"] is not None:
+            await clients["http"].aclose()
+
+    cache = init_http_cache(app, request, asynchronous=True)
+    register_async_routes(app, db, sync_db, clients, cache)
+    init_profiling(app, request, g, asynchronous=True)
+
+    gc_interval = float(os.getenv("UPLOAD_GC_INTERVAL", "0"))
+    if gc_interval > 0:
+        start_sweeper(sync_db, gc_interval, **options_from_env())
+
+    return app
+
+
+def register_async_routes(app, db, sync_db, clients, cache):
+    """Registers all the routes for the Quart app."""
+    register_home_routes(app, db, sync_db, cache)
+    register_auth_routes(app, db)
+    register_entry_routes(app, db, sync_db, clients, cache)
+    register_search_routes(app, db)
+
+
+def register_home_routes(app, db, sync_db, cache):
+    """Register routes for the home page and history."""
+    feed = PredictionFeed(sync_db.predictions)
+    app.extensions["prediction_feed"] = feed
+
+    @app.route("/")
+    async def home():
+        username = session.get("username")
+        if username:
+            user_entries = await db.plants.find({"user": username}).to_list(None)
+            recent_entries = (
+                user_entries[-3:] if len(user_entries) > 3 else user_entries
+            )
+            return await render_template(
+                "home.html", user=username, user_entries=recent_entries
+            )
+        return await render_template("home.html", user=None)
+
+    @app.route("/history")
+    async def history():
+        username = session.get("username")
+        if not username:
+            return redirect(url_for("login"))
+        # Read before the predictions, so the fragment is never newer than it
+        version = await predictions_version(db, username)
+        fragment = cache.get(("history", username), version)
+        if fragment is None:
+            user_results = await db.predictions.find({"user": username}).to_list(None)
+            fragment = Fragment(
+                await render_template("_history.html", results=user_results),
+                datetime.now(timezone.utc),
+                version,
+            )
+            cache.put(("history", username), username, fragment)
+        stream_url = url_for("history_stream")
+        return await conditional_page("history.html", fragment, stream_url=stream_url)
+
+    @app.route("/history/export.<fmt>")
+    async def export_history(fmt):
+        username = session.get("username")
+        if not username:
+            return redirect(url_for("login"))
+        if fmt not in EXPORT_FORMATS:
+            return "Unknown export format", 404
+        if fmt == "zip":
+            return await zip_export(db, username)
+        return Response(
+            export_lines(export_cursor(db.predictions, username), fmt),
+            mimetype=EXPORT_FORMATS[fmt],
+            headers=export_headers(fmt),
+        )
+
+    @app.route("/history/stream")
+    async def history_stream():
+        """Stream new and deleted predictions of the user as server-sent events."""
+        username = session.get("username")
+        if not username:
+            return "Not logged in", 401
+        if not feed.accepting():
+            return "Too many live streams", 503
+        response = Response(
+            feed.stream_async(username),
+            mimetype="text/event-stream",
+            headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+        )
+        response.timeout = None  # Streams stay open while the page is
+        return response
+
+    @app.route("/delete/<entry_id>", methods=["POST"])
+    async def delete_entry(entry_id):
+        """Delete an entry by ID."""
+        username = session.get("username")
+        if not username:
+            return redirect(url_for("login"))
+        await begin_change(db, username)
+        deleted = None
+        try:
+            deleted = await db.predictions.find_one_and_delete(
+                {"_id": ObjectId(entry_id), "user": username}
+            )
+        finally:
+            if deleted:
+                await forget_prediction(db, deleted)
+            else:
+                await cancel_change(db, username)
+        if deleted:
+            cache.invalidate_user(username)
+        await flash("Entry deleted successfully", "success")
+        return redirect(url_for("history"))
+
+    @app.route("/stats")
+    async def stats():
+        username = session.get("username")
+        if not username:
+            return redirect(url_for("login"))
+        return await render_template(
+            "stats.html", user=username, stats=await get_user_stats(db, username)
+        )
+
+    @app.route("/api/stats")
+    async def stats_api():
+        username = session.get("username")
+        if not username:
+            return "Not logged in", 401
+        return jsonify(await get_user_stats(db, username))
+
+
+def register_auth_routes(app, db):
+    """Register authentication-related routes."""
+    guard = AuthGuard.from_env()
+
+    @app.route("/login", methods=["GET", "POST"])
+    async def login():
+        if request.method == "POST":
+            form = await request.form
+            username = form["username"]
+            password = form["password"]
+            if not guard.allow(username, request.remote_addr):
+                await flash("Too many attempts, please try again later.", "error")
+                return await render_template("login.html"), 429
+            user = await db.users.find_one({"username": username})
+            try:
+                valid = user and await asyncio.to_thread(
+                    guard.verify_password, user["password"], password
+                )
+                if valid and guard.needs_rehash(user["password"]):
+                    rehashed = await asyncio.to_thread(guard.hash_password, password)
+                    await db.users.update_one(
+                        {"_id": user["_id"]}, {"$set": {"password": rehashed}}
+                    )
+            except AuthBusy:
+                await flash("The server is busy, please try again.", "error")
+                return await render_template("login.html"), 503
+            if not valid:
+                await flash("Invalid username or password!", "error")
+                return await render_template("login.html")
+            session["username"] = username
+            return redirect(url_for("home"))
+        return await render_template("login.html")
+
+    @app.route("/logout")
+    async def logout():
+        session.pop("username", None)
+        return redirect(url_for("home"))
+
+    @app.route("/signup", methods=["GET", "POST"])
+    async def signup():
+        if request.method == "POST":
+            form = await request.form
+            username = form["username"]
+            password = form["password"]
+            if not guard.allow(username, request.remote_addr):
+                await flash("Too many attempts, please try again later.", "error")
+                return await render_template("signup.html"), 429
+            if await db.users.find_one({"username": username}):
+                await flash("Username already exists", "error")
+                return await render_template("signup.html")
+            try:
+                hashed_password = await asyncio.to_thread(guard.hash_password, password)
+            except AuthBusy:
+                await flash("The server is busy, please try again.", "error")
+                return await render_template("signup.html"), 503
+            await db.users.insert_one(
+                {"username": username, "password": hashed_password}
+            )
+            session["username"] = username
+            return redirect(url_for("home"))
+        return await render_template("signup.html")
+
+
+def register_entry_routes(app, db, sync_db, clients, cache):
+    """Register routes for entry management."""
+    # The cross-replica counter syncs in a thread with the blocking client
+    limiter = UploadLimiter.from_env(sync_db.upload_counters)
+    if limiter.quota:
+        sync_db.upload_usage.create_index("expires_at", expireAfterSeconds=0)
+
+    @app.route("/upload", methods=["GET", "POST"])
+    async def upload():
+        if request.method == "POST":
+            username = session.get("username")
+            form = await request.form
+            photo_data = form.get("photo")
+            if not photo_data:
+                return "No photo data received", 400
+            try:
+                limiter.check(username, request.remote_addr)
+                photo_binary = decode_photo(photo_data)
+                normalized = await asyncio.to_thread(normalize_photo, photo_binary)
+                size = stored_size(normalized, photo_binary)
+                if limiter.quota and username:
+                    await check_storage(db, limiter.quota, username, size)
+                filepath, filename = await asyncio.to_thread(
+                    save_photo, photo_binary, normalized
+                )
+                if limiter.quota and username:
+                    await record_storage(db, limiter.quota, username, size)
+                await process_photo(db, clients["http"], filepath, filename, username)
+                cache.invalidate_user(username)
+            except UploadRejected as rejected:
+                return str(rejected), 429, rejected.headers()
+            except (
+                ValueError,
+                IOError,
+                httpx.HTTPError,
+                pymongo.errors.PyMongoError,
+            ) as error:
+                print(f"Error processing file: {error}")
+                return "Error processing the photo", 500
+            return redirect(url_for("results", filename=filename))
+        return await render_template("upload.html")
+
+    @app.route("/results/<filename>")
+    async def results(filename):
+        key = ("results", filename)
+        fragment = cache.get(key, await predictions_version(db, cache.owner(key)))
+        if fragment is None:
+            result = await db.predictions.find_one({"photo": filename})
+            owner = result.get("user") if result else None
+            version = await predictions_version(db, owner)
+            # A result deleted before the version was read must not be cached
+            if not result or (
+                version is not None
+                and not await db.predictions.count_documents(
+                    {"_id": result["_id"]}, limit=1
+                )
+            ):
+                return "Result not found", 404
+            created = result["_id"].generation_time if "_id" in result else None
+            fragment = Fragment(
+                await render_template("_result.html", result=result), created, version
+            )
+            cache.put(key, owner, fragment)
+        return await conditional_page("results.html", fragment)
+
+    @app.route("/new_entry", methods=["GET", "POST"])
+    async def new_entry():
+        new_entry_id = request.args.get("new_entry_id")
+        if not new_entry_id:
+            return "No entry ID provided", 400
+        entry_id = ObjectId(new_entry_id)
+        if request.method == "POST":
+            form = await request.form
+            await db.plants.update_one(
+                {"_id": entry_id}, {"$set": {"instructions": form["instructions"]}}
+            )
+            return redirect(url_for("home", user=session.get("username")))
+        document = await db.plants.find_one({"_id": entry_id})
+        if not document:
+            return "Entry not found", 404
+        return await render_template(
+            "new-entry.html",
+            photo=document.get("photo"),
+            name=document.get("name"),
+            new_entry_id=new_entry_id,
+        )
+
+
+def register_search_routes(app, db):
+    """Register the search page and API."""
+    indexes = SearchIndexes()
+
+    async def search_results():
+        if indexes.due():
+            indexes.update(await ensure_search_indexes(db))
+        query, page = search_params(request.args)
+        return await search_entries(
+            db, session["username"], query, page, text_ready=indexes.ready
+        )
+
+    @app.route("/search")
+    async def search():
+        username = session.get("username")
+        if not username:
+            return redirect(url_for("login"))
+        return await render_template(
+            "search.html", user=username, search=await search_results()
+        )
+
+    @app.route("/api/search")
+    async def search_api():
+        if not session.get("username"):
+            return "Not logged in", 401
+        return jsonify(await search_results())
+
+
+async def ensure_search_indexes(db):
+    """Creates the per-user text indexes; returns the collections that have one."""
+    ready = set()
+    for collection in TEXT_INDEXES:
+        keys, options = text_index(collection)
+        try:
+            await getattr(db, collection).create_index(keys, **options)
+            ready.add(collection)
+        except pymongo.errors.OperationFailure as error:
+            print(f"Could not create the search index on {collection}: {error}")
+    return ready
+
+
+async def search_entries(db, username, query, page=1, text_ready=None):
+    """Searches a user's plant entries and identifications."""
+    text_ready = TEXT_INDEXES if text_ready is None else text_ready
+    query = clean_query(query)
+    page = clamp_page(page)
+    if not query:
+        return results_page({}, query, page)
+    hits = {}
+    for collection in TEXT_INDEXES:
+        text = collection in text_ready
+        find_filter, projection, sort = search_query(collection, username, query, text)
+        cursor = getattr(db, collection).find(find_filter, projection).sort(sort)
+        hits[collection] = await cursor.to_list(
+            match_limit(page, SEARCH_PAGE_SIZE, text)
+        )
+    return results_page(hits, query, page, text_ready=text_ready)
+
+
+async def conditional_page(template, fragment, **context):
+    """Render a page around a fragment and make it a conditional response."""
+    response = revalidated(
+        await make_response(
+            await render_template(template, fragment=Markup(fragment.html), **context)
+        ),
+        fragment,
+    )
+    await response.add_etag()
+    return await response.make_conditional(request)
+
+
+async def export_lines(cursor, fmt):
+    """Stream the rows of an export cursor as NDJSON or CSV in chunks."""
+    chunk = [csv_line(EXPORT_COLUMNS)] if fmt == "csv" else []
+    length = 0
+    async for document in cursor:
+        row = export_row(document)
+        line = (
+            csv_line([row[column] for column in EXPORT_COLUMNS])
+            if fmt == "csv"
+            else ndjson_line(row)
+        )
+        chunk.append(line)
+        length += len(line)
+        if length >= EXPORT_CHUNK_SIZE:
+            yield "".join(chunk)
+            chunk, length = [], 0
+    if chunk:
+        yield "".join(chunk)
+
+
+async def zip_export(db, username, max_rows=EXPORT_ZIP_MAX_ROWS):
+    """Plans a user's ZIP export batch by batch from the history cursor."""
+    plan = ArchivePlan(UPLOADS_DIR, max_rows)
+    cursor = export_cursor(db.predictions, username, max_rows + 1)
+    batch = []
+    async for document in cursor:
+        batch.append(document)
+        if len(batch) >= EXPORT_BATCH_SIZE:
+            # Planning reads the photo sizes from disk
+            await asyncio.to_thread(plan.add, batch)
+            batch = []
+    await asyncio.to_thread(plan.add, batch)
+    if plan.too_large:
+        return ZIP_TOO_LARGE, 413
+    return await zip_response(ZipExport(plan.members()))
+
+
+async def zip_response(archive):
+    """Streams a ZIP export, or the part of it the Range header asks for."""
+    if archive.too_large:
+        return ZIP_TOO_LARGE, 413
+    span = byte_range(archive, request.range, request.if_range)
+    if span is None:
+        return (
+            "Requested range not satisfiable",
+            416,
+            {"Content-Range": f"bytes */{archive.length}"},
+        )
+    start, stop = span
+    chunks = archive.chunks(start, stop)
+
+    async def body():
+        # The archive reads photos from disk, so produce it in a worker thread
+        while True:
+            chunk = await asyncio.to_thread(next, chunks, None)
+            if chunk is None:
+                return
+            yield chunk
+
+    headers = {
+        **export_headers("zip"),
+        "Accept-Ranges": "bytes",
+        "Content-Length": str(stop - start),
+    }
+    partial = stop - start < archive.length
+    if partial:
+        headers["Content-Range"] = f"bytes {start}-{stop - 1}/{archive.length}"
+    response = Response(
+        body(), status=206 if partial else 200, mimetype=EXPORT_FORMATS["zip"]
+    )
+    response.headers.update(headers)
+    response.set_etag(archive.etag)
+    return response
+
+
+async def check_storage(db, quota, username, size):
+    """Checks that size more bytes fit in the user's storage quota for today."""
+    day = usage_day()
+    used = quota.cached(username, day)
+    if used is None:
+        document = await db.upload_usage.find_one({"_id": usage_id(username, day)})
+        used = document["bytes"] if document else 0
+        quota.remember(username, day, used)
+    quota.check(used, size)
+
+
+async def record_storage(db, quota, username, size):
+    """Adds the bytes of a stored upload to the user's usage for today."""
+    day = usage_day()
+    document = await db.upload_usage.find_one_and_update(
+        **usage_upsert(username, day, size)
+    )
+    quota.remember(username, day, document["bytes"])
+
+
+async def process_photo(db, http_client, filepath, filename, username):
+    """Sends the photo to the ML client and saves the prediction to MongoDB."""
+    headers = {DEADLINE_HEADER: f"{time.time() + ML_TIMEOUT:.3f}"}
+    if ML_TRANSPORT == "shared":
+        response = await http_client.post(
+            ML_CLIENT_URL, json=photo_reference(filepath, filename), headers=headers
+        )
+    else:
+        content_type = mimetypes.guess_type(filename)[0] or "application/octet-stream"
+        photo = await asyncio.to_thread(read_file, filepath)
+        response = await http_client.post(
+            ML_CLIENT_URL,
+            files={"image": (filename, photo, content_type)},
+            headers=headers,
+        )
+    response.raise_for_status()
+    plant_name = response.json().get("plant_name", "Unknown")
+    res = {
+        "photo": filename,
+        "filepath": filepath,
+        "plant_name": plant_name,
+        "user": username,
+    }
+    await begin_change(db, username)
+    try:
+        await db.predictions.insert_one(res)
+    except pymongo.errors.PyMongoError:
+        await cancel_change(db, username)
+        raise
+    print(f"Inserted prediction into MongoDB: {res}")
+    await record_prediction(db, res)
+
+
+async def predictions_version(db, username):
+    """Reads the generation of a user's predictions, bumped by every change."""
+    if username is None:
+        return None
+    summary = await db.user_stats.find_one({"_id": username}, {"version": 1})
+    return summary.get("version", 0) if summary else 0
+
+
+async def begin_change(db, username):
+    """Marks a change of the user's predictions as pending, before writing it."""
+    if username is not None:
+        await db.user_stats.update_one(**change_started(username))
+
+
+async def cancel_change(db, username):
+    """Ends a pending change whose write to db.predictions did not happen."""
+    if username is not None:
+        await db.user_stats.update_one({"_id": username}, change_cancelled())
+
+
+async def record_prediction(db, prediction):
+    """Counts an inserted prediction document in its user's summary."""
+    if prediction.get("user") is not None:
+        await db.user_stats.update_one(
+            {"_id": prediction["user"]}, prediction_increment(prediction)
+        )
+
+
+async def forget_prediction(db, prediction):
+    """Removes a deleted prediction document from its user's summary."""
+    if prediction.get("user") is not None:
+        await db.user_stats.update_one(
+            {"_id": prediction["user"]}, prediction_increment(prediction, step=-1)
+        )
+
+
+async def store_summary(db, current, summary):
+    """Stores a rebuilt summary unless the user's predictions changed meanwhile."""
+    if current is None:
+        try:
+            await db.user_stats.insert_one(summary)
+        except pymongo.errors.DuplicateKeyError:
+            return False
+        return True
+    result = await db.user_stats.replace_one(
+        {"_id": summary["_id"], "version": current.get("version", 0)}, summary
+    )
+    return result.matched_count == 1
+
+
+async def rebuild_user_stats(db, username):
+    """Recomputes a user's summary document from db.predictions."""
+    for attempt in range(REBUILD_ATTEMPTS):
+        current = await db.user_stats.find_one({"_id": username})
+        if is_built(current):
+            return current
+        cursor = await db.predictions.aggregate(rebuild_pipeline(username))
+        facets = await cursor.to_list(1)
+        version = current.get("version", 0) if current else 0
+        summary = summary_from_facets(username, facets[0] if facets else {}, version)
+        if can_rebuild(current) and await store_summary(db, current, summary):
+            return summary
+        if attempt + 1 < REBUILD_ATTEMPTS:
+            await asyncio.sleep(REBUILD_RETRY_DELAY)
+    return summary
+
+
+async def get_user_stats(db, username):
+    """Reads a user's stats, rebuilding the summary if it is not built yet."""
+    summary = await db.user_stats.find_one({"_id": username})
+    if not is_built(summary):
+        summary = await rebuild_user_stats(db, username)
+    return present_stats(summary)
+
+
+def read_file(filepath):
+    """Reads a whole file as bytes."""
+    with open(filepath, "rb") as file_handle:
+        return file_handle.read()
@@ -0,0 +1,105 @@
+"""
+Bounded-cost password hashing and login throttling.
+
+The hash algorithm and cost come from PASSWORD_HASH_METHOD (any werkzeug
+method string, e.g. "scrypt:32768:8:1" or "pbkdf2:sha256:600000"); stored
+hashes made with another method are upgraded on the next successful login.
+Login and signup attempts are throttled per username and per client IP with
+token buckets before any hashing happens, and hashing can be confined to a
+small worker pool (AUTH_HASH_WORKERS) so a burst of attempts cannot occupy
+every request thread.
+"""
+
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from werkzeug.security import check_password_hash, generate_password_hash
+
+from rate_limit import TokenBucket
+
+DEFAULT_HASH_METHOD = "scrypt:32768:8:1"
+
+
+class AuthBusy(Exception):
+    """Raised when the hashing pool is saturated."""
+
+
+class AuthGuard:
+    """Hash policy, attempt throttling and the hashing worker pool."""
+
+    def __init__(self, method=DEFAULT_HASH_METHOD, workers=0, queue=16, limits=None):
+        """
+        Args:
+            method (str): werkzeug password hash method.
+            workers (int): Hashing threads; 0 hashes on the request thread.
+            queue (int): Hashes allowed to wait for a worker.
+            limits (dict): (rate per second, burst) for "user" and "ip".
+        """
+        limits = {"user": (0.2, 5), "ip": (2.0, 50), **(limits or {})}
+        # Hashing an empty password once yields werkzeug's canonical method
+        # string, e.g. "pbkdf2:sha256" -> "pbkdf2:sha256:1000000"
+        self.method = generate_password_hash("", method).split("$", 1)[0]
+        self.user_attempts = TokenBucket(*limits["user"])
+        self.ip_attempts = TokenBucket(*limits["ip"])
+        self.executor = (
+            ThreadPoolExecutor(max_workers=workers, thread_name_prefix="auth-hash")
+            if workers > 0
+            else None
+        )
+        self.slots = threading.BoundedSemaphore(workers + queue) if workers else None
+
+    @classmethod
+    def from_env(cls):
+        """Build an AuthGuard from the AUTH_* and PASSWORD_HASH_METHOD variables."""
+        return cls(
+            method=os.getenv("PASSWORD_HASH_METHOD", DEFAULT_HASH_METHOD),
+            workers=int(os.getenv("AUTH_HASH_WORKERS", "0")),
+            queue=int(os.getenv("AUTH_HASH_QUEUE", "16")),
+            limits={
+                "user": (
+                    float(os.getenv("AUTH_USER_RATE", "0.2")),
+                    float(os.getenv("AUTH_USER_BURST", "5")),
+                ),
+                "ip": (
+                    float(os.getenv("AUTH_IP_RATE", "2")),
+                    float(os.getenv("AUTH_IP_BURST", "50")),
+                ),
+            },
+        )
+
+    def allow(self, username, client_ip):
+        """Check the username and client IP buckets; True if both allow it."""
+        return self.ip_attempts.allow(client_ip) and self.user_attempts.allow(username)
+
+    def run(self, func, *args):
+        """
+        Run func in the hashing pool (or inline when there is no pool).
+
+        Raises:
+            AuthBusy: If all workers and queue slots are taken.
+        """
+        if self.executor is None:
+            return func(*args)
+        # pylint: disable-next=consider-using-with
+        if not self.slots.acquire(blocking=False):
+            raise AuthBusy("Password hashing pool is saturated")
+        try:
+            future = self.executor.submit(func, *args)
+        except RuntimeError:
+            self.slots.release()
+            raise
+        future.add_done_callback(lambda _: self.slots.release())
+        return future.result()
+
+    def hash_password(self, password):
+        """Hash a password with the configured method."""
+        return self.run(generate_password_hash, password, self.method)
+
+    def verify_password(self, stored_hash, password):
+        """Check a password against its stored hash."""
+        return self.run(check_password_hash, stored_hash, password)
+
+    def needs_rehash(self, stored_hash):
+        """True if stored_hash was made with a different method or cost."""
+        return stored_hash.split("$", 1)[0] != self.method
@@ -0,0 +1,414 @@
+"""
+Streaming export of a user's prediction history.
+
+The history is read from db.predictions with a batched cursor in _id order
+and streamed as it is read, so exports do not load the whole history:
+
+- NDJSON and CSV hold one row per prediction (id, photo, species, time);
+- ZIP holds the photos under photos/ and the NDJSON rows as
+  history.ndjson. Members are stored uncompressed (the photos are already
+  compressed images) with a fixed layout, so the archive size and every
+  member's offset are known before it is sent. That gives the download a
+  Content-Length and lets an interrupted download resume with a Range
+  request, validated by an ETag. The layout is planned from the cursor
+  batch by batch, keeping a member and a history.ndjson line per
+  prediction, so ZIP exports of more than EXPORT_ZIP_MAX_ROWS predictions
+  are refused rather than planned. The photos are read from disk in
+  chunks while streaming.
+
+The archive has no ZIP64 records, so it is limited to 65535 members and
+4 GiB. The query builders are shared with the async app in asgi_app.py.
+"""
+
+import csv
+import hashlib
+import io
+import json
+import os
+import struct
+import threading
+import zlib
+from collections import OrderedDict, namedtuple
+from datetime import datetime, timezone
+
+EXPORT_BATCH_SIZE = int(os.getenv("EXPORT_BATCH_SIZE", "500"))
+EXPORT_CHUNK_SIZE = 64 * 1024
+
+EXPORT_FORMATS = {
+    "ndjson": "application/x-ndjson",
+    "csv": "text/csv",
+    "zip": "application/zip",
+}
+EXPORT_COLUMNS = ["id", "photo", "plant_name", "created"]
+EXPORT_SORT = [("_id", 1)]
+
+ZIP_MAX_MEMBERS = 0xFFFF
+ZIP_MAX_LENGTH = 0xFFFFFFFF
+
+# Predictions a ZIP export may hold; its plan is kept in memory
+EXPORT_ZIP_MAX_ROWS = min(
+    int(os.getenv("EXPORT_ZIP_MAX_ROWS", "10000")), ZIP_MAX_MEMBERS - 1
+)
+ZIP_TOO_LARGE = "History too large for a ZIP, export it as NDJSON"
+
+# Bit 3: CRC-32 and sizes follow the data; bit 11: UTF-8 names
+ZIP_FLAGS = 0x0808
+LOCAL_HEADER = struct.Struct("<IHHHHHIIIHH")
+DATA_DESCRIPTOR = struct.Struct("<IIII")
+CENTRAL_HEADER = struct.Struct("<IHHHHHHIIIHHHHHII")
+END_RECORD = struct.Struct("<IHHHHIIH")
+
+# A member of an export archive: its content is the file at path, or data
+ArchiveMember = namedtuple("ArchiveMember", ["name", "size", "when", "path", "data"])
+
+
+def export_cursor(collection, username, limit=0):
+    """Open a batched cursor over a user's predictions in export order."""
+    return collection.find(
+        {"user": username},
+        {"photo": 1, "plant_name": 1},
+        sort=EXPORT_SORT,
+        batch_size=EXPORT_BATCH_SIZE,
+        limit=limit,
+    )
+
+
+def export_headers(fmt):
+    """Return the headers of a download in fmt."""
+    return {"Content-Disposition": f"attachment; filename=plant-history.{fmt}"}
+
+
+def export_row(document):
+    """Shape a prediction as an export row."""
+    return {
+        "id": str(document["_id"]),
+        "photo": document.get("photo"),
+        "plant_name": document.get("plant_name"),
+        "created": document["_id"].generation_time.isoformat(),
+    }
+
+
+def ndjson_line(row):
+    """Encode an export row as a line of NDJSON."""
+    return json.dumps(row) + "\n"
+
+
+def csv_line(values):
+    """Encode a list of values as a line of CSV."""
+    buffer = io.StringIO()
+    csv.writer(buffer).writerow(values)
+    return buffer.getvalue()
+
+
+def csv_lines(rows):
+    """Generate the CSV export: a header line, then one line per row."""
+    yield csv_line(EXPORT_COLUMNS)
+    for row in rows:
+        yield csv_line([row[column] for column in EXPORT_COLUMNS])
+
+
+def coalesce(lines, size=EXPORT_CHUNK_SIZE):
+    """Join short lines into chunks of about size characters."""
+    chunk, length = [], 0
+    for line in lines:
+        chunk.append(line)
+        length += len(line)
+        if length >= size:
+            yield "".join(chunk)
+            chunk, length = [], 0
+    if chunk:
+        yield "".join(chunk)
+
+
+class ArchivePlan:
+    """The members of a ZIP export, planned from the history cursor batch by batch."""
+
+    def __init__(self, uploads_dir, max_rows=EXPORT_ZIP_MAX_ROWS):
+        self.uploads_dir = uploads_dir
+        self.max_rows = max_rows
+        self.rows = 0
+        self.photos = []
+        self.manifest = []
+        self.when = datetime(1980, 1, 1, tzinfo=timezone.utc)
+
+    @property
+    def too_large(self):
+        """True if the export has more than max_rows predictions."""
+        return self.rows > self.max_rows
+
+    def add(self, documents):
+        """
+        Plan the members of a batch of predictions.
+
+        Photos missing from uploads_dir are left out of the archive but keep
+        their row in history.ndjson.
+
+        Returns:
+            bool: False once the export is too large; the rest of the batch
+                is not planned.
+        """
+        for document in documents:
+            self.rows += 1
+            if self.too_large:
+                return False
+            row = export_row(document)
+            self.manifest.append(ndjson_line(row))
+            created = document["_id"].generation_time
+            self.when = max(self.when, created)
+            photo = os.path.basename(row["photo"] or "")
+            path = os.path.join(self.uploads_dir, photo)
+            try:
+                size = os.path.getsize(path)
+            except OSError:
+                continue
+            self.photos.append(
+                ArchiveMember(f"photos/{photo}", size, created, path, None)
+            )
+        return True
+
+    def members(self):
+        """
+        Return the planned members.
+
+        Returns:
+            list: ArchiveMember per photo, then history.ndjson.
+        """
+        data = "".join(self.manifest).encode()
+        manifest = ArchiveMember("history.ndjson", len(data), self.when, None, data)
+        return self.photos + [manifest]
+
+
+def archive_members(documents, uploads_dir, max_rows=EXPORT_ZIP_MAX_ROWS):
+    """
+    List the members of a ZIP export of documents.
+
+    Returns:
+        list: See ArchivePlan.members; None if there are more than max_rows
+            documents.
+    """
+    plan = ArchivePlan(uploads_dir, max_rows)
+    return plan.members() if plan.add(documents) else None
+
+
+def dos_timestamp(when):
+    """Return the (time, date) fields of a ZIP header for a datetime."""
+    when = max(when, datetime(1980, 1, 1, tzinfo=timezone.utc))
+    return (
+        when.hour << 11 | when.minute << 5 | when.second // 2,
+        (when.year - 1980) << 9 | when.month << 5 | when.day,
+    )
+
+
+class CrcCache:
+    """CRC-32s of exported photos, so resumed downloads can skip reading them."""
+
+    def __init__(self, max_entries=100000):
+        self.max_entries = max_entries
+        self._crcs = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, member):
+        """Return the cached CRC-32 of a member's file, or None."""
+        with self._lock:
+            return self._crcs.get((member.path, member.size))
+
+    def put(self, member, crc):
+        """Remember the CRC-32 of a member's file."""
+        with self._lock:
+            self._crcs[(member.path, member.size)] = crc
+            while len(self._crcs) > self.max_entries:
+                self._crcs.popitem(last=False)
+
+
+CRC_CACHE = CrcCache()
+
+
+def window(data, position, start, stop):
+    """Yield the part of data (at position in the archive) in [start, stop)."""
+    end = position + len(data)
+    if end > start and position < stop:
+        yield data[max(0, start - position) : stop - position]
+
+
+def read_member(member, begin=0):
+    """
+    Read a member's content from begin in chunks.
+
+    Raises:
+        OSError: If its file changed size since the archive was planned.
+    """
+    if member.path is None:
+        yield member.data[begin:]
+        return
+    with open(member.path, "rb") as file:
+        file.seek(begin)
+        remaining = member.size - begin
+        while remaining > 0:
+            chunk = file.read(min(EXPORT_CHUNK_SIZE, remaining))
+            if not chunk:
+                raise OSError(f"{member.path} changed during the export")
+            remaining -= len(chunk)
+            yield chunk
+
+
+class ZipExport:
+    """A stored (uncompressed) ZIP archive whose bytes can be streamed by range."""
+
+    def __init__(self, members, crc_cache=CRC_CACHE):
+        self.members = members
+        self.crc_cache = crc_cache
+        self.names = [member.name.encode() for member in members]
+        self.offsets = []
+        position = 0
+        for member, name in zip(members, self.names):
+            self.offsets.append(position)
+            position += LOCAL_HEADER.size + len(name) + member.size
+            position += DATA_DESCRIPTOR.size
+        self.central_offset = position
+        self.central_size = sum(CENTRAL_HEADER.size + len(name) for name in self.names)
+        self.length = self.central_offset + self.central_size + END_RECORD.size
+
+    @property
+    def too_large(self):
+        """True if the archive would need ZIP64 records."""
+        return len(self.members) > ZIP_MAX_MEMBERS or self.length > ZIP_MAX_LENGTH
+
+    @property
+    def etag(self):
+        """An entity tag that changes whenever the archive content would."""
+        digest = hashlib.sha1()
+        for member in self.members:
+            digest.update(f"{member.name}\0{member.size}\0{member.when}\0".encode())
+        digest.update(self.members[-1].data if self.members else b"")
+        return digest.hexdigest()
+
+    def local_header(self, index):
+        """Return the local file header of member index."""
+        time_field, date_field = dos_timestamp(self.members[index].when)
+        header = LOCAL_HEADER.pack(
+            0x04034B50,  # signature
+            20,  # version needed: 2.0
+            ZIP_FLAGS,
+            0,  # stored
+            time_field,
+            date_field,
+            0,  # CRC-32 and sizes are in the data descriptor
+            0,
+            0,
+            len(self.names[index]),
+            0,  # extra field length
+        )
+        return header + self.names[index]
+
+    def central_header(self, index, crc):
+        """Return the central directory header of member index."""
+        member = self.members[index]
+        time_field, date_field = dos_timestamp(member.when)
+        header = CENTRAL_HEADER.pack(
+            0x02014B50,  # signature
+            20,  # version made by
+            20,  # version needed: 2.0
+            ZIP_FLAGS,
+            0,  # stored
+            time_field,
+            date_field,
+            crc,
+            member.size,
+            member.size,
+            len(self.names[index]),
+            0,  # extra field, comment, disk number, attributes
+            0,
+            0,
+            0,
+            0,
+            self.offsets[index],
+        )
+        return header + self.names[index]
+
+    def end_record(self):
+        """Return the end of central directory record."""
+        count = len(self.members)
+        return END_RECORD.pack(
+            0x06054B50, 0, 0, count, count, self.central_size, self.central_offset, 0
+        )
+
+    def member_data(self, index, start, stop):
+        """
+        Yield the part of member index's content in [start, stop).
+
+        Returns:
+            int: The CRC-32 of the content, or None if the content was cut
+                off at stop before it could be computed.
+        """
+        member = self.members[index]
+        data_start = self.offsets[index] + LOCAL_HEADER.size + len(self.names[index])
+        crc = self.crc_cache.get(member) if member.path else None
+        if crc is not None:
+            # Only read the requested part of the file
+            begin = min(member.size, max(0, start - data_start))
+            if data_start + begin < stop:
+                position = data_start + begin
+                for chunk in read_member(member, begin):
+                    yield from window(chunk, position, start, stop)
+                    position += len(chunk)
+                    if position >= stop:
+                        break
+            return crc
+        crc, position = 0, data_start
+        for chunk in read_member(member):
+            crc = zlib.crc32(chunk, crc)
+            yield from window(chunk, position, start, stop)
+            position += len(chunk)
+            if position >= stop:
+                return None
+        if member.path:
+            self.crc_cache.put(member, crc)
+        return crc
+
+    def chunks(self, start=0, stop=None):
+        """
+        Generate the bytes of the archive in [start, stop).
+
+        Members before start are not sent, but their content is read to
+        compute CRC-32s the archive needs later, unless they are cached.
+        """
+        stop = self.length if stop is None else min(stop, self.length)
+        crcs = []
+        for index, offset in enumerate(self.offsets):
+            if offset >= stop:
+                return
+            yield from window(self.local_header(index), offset, start, stop)
+            crc = yield from self.member_data(index, start, stop)
+            if crc is None:
+                return
+            crcs.append(crc)
+            size = self.members[index].size
+            data_end = offset + LOCAL_HEADER.size + len(self.names[index]) + size
+            descriptor = DATA_DESCRIPTOR.pack(0x08074B50, crc, size, size)
+            yield from window(descriptor, data_end, start, stop)
+        position = self.central_offset
+        for index, crc in enumerate(crcs):
+            header = self.central_header(index, crc)
+            yield from window(header, position, start, stop)
+            position += len(header)
+        yield from window(self.end_record(), position, start, stop)
+
+
+def byte_range(archive, request_range, if_range):
+    """
+    Choose the part of an archive to send for a request.
+
+    Args:
+        archive (ZipExport): The archive.
+        request_range: The request's parsed Range header, or None.
+        if_range: The request's parsed If-Range header.
+
+    Returns:
+        tuple: (start, stop) of a 206 response, (0, length) for the whole
+            archive, or None if the range cannot be satisfied (416).
+    """
+    if request_range is None or (
+        (if_range.etag or if_range.date) and if_range.etag != archive.etag
+    ):
+        return 0, archive.length
+    return request_range.range_for_length(archive.length)
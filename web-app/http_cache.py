@@ -0,0 +1,182 @@
+"""
+HTTP caching for the Flask app and the async app.
+
+Results and history pages are built from fragments (the rendered page
+content) kept in an in-process LRU cache, so a repeat view costs a single
+find_one by _id instead of a query of the user's predictions and a template
+render of the entries. Each fragment records the generation of its user's
+predictions it was rendered from: the "version" of the user's summary in
+db.user_stats, which every upload and delete bumps (see user_stats.py). A
+fragment is only served while that generation is current, so a change made
+by another worker or replica is seen on the next view, and a render that
+raced with a change can never be served once the change is done. The
+worker that handled a change also drops the user's fragments right away.
+Pages carry a strong ETag of their body and a Last-Modified date and are
+answered with 304 Not Modified when the browser's copy is current.
+
+Uploaded images get validators from Flask's static route already; because
+upload names are unique and files are never rewritten, they are also marked
+immutable with a long max-age so browsers do not revalidate them at all.
+
+FRAGMENT_CACHE_SIZE sets the number of cached fragments (0 disables the
+cache) and UPLOAD_CACHE_MAX_AGE the max-age of uploaded images in seconds.
+Hit ratios are reported at /api/cache.
+"""
+
+import os
+import threading
+from collections import OrderedDict, namedtuple
+
+from flask import current_app, make_response, render_template, request
+from markupsafe import Markup
+
+from request_profiling import as_hook
+
+# A rendered page fragment, the Last-Modified date to serve it with (or None)
+# and the generation of its user's predictions it was rendered from
+Fragment = namedtuple(
+    "Fragment", ["html", "last_modified", "generation"], defaults=(None,)
+)
+
+
+class FragmentCache:
+    """A thread-safe LRU of rendered fragments that can be dropped per user."""
+
+    def __init__(self, max_entries=1024):
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+        self.stale = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, generation=None):
+        """
+        Return the fragment cached under key, or None.
+
+        A fragment rendered from another generation of its user's data is
+        stale: it is dropped and None is returned.
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[1].generation != generation:
+                del self._entries[key]
+                self.stale += 1
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def owner(self, key):
+        """Return the user whose data the fragment under key was built from."""
+        with self._lock:
+            entry = self._entries.get(key)
+            return entry[0] if entry is not None else None
+
+    def put(self, key, user, fragment):
+        """Cache a fragment built from the data of user."""
+        if self.max_entries <= 0:
+            return
+        with self._lock:
+            self._entries[key] = (user, fragment)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def invalidate_user(self, user):
+        """Drop every fragment built from the data of user."""
+        with self._lock:
+            stale = [key for key, entry in self._entries.items() if entry[0] == user]
+            for key in stale:
+                del self._entries[key]
+            self.invalidations += len(stale)
+
+    def stats(self):
+        """Return the cache size and hit ratio as a dict."""
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self._entries),
+                "max_entries": self.max_entries,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_ratio": self.hits / lookups if lookups else 0.0,
+                "invalidations": self.invalidations,
+                "stale": self.stale,
+            }
+
+
+def init_http_cache(app, req=request, asynchronous=False):
+    """
+    Create the app's fragment cache and register the caching hooks.
+
+    Args:
+        app (Flask): The app to configure, or the Quart app of asgi_app.py.
+        req: The request proxy of the app's framework.
+        asynchronous (bool): Register the hooks as coroutines.
+
+    Returns:
+        FragmentCache: The app's fragment cache.
+    """
+    cache = FragmentCache(int(os.getenv("FRAGMENT_CACHE_SIZE", "1024")))
+    app.extensions["fragment_cache"] = cache
+    upload_max_age = int(os.getenv("UPLOAD_CACHE_MAX_AGE", "31536000"))
+
+    def cache_uploads(response):
+        return mark_immutable(req, response, upload_max_age)
+
+    def cache_stats():
+        return cache.stats()
+
+    app.after_request(as_hook(cache_uploads, asynchronous))
+    app.add_url_rule("/api/cache", "cache_stats", as_hook(cache_stats, asynchronous))
+    return cache
+
+
+def mark_immutable(req, response, max_age):
+    """Mark a response serving an uploaded image as immutable for max_age seconds."""
+    if (
+        req.endpoint == "static"
+        and req.view_args.get("filename", "").startswith("uploads/")
+        and response.status_code in (200, 304)
+    ):
+        response.cache_control.public = True
+        response.cache_control.max_age = max_age
+        response.cache_control.immutable = True
+    return response
+
+
+def revalidated(response, fragment):
+    """Mark a page response as private and to be revalidated on each use."""
+    response.cache_control.private = True
+    response.cache_control.no_cache = True
+    if fragment.last_modified is not None:
+        response.last_modified = fragment.last_modified
+    return response
+
+
+def fragment_cache():
+    """Return the fragment cache of the current app."""
+    return current_app.extensions["fragment_cache"]
+
+
+def conditional_page(template, fragment, **context):
+    """
+    Render a page around a fragment and make it a conditional response.
+
+    The page gets a strong ETag of its body, the fragment's Last-Modified
+    date and must be revalidated by the browser on each use; a request
+    whose validators match gets an empty 304 response instead.
+    """
+    response = revalidated(
+        make_response(
+            render_template(template, fragment=Markup(fragment.html), **context)
+        ),
+        fragment,
+    )
+    response.add_etag()
+    return response.make_conditional(request)
@@ -0,0 +1,361 @@
+"""
+Live history updates pushed to browsers with server-sent events.
+
+One PredictionFeed per app watches db.predictions and fans new and deleted
+predictions out to the event streams of their user, so the number of
+change streams does not grow with the number of open history pages.
+
+The feed follows a MongoDB change stream. Servers without change streams
+(a standalone mongod, or mongomock in tests) are polled instead, and only
+for the predictions of users with an open stream. A poll reads only the
+predictions added since the newest one it has seen (_id greater than it)
+and the number of predictions per user, both from a (user, _id) index.
+Only when a count does not add up, i.e. after a delete, are that user's
+prediction ids listed to find the missing ones. Change events of deletes
+carry only the document id; their user is taken from the pre-image when
+the collection records one (changeStreamPreAndPostImages, MongoDB 6.0+),
+or else from the inserts the feed has seen.
+
+With the sync server every open stream holds a worker thread for as long
+as the page stays open, so a process serves at most LIVE_MAX_STREAMS
+streams; beyond that /history/stream is refused and the history page
+works without live updates. The streams of the async app (stream_async)
+wait on its event loop instead; the feed hands their events over to the
+loop.
+"""
+
+import asyncio
+import json
+import os
+import queue
+import threading
+import time
+from collections import OrderedDict
+
+import pymongo
+
+LIVE_POLL_INTERVAL = float(os.getenv("LIVE_POLL_INTERVAL", "2"))
+LIVE_HEARTBEAT_SECONDS = 15
+LIVE_MAX_STREAMS = int(os.getenv("LIVE_MAX_STREAMS", "100"))
+
+# Error code of $changeStream on a server that is not a replica set
+CHANGE_STREAM_UNSUPPORTED = 40573
+
+PREDICTION_FIELDS = {"_id": 1, "user": 1, "photo": 1, "plant_name": 1}
+POLL_INDEX = [("user", pymongo.ASCENDING), ("_id", pymongo.ASCENDING)]
+
+
+class AsyncEvents:
+    """The events of a stream of the async app, handed over to its event loop."""
+
+    def __init__(self, maxsize):
+        self.loop = asyncio.get_running_loop()
+        self.queue = asyncio.Queue(maxsize)
+
+    def put_nowait(self, event):
+        """Queue an event from the feed's thread."""
+        try:
+            self.loop.call_soon_threadsafe(self.deliver, event)
+        except RuntimeError:
+            pass  # The loop is closed, and the stream with it
+
+    def deliver(self, event):
+        """Queue an event on the loop, resetting a stream that is not keeping up."""
+        try:
+            self.queue.put_nowait(event)
+        except asyncio.QueueFull:
+            while not self.queue.empty():
+                self.queue.get_nowait()
+            self.queue.put_nowait({"type": "reset"})
+
+
+def prediction_event(kind, document):
+    """Build the event sent to browsers for an inserted or deleted prediction."""
+    event = {"type": kind, "id": str(document["_id"])}
+    if kind == "insert":
+        event["photo"] = document.get("photo")
+        event["plant_name"] = document.get("plant_name")
+    return event
+
+
+def format_sse(event):
+    """Encode an event as a server-sent events message."""
+    return f"event: {event['type']}\ndata: {json.dumps(event)}\n\n"
+
+
+class PredictionFeed:  # pylint: disable=too-many-instance-attributes
+    """A single prediction watcher shared by every connected event stream."""
+
+    def __init__(
+        self,
+        collection,
+        poll_interval=LIVE_POLL_INTERVAL,
+        queue_size=100,
+        max_streams=LIVE_MAX_STREAMS,
+    ):
+        """
+        Args:
+            collection: The predictions collection.
+            poll_interval (float): Seconds between polls without change streams.
+            queue_size (int): Events buffered per stream before it is reset.
+            max_streams (int): Open streams accepted by accepting().
+        """
+        self.collection = collection
+        self.poll_interval = poll_interval
+        self.queue_size = queue_size
+        self.max_streams = max_streams
+        self.mode = None
+        self._subscribers = {}
+        self._owners = OrderedDict()
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def start(self):
+        """Start the watcher thread unless it is already running."""
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(
+                    target=self.run, name="prediction-feed", daemon=True
+                )
+                self._thread.start()
+
+    def subscribe(self, username, events=None):
+        """
+        Open a stream of the events of username.
+
+        Args:
+            events: Where to put the stream's events; a new queue.Queue if None.
+
+        Returns:
+            queue.Queue: The events for this stream.
+        """
+        events = queue.Queue(self.queue_size) if events is None else events
+        with self._lock:
+            self._subscribers.setdefault(username, set()).add(events)
+        return events
+
+    def unsubscribe(self, username, events):
+        """Close a stream opened by subscribe."""
+        with self._lock:
+            streams = self._subscribers.get(username, set())
+            streams.discard(events)
+            if not streams:
+                self._subscribers.pop(username, None)
+
+    def users(self):
+        """Return the users with at least one open stream."""
+        with self._lock:
+            return set(self._subscribers)
+
+    def accepting(self):
+        """True if fewer than max_streams streams are open."""
+        with self._lock:
+            open_streams = sum(len(streams) for streams in self._subscribers.values())
+        return open_streams < self.max_streams
+
+    def publish(self, username, event):
+        """Send an event to every stream of username."""
+        with self._lock:
+            streams = list(self._subscribers.get(username, ()))
+        for events in streams:
+            try:
+                events.put_nowait(event)
+            except queue.Full:
+                # The browser is not keeping up; make it reload instead
+                with events.mutex:
+                    events.queue.clear()
+                events.put_nowait({"type": "reset"})
+
+    def remember_owner(self, prediction_id, username, limit=10000):
+        """Remember the user of a prediction, to route its delete later."""
+        with self._lock:
+            self._owners[prediction_id] = username
+            while len(self._owners) > limit:
+                self._owners.popitem(last=False)
+
+    def handle_change(self, change):
+        """Publish one change stream event to the streams of its user."""
+        if change["operationType"] == "insert":
+            document = change["fullDocument"]
+            self.remember_owner(document["_id"], document.get("user"))
+            self.publish(document.get("user"), prediction_event("insert", document))
+        elif change["operationType"] == "delete":
+            prediction_id = change["documentKey"]["_id"]
+            before = change.get("fullDocumentBeforeChange") or {}
+            with self._lock:
+                username = before.get("user", self._owners.pop(prediction_id, None))
+            if username is not None:
+                self.publish(
+                    username, prediction_event("delete", {"_id": prediction_id})
+                )
+
+    def watch(self):
+        """
+        Follow the change stream, resuming after errors.
+
+        Raises:
+            pymongo.errors.OperationFailure: If the server has no change streams.
+        """
+        pipeline = [{"$match": {"operationType": {"$in": ["insert", "delete"]}}}]
+        options = {"full_document_before_change": "whenAvailable"}
+        resume_token = None
+        while True:
+            try:
+                with self.collection.watch(
+                    pipeline, resume_after=resume_token, **options
+                ) as stream:
+                    self.mode = "change_stream"
+                    for change in stream:
+                        resume_token = stream.resume_token
+                        self.handle_change(change)
+            except pymongo.errors.OperationFailure as error:
+                if error.code == CHANGE_STREAM_UNSUPPORTED:
+                    raise
+                print(f"Prediction change stream failed, restarting: {error}")
+                if options:
+                    options = {}  # Servers before 6.0 have no pre-images
+                else:
+                    resume_token = None
+                time.sleep(self.poll_interval)
+            except pymongo.errors.PyMongoError as error:
+                print(f"Prediction change stream failed, resuming: {error}")
+                time.sleep(self.poll_interval)
+
+    def prediction_ids(self, username):
+        """List the ids of a user's predictions, read from the index only."""
+        return {
+            document["_id"]
+            for document in self.collection.find({"user": username}, {"_id": 1})
+        }
+
+    def prediction_counts(self, users):
+        """Count the predictions of each of users."""
+        counts = dict.fromkeys(users, 0)
+        for row in self.collection.aggregate(
+            [
+                {"$match": {"user": {"$in": list(users)}}},
+                {"$group": {"_id": "$user", "count": {"$sum": 1}}},
+            ]
+        ):
+            counts[row["_id"]] = row["count"]
+        return counts
+
+    def poll_new(self, known):
+        """Publish the predictions added after the newest one seen per user."""
+        clauses = [
+            {"user": username, "_id": {"$gt": max(ids)}}
+            for username, ids in known.items()
+            if ids
+        ]
+        clauses += [{"user": username} for username, ids in known.items() if not ids]
+        if not clauses:
+            return
+        for document in self.collection.find(
+            {"$or": clauses}, PREDICTION_FIELDS, sort=[("_id", pymongo.ASCENDING)]
+        ):
+            ids = known[document["user"]]
+            if document["_id"] not in ids:
+                ids.add(document["_id"])
+                self.publish(document["user"], prediction_event("insert", document))
+
+    def reconcile(self, username, ids):
+        """
+        Publish the changes that a user's prediction count revealed.
+
+        Lists the user's prediction ids: those gone were deleted, and those
+        unseen were inserted with an _id older than the newest seen (e.g.
+        by a server whose clock is behind).
+        """
+        current = self.prediction_ids(username)
+        for prediction_id in ids - current:
+            self.publish(username, prediction_event("delete", {"_id": prediction_id}))
+        unseen = current - ids
+        if unseen:
+            for document in self.collection.find(
+                {"_id": {"$in": list(unseen)}},
+                PREDICTION_FIELDS,
+                sort=[("_id", pymongo.ASCENDING)],
+            ):
+                self.publish(username, prediction_event("insert", document))
+        ids.clear()
+        ids.update(current)
+
+    def poll_once(self, known):
+        """
+        Publish the changes of subscribed users' predictions since the last poll.
+
+        Args:
+            known (dict): User to the set of their prediction ids, updated in
+                place. Users seen for the first time are recorded without
+                events, and users without streams are forgotten.
+        """
+        users = self.users()
+        for username in set(known) - users:
+            del known[username]
+        for username in users - set(known):
+            known[username] = self.prediction_ids(username)
+        if not known:
+            return
+        self.poll_new(known)
+        for username, count in self.prediction_counts(known).items():
+            if count != len(known[username]):
+                self.reconcile(username, known[username])
+
+    def poll(self):
+        """Poll for changes forever."""
+        self.mode = "polling"
+        known = {}
+        try:
+            self.collection.create_index(POLL_INDEX)
+        except pymongo.errors.PyMongoError as error:
+            print(f"Could not create the prediction polling index: {error}")
+        while True:
+            try:
+                self.poll_once(known)
+            except pymongo.errors.PyMongoError as error:
+                print(f"Prediction polling failed: {error}")
+            time.sleep(self.poll_interval)
+
+    def run(self):
+        """Watch the change stream, or poll when the server has none."""
+        if callable(getattr(type(self.collection), "watch", None)):
+            try:
+                self.watch()
+            except pymongo.errors.OperationFailure:
+                print("Change streams are not supported, polling for predictions")
+        self.poll()
+
+    def stream(self, username, heartbeat=LIVE_HEARTBEAT_SECONDS):
+        """
+        Generate the server-sent events of one browser connection.
+
+        Yields:
+            str: SSE messages, with a comment line as heartbeat when idle.
+        """
+        events = self.subscribe(username)
+        self.start()
+        try:
+            yield "retry: 5000\n\n"
+            while True:
+                try:
+                    yield format_sse(events.get(timeout=heartbeat))
+                except queue.Empty:
+                    yield ": keep-alive\n\n"
+        finally:
+            self.unsubscribe(username, events)
+
+    async def stream_async(self, username, heartbeat=LIVE_HEARTBEAT_SECONDS):
+        """Generate the server-sent events of a connection to the async app."""
+        events = self.subscribe(username, AsyncEvents(self.queue_size))
+        self.start()
+        try:
+            yield "retry: 5000\n\n"
+            while True:
+                try:
+                    event = await asyncio.wait_for(events.queue.get(), heartbeat)
+                except asyncio.TimeoutError:
+                    yield ": keep-alive\n\n"
+                else:
+                    yield format_sse(event)
+        finally:
+            self.unsubscribe(username, events)
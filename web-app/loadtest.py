@@ -0,0 +1,505 @@
+"""
+Load-testing harness for the upload -> predict -> results -> history flow.
+
+The web app is created in-process against a mongomock stand-in (or a real
+MongoDB when --mongo-uri is given) and calls to the ML client are routed
+either to a stub model or to a running ML client (--ml-url). Concurrent
+virtual users then drive the routes with the flowers-102 sample images and
+the run is reported as JSON so results can be compared across commits.
+With --base-url the same scenario is driven over HTTP against a running
+server instead, e.g. to compare the sync server with the ASGI one. With
+--predict-url the virtual users post the images straight to a running ML
+client's /predict instead, to load the model server on its own.
+
+The in-process app runs with the upload and login limits lifted, as every
+virtual user comes from one address. A server driven with --base-url must
+be started with them lifted too (see readme.txt). Uploads answered with 429
+are counted as "throttled", and the run exits with an error when there are
+any, since its numbers would then measure the rate limiter.
+
+Usage:
+    python loadtest.py --users 8 --iterations 20 --output loadtest.json
+    python loadtest.py --users 200 --base-url http://localhost:5000
+    python loadtest.py --users 8 --predict-url http://localhost:3001/predict
+"""
+
+import argparse
+import base64
+import contextlib
+import functools
+import json
+import math
+import os
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import uuid
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from unittest.mock import patch
+from urllib.parse import urljoin
+
+import requests
+
+import app as webapp
+
+DEFAULT_IMAGE_DIR = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)),
+    "..",
+    "machine-learning-client",
+    "data",
+    "flowers-102",
+    "jpg",
+)
+
+
+def percentile(samples, pct):
+    """
+    Return the pct-th percentile of samples using the nearest-rank method.
+
+    Args:
+        samples (list): Unsorted numeric samples.
+        pct (float): Percentile between 0 and 100.
+
+    Returns:
+        float: The percentile value, or 0.0 when there are no samples.
+    """
+    if not samples:
+        return 0.0
+    ordered = sorted(samples)
+    rank = max(1, math.ceil(pct / 100.0 * len(ordered)))
+    return ordered[min(rank, len(ordered)) - 1]
+
+
+def summarize(samples):
+    """Summarize latency samples (in seconds) as milliseconds."""
+    count = len(samples)
+    return {
+        "count": count,
+        "mean_ms": round(sum(samples) / count * 1000, 3) if count else 0.0,
+        "p50_ms": round(percentile(samples, 50) * 1000, 3),
+        "p95_ms": round(percentile(samples, 95) * 1000, 3),
+        "p99_ms": round(percentile(samples, 99) * 1000, 3),
+        "max_ms": round(max(samples) * 1000, 3) if count else 0.0,
+    }
+
+
+class Timings:
+    """Thread-safe collection of latency samples grouped by name."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._samples = {}
+
+    def record(self, name, seconds):
+        """Record one sample for name."""
+        with self._lock:
+            self._samples.setdefault(name, []).append(seconds)
+
+    @contextlib.contextmanager
+    def measure(self, name):
+        """Context manager that records the wall time of its body."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(name, time.perf_counter() - start)
+
+    def report(self):
+        """Return the summary of every recorded name."""
+        with self._lock:
+            return {name: summarize(list(s)) for name, s in self._samples.items()}
+
+
+def load_sample_photos(image_dir, limit):
+    """
+    Load sample images as raw bytes.
+
+    Args:
+        image_dir (str): Directory containing .jpg images.
+        limit (int): Maximum number of images to load.
+
+    Returns:
+        list: (file name, bytes) tuples.
+    """
+    names = sorted(f for f in os.listdir(image_dir) if f.endswith(".jpg"))[:limit]
+    if not names:
+        raise ValueError(f"No .jpg images found in {image_dir}")
+    photos = []
+    for name in names:
+        with open(os.path.join(image_dir, name), "rb") as file_handle:
+            photos.append((name, file_handle.read()))
+    return photos
+
+
+def data_url(photo):
+    """Encode a (name, bytes) photo as the base64 data URL the upload form posts."""
+    encoded = base64.b64encode(photo[1]).decode("ascii")
+    return f"data:image/jpeg;base64,{encoded}"
+
+
+def stub_predict(latency):
+    """
+    Build a replacement for requests.post that answers like the ML client.
+
+    Args:
+        latency (float): Seconds to sleep per call to simulate inference.
+
+    Returns:
+        callable: A requests.post compatible function.
+    """
+
+    def post(_url, files=None, **_kwargs):
+        for _, file_handle, _ in (files or {}).values():
+            file_handle.read()
+        if latency:
+            time.sleep(latency)
+        response = requests.models.Response()
+        response.status_code = 200
+        response._content = json.dumps(  # pylint: disable=protected-access
+            {"plant_name": "stub flower"}
+        ).encode("utf-8")
+        return response
+
+    return post
+
+
+def remote_predict(ml_url):
+    """Build a requests.post replacement that targets a running ML client."""
+    real_post = requests.post
+
+    def post(_url, timeout=10, **kwargs):
+        return real_post(ml_url, timeout=timeout, **kwargs)
+
+    return post
+
+
+def timed(timings, name, func):
+    """Wrap func so each call is recorded under name."""
+
+    def wrapper(*args, **kwargs):
+        with timings.measure(name):
+            return func(*args, **kwargs)
+
+    return wrapper
+
+
+class HttpClient:
+    """Test-client lookalike that sends real HTTP requests to a server."""
+
+    def __init__(self, base_url):
+        self.base_url = base_url
+        self.session = requests.Session()
+
+    def get(self, path):
+        """GET path without following redirects."""
+        return self.session.get(
+            urljoin(self.base_url, path), allow_redirects=False, timeout=30
+        )
+
+    def post(self, path, data=None):
+        """POST form data to path without following redirects."""
+        return self.session.post(
+            urljoin(self.base_url, path), data=data, allow_redirects=False, timeout=30
+        )
+
+
+def http_predict(session, predict_url, photo):
+    """
+    POST a photo to an ML client's /predict as the web app's multipart upload.
+
+    Returns:
+        int: The response status code.
+    """
+    name, data = photo
+    response = session.post(
+        predict_url, files={"image": (name, data, "image/jpeg")}, timeout=30
+    )
+    return response.status_code
+
+
+def run_predict_user(predict, photos, iterations, timings):
+    """
+    Drive one virtual user posting photos straight to the ML client.
+
+    Args:
+        predict (callable): Posts a (name, bytes) photo, returns the status.
+        photos (list): Photos to post in turn.
+        iterations (int): Number of predictions.
+        timings (Timings): Where route timings are recorded.
+
+    Returns:
+        Counter: Failed requests by route and status, e.g. "/predict 503".
+    """
+    errors = Counter()
+    for iteration in range(iterations):
+        with timings.measure("route:/predict"):
+            status = predict(photos[iteration % len(photos)])
+        count_error(errors, "/predict", status, 200)
+    return errors
+
+
+def count_error(errors, route, status, expected):
+    """
+    Count a response of route in errors unless its status is the expected one.
+
+    Returns:
+        bool: True if the status was the expected one.
+    """
+    if status == expected:
+        return True
+    errors[f"{route} {status}"] += 1
+    return False
+
+
+def run_user(client, username, images, iterations, timings):
+    """
+    Drive one virtual user through signup and repeated upload cycles.
+
+    Args:
+        client: Flask test client or HttpClient with its own cookie jar.
+        username (str): Account created for this user.
+        images (list): Data URLs to upload in turn.
+        iterations (int): Number of upload cycles.
+        timings (Timings): Where route timings are recorded.
+
+    Returns:
+        Counter: Failed requests by route and status, e.g. "/upload 429".
+    """
+    errors = Counter()
+    credentials = {"username": username, "password": "loadtest"}
+    with timings.measure("route:/signup"):
+        client.post("/signup", data=credentials)
+
+    for iteration in range(iterations):
+        photo = images[iteration % len(images)]
+        with timings.measure("route:/upload"):
+            response = client.post("/upload", data={"photo": photo})
+        if not count_error(errors, "/upload", response.status_code, 302):
+            continue
+        location = response.headers["Location"]
+        with timings.measure("route:/results"):
+            response = client.get(location)
+        count_error(errors, "/results", response.status_code, 200)
+        with timings.measure("route:/history"):
+            response = client.get("/history")
+        count_error(errors, "/history", response.status_code, 200)
+    return errors
+
+
+@contextlib.contextmanager
+def patched_stack(args, timings):
+    """Patch the web app's Mongo client, ML client call and stages for timing."""
+    with contextlib.ExitStack() as stack:
+        if args.mongo_uri:
+            mongo_uri = args.mongo_uri
+        else:
+            import mongomock  # pylint: disable=import-outside-toplevel
+
+            mongo_uri = "mongodb://loadtest"
+            shared_client = mongomock.MongoClient()
+            stack.enter_context(
+                patch.object(
+                    webapp.pymongo, "MongoClient", lambda *_a, **_k: shared_client
+                )
+            )
+        stack.enter_context(
+            patch.dict(
+                os.environ,
+                {
+                    "MONGO_URI": mongo_uri,
+                    "MONGO_DBNAME": args.mongo_dbname,
+                    "SECRET_KEY": os.getenv("SECRET_KEY", "loadtest"),
+                    # every virtual user signs up and uploads from the same
+                    # address; the limits would throttle the run itself
+                    "AUTH_IP_BURST": "1000000",
+                    "UPLOAD_IP_RATE": "1000000",
+                    "UPLOAD_IP_BURST": "1000000",
+                    "UPLOAD_USER_RATE": "1000000",
+                    "UPLOAD_USER_BURST": "1000000",
+                },
+            )
+        )
+        predict = (
+            remote_predict(args.ml_url)
+            if args.ml_url
+            else stub_predict(args.stub_latency)
+        )
+        stack.enter_context(
+            patch.object(
+                webapp.requests, "post", timed(timings, "stage:predict", predict)
+            )
+        )
+        # Keep the uploaded photos out of the tree
+        uploads_dir = stack.enter_context(tempfile.TemporaryDirectory())
+        stages = {
+            "decode_photo": webapp.decode_photo,
+            # draft decode, EXIF transpose, thumbnail and re-encode: the
+            # main CPU cost of an upload
+            "normalize_photo": webapp.normalize_photo,
+            "save_photo": functools.partial(webapp.save_photo, uploads_dir=uploads_dir),
+            "process_photo": webapp.process_photo,
+        }
+        for stage, func in stages.items():
+            stack.enter_context(
+                patch.object(webapp, stage, timed(timings, f"stage:{stage}", func))
+            )
+        yield
+
+
+def git_revision():
+    """Return the current git commit, or None outside a checkout."""
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "HEAD"],
+            capture_output=True,
+            text=True,
+            check=True,
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def describe_config(args, image_count):
+    """Describe the run configuration for the report."""
+    mongo = ml_client = None  # unknown when driving a running server
+    if args.predict_url:
+        ml_client = args.predict_url
+    elif not args.base_url:
+        mongo = "real" if args.mongo_uri else "mongomock"
+        ml_client = args.ml_url or f"stub ({args.stub_latency}s)"
+    return {
+        "server": args.predict_url or args.base_url or "in-process",
+        "users": args.users,
+        "iterations": args.iterations,
+        "images": image_count,
+        "mongo": mongo,
+        "ml": ml_client,
+    }
+
+
+def run_load_test(args):  # pylint: disable=too-many-locals
+    """
+    Run the load test described by args.
+
+    Returns:
+        dict: JSON-serializable report.
+    """
+    photos = load_sample_photos(args.image_dir, args.images)
+    images = [data_url(photo) for photo in photos]
+    timings = Timings()
+    run_id = uuid.uuid4().hex[:8]
+    with contextlib.ExitStack() as stack:
+        if args.predict_url:
+            users = [
+                functools.partial(
+                    run_predict_user,
+                    functools.partial(
+                        http_predict, requests.Session(), args.predict_url
+                    ),
+                    photos[index:] + photos[:index],
+                    args.iterations,
+                    timings,
+                )
+                for index in range(args.users)
+            ]
+        else:
+            if args.base_url:
+                make_client = functools.partial(HttpClient, args.base_url)
+            else:
+                stack.enter_context(patched_stack(args, timings))
+                app = webapp.create_app()
+                app.config["TESTING"] = True
+                make_client = app.test_client
+            users = [
+                functools.partial(
+                    run_user,
+                    make_client(),
+                    f"loadtest-{run_id}-{index}",
+                    images[index:] + images[:index],
+                    args.iterations,
+                    timings,
+                )
+                for index in range(args.users)
+            ]
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=args.users) as pool:
+            futures = [pool.submit(user) for user in users]
+            errors = sum((future.result() for future in futures), Counter())
+        elapsed = time.perf_counter() - start
+
+    breakdown = timings.report()
+    requests_made = sum(
+        stats["count"] for name, stats in breakdown.items() if name.startswith("route:")
+    )
+    return {
+        "revision": git_revision(),
+        "config": describe_config(args, len(images)),
+        "elapsed_s": round(elapsed, 3),
+        "requests": requests_made,
+        "errors": sum(errors.values()),
+        "failed": dict(sorted(errors.items())),
+        "throttled": errors["/upload 429"],
+        "rps": round(requests_made / elapsed, 2) if elapsed else 0.0,
+        "uploads_per_s": (
+            round(args.users * args.iterations / elapsed, 2) if elapsed else 0.0
+        ),
+        "breakdown": breakdown,
+    }
+
+
+def parse_args(argv=None):
+    """Parse command-line arguments."""
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n", maxsplit=1)[0])
+    parser.add_argument("--users", type=int, default=4, help="concurrent users")
+    parser.add_argument(
+        "--iterations", type=int, default=10, help="upload cycles per user"
+    )
+    parser.add_argument(
+        "--images", type=int, default=16, help="number of sample images"
+    )
+    parser.add_argument("--image-dir", default=DEFAULT_IMAGE_DIR)
+    parser.add_argument("--mongo-uri", help="use a real MongoDB instead of mongomock")
+    parser.add_argument("--mongo-dbname", default="plant_identifier_loadtest")
+    parser.add_argument(
+        "--ml-url", help="POST to a running ML client instead of the stub"
+    )
+    parser.add_argument(
+        "--stub-latency",
+        type=float,
+        default=0.0,
+        help="seconds the stub model sleeps per prediction",
+    )
+    parser.add_argument(
+        "--base-url", help="drive a running server over HTTP instead of in-process"
+    )
+    parser.add_argument(
+        "--predict-url",
+        help="post the images straight to a running ML client's /predict",
+    )
+    parser.add_argument("--output", help="write the JSON report to this file")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    """Entry point for the load test."""
+    args = parse_args(argv)
+    report = run_load_test(args)
+    text = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as file_handle:
+            file_handle.write(text)
+    print(text)
+    if report["throttled"]:
+        sys.exit(
+            f"{report['throttled']} uploads were rate limited (429), so the run "
+            "measured the upload limits; lift them on the server (see readme.txt)"
+        )
+    return report
+
+
+if __name__ == "__main__":
+    main()
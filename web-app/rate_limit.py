@@ -0,0 +1,53 @@
+"""
+In-process token-bucket rate limiting.
+"""
+
+import threading
+import time
+from collections import OrderedDict
+
+
+class TokenBucket:
+    """
+    A set of token buckets keyed by e.g. username or client IP.
+
+    Each key starts with `burst` tokens and regains `rate` tokens per second
+    up to `burst`. Only the `max_keys` most recently used keys are kept, so
+    memory stays bounded however many distinct keys are seen.
+    """
+
+    def __init__(self, rate, burst, max_keys=10000):
+        self.rate = rate
+        self.burst = burst
+        self.max_keys = max_keys
+        self._buckets = OrderedDict()
+        self._lock = threading.Lock()
+
+    def allow(self, key, cost=1.0, now=None):
+        """
+        Take `cost` tokens from the bucket of `key` if it has enough.
+
+        Returns:
+            bool: True if the request is allowed.
+        """
+        now = time.monotonic() if now is None else now
+        with self._lock:
+            tokens, last = self._buckets.pop(key, (self.burst, now))
+            tokens = min(self.burst, tokens + (now - last) * self.rate)
+            allowed = tokens >= cost
+            if allowed:
+                tokens -= cost
+            self._buckets[key] = (tokens, now)
+            if len(self._buckets) > self.max_keys:
+                self._buckets.popitem(last=False)
+            return allowed
+
+    def retry_after(self, key, cost=1.0, now=None):
+        """Return the seconds until `key` has `cost` tokens again."""
+        now = time.monotonic() if now is None else now
+        with self._lock:
+            tokens, last = self._buckets.get(key, (self.burst, now))
+        tokens = min(self.burst, tokens + (now - last) * self.rate)
+        if tokens >= cost or self.rate <= 0:
+            return 0.0
+        return (cost - tokens) / self.rate
@@ -0,0 +1,317 @@
+"""
+Opt-in request profiling for the Flask app and the async app.
+
+A request is profiled when it carries the X-Profile header set to
+PROFILE_TOKEN, or at random for a PROFILE_SAMPLE_RATE fraction of requests.
+Profiled requests get a cProfile report (or pyinstrument, when installed and
+PROFILE_ENGINE=pyinstrument) plus tracemalloc snapshots of every
+profiled_section() they pass through. Reports are written to PROFILE_DIR,
+which keeps the newest PROFILE_MAX_REPORTS of them, and listed at /_profiles
+for requests carrying the token; without PROFILE_TOKEN they are only on
+disk. When neither trigger is configured no hooks are registered, so there
+is no per-request overhead.
+
+Profiling never fails a request: errors of the profiler are logged and the
+request is served without its report.
+
+In the async app (asgi_app.py) the hooks run on the event loop, so a report
+also covers the other requests the loop served meanwhile, and a request that
+starts while another one is being profiled is served without a report, as
+the profiler can only be active once per thread. Its reports have no
+sections, since profiled_section() needs a Flask request.
+"""
+
+import cProfile
+import functools
+import hmac
+import io
+import mimetypes
+import json
+import os
+import pstats
+import random
+import threading
+import time
+import tracemalloc
+import uuid
+from contextlib import contextmanager
+from urllib.parse import urlencode
+
+from flask import g, has_request_context, request
+from werkzeug.exceptions import NotFound
+from werkzeug.security import safe_join
+
+try:
+    import pyinstrument
+except ImportError:  # pragma: no cover - optional dependency
+    pyinstrument = None
+
+PROFILE_HEADER = "X-Profile"
+
+
+class TracingUsers:
+    """
+    Reference count of the sections using tracemalloc.
+
+    Tracing is started by the first section and stopped when the last one
+    ends, so overlapping profiled requests never stop it under each other.
+    Tracing started outside this module is left alone.
+    """
+
+    def __init__(self):
+        self.users = 0
+        self.owned = False
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        """Make sure tracemalloc is tracing until the matching release()."""
+        with self._lock:
+            if self.users == 0 and not tracemalloc.is_tracing():
+                tracemalloc.start()
+                self.owned = True
+            self.users += 1
+
+    def release(self):
+        """End a section; stops tracing after the last one if we started it."""
+        with self._lock:
+            self.users -= 1
+            if self.users == 0 and self.owned:
+                tracemalloc.stop()
+                self.owned = False
+
+
+TRACING = TracingUsers()
+
+
+def init_profiling(app, req=request, state=g, asynchronous=False):
+    """
+    Register the profiling hooks and index routes if profiling is configured.
+
+    Args:
+        app (Flask): The app to instrument, or the Quart app of asgi_app.py.
+        req: The request proxy of the app's framework.
+        state: The g proxy of the app's framework.
+        asynchronous (bool): Register hooks and routes as coroutines, which
+            Quart runs on the event loop rather than in a worker thread.
+
+    Returns:
+        bool: True if profiling hooks were registered.
+    """
+    token = os.getenv("PROFILE_TOKEN")
+    sample_rate = float(os.getenv("PROFILE_SAMPLE_RATE", "0"))
+    if not token and sample_rate <= 0:
+        return False
+
+    profile_dir = os.path.abspath(os.getenv("PROFILE_DIR", "profiles"))
+    max_reports = int(os.getenv("PROFILE_MAX_REPORTS", "200"))
+    engine = os.getenv("PROFILE_ENGINE", "cprofile")
+    if engine == "pyinstrument" and pyinstrument is None:
+        print("pyinstrument is not installed, falling back to cProfile")
+        engine = "cprofile"
+    os.makedirs(profile_dir, exist_ok=True)
+
+    def start_profile():
+        if req.path.startswith("/_profiles"):
+            return
+        requested = token and req.headers.get(PROFILE_HEADER) == token
+        if not requested and random.random() >= sample_rate:
+            return
+        state.profile_id = (
+            f"{time.strftime('%Y%m%d-%H%M%S')}-{req.endpoint}-"
+            f"{uuid.uuid4().hex[:8]}"
+        )
+        state.profile_sections = []
+        state.profile_start = time.perf_counter()
+        try:
+            state.profile = start_profiler(engine)
+        except (RuntimeError, ValueError) as error:
+            # e.g. another profiler is already active on this thread
+            print(f"Could not start the profiler: {error}")
+
+    def stop_profile(response):
+        profiler = state.pop("profile", None)
+        if profiler is None:
+            return response
+        title = f"{req.method} {req.path} -> {response.status_code}"
+        try:
+            profile_id = write_profile(profile_dir, engine, profiler, title, state)
+            prune_profiles(profile_dir, max_reports)
+        except (OSError, RuntimeError, ValueError) as error:
+            print(f"Could not write the profile: {error}")
+            return response
+        response.headers["X-Profile-Id"] = profile_id
+        return response
+
+    def profile_index():
+        # Links carry the token, as a browser following them sends no header
+        query = urlencode({"token": check_token(token, req)})
+        names = sorted(os.listdir(profile_dir), reverse=True)
+        links = "".join(
+            f'<li><a href="/_profiles/{name}?{query}">{name}</a></li>'
+            for name in names
+            if name.endswith(".txt")
+        )
+        return f"<h1>Profiles</h1><ul>{links}</ul>"
+
+    def profile_file(filename):
+        check_token(token, req)
+        path = safe_join(profile_dir, filename)
+        if path is None or not os.path.isfile(path):
+            raise NotFound()
+        with open(path, "rb") as file_handle:
+            content = file_handle.read()
+        content_type = mimetypes.guess_type(path)[0] or "application/octet-stream"
+        return content, 200, {"Content-Type": content_type}
+
+    app.before_request(as_hook(start_profile, asynchronous))
+    app.after_request(as_hook(stop_profile, asynchronous))
+    app.add_url_rule(
+        "/_profiles", "profile_index", as_hook(profile_index, asynchronous)
+    )
+    app.add_url_rule(
+        "/_profiles/<path:filename>",
+        "profile_file",
+        as_hook(profile_file, asynchronous),
+    )
+    return True
+
+
+def as_hook(func, asynchronous):
+    """Return func, or a coroutine calling it for an app that runs them."""
+    if not asynchronous:
+        return func
+
+    @functools.wraps(func)
+    async def hook(*args, **kwargs):
+        return func(*args, **kwargs)
+
+    return hook
+
+
+def check_token(token, req):
+    """
+    Abort with 404 unless the request req carries the profiling token.
+
+    Profiles expose code paths and timings, so they are never served when no
+    token is configured (sampling-only setups keep them on disk).
+
+    Returns:
+        str: The token the request carried.
+    """
+    supplied = req.headers.get(PROFILE_HEADER) or req.args.get("token")
+    if not token or not supplied or not hmac.compare_digest(supplied, token):
+        raise NotFound()
+    return supplied
+
+
+def prune_profiles(profile_dir, max_reports):
+    """Delete the files of all but the newest max_reports profiles."""
+    reports = sorted(
+        (entry for entry in os.scandir(profile_dir) if entry.name.endswith(".txt")),
+        key=lambda entry: entry.stat().st_mtime,
+        reverse=True,
+    )
+    stale = {entry.name[: -len(".txt")] for entry in reports[max_reports:]}
+    if not stale:
+        return
+    for entry in os.scandir(profile_dir):
+        if entry.name.split(".", 1)[0] in stale:
+            try:
+                os.remove(entry.path)
+            except FileNotFoundError:
+                pass  # Pruned by a concurrent request
+
+
+def start_profiler(engine):
+    """Create and start a profiler for the given engine."""
+    if engine == "pyinstrument":
+        profiler = pyinstrument.Profiler()
+        profiler.start()
+        return profiler
+    profiler = cProfile.Profile()
+    profiler.enable()
+    return profiler
+
+
+def write_profile(profile_dir, engine, profiler, title, state):
+    """
+    Stop profiler and write its report and a text summary to profile_dir.
+
+    Args:
+        title (str): The request and response status, heading the summary.
+        state: The request's g, holding the profile id, start and sections.
+
+    Returns:
+        str: The profile id used as the file name prefix.
+    """
+    elapsed_ms = (time.perf_counter() - state.profile_start) * 1000
+    profile_id = state.profile_id
+    base = os.path.join(profile_dir, profile_id)
+
+    if engine == "pyinstrument":
+        profiler.stop()
+        with open(f"{base}.html", "w", encoding="utf-8") as file_handle:
+            file_handle.write(profiler.output_html())
+        stacks = profiler.output_text()
+    else:
+        profiler.disable()
+        profiler.dump_stats(f"{base}.prof")
+        buffer = io.StringIO()
+        pstats.Stats(profiler, stream=buffer).sort_stats("cumulative").print_stats(30)
+        stacks = buffer.getvalue()
+
+    with open(f"{base}.txt", "w", encoding="utf-8") as file_handle:
+        file_handle.write(f"{title} in {elapsed_ms:.1f}ms\n\n")
+        file_handle.write("Sections:\n")
+        file_handle.write(json.dumps(state.profile_sections, indent=2))
+        file_handle.write("\n\n")
+        file_handle.write(stacks)
+    return profile_id
+
+
+@contextmanager
+def profiled_section(name):
+    """
+    Record time and tracemalloc allocations of a block in a profiled request.
+
+    Does nothing unless the current request is being profiled. The peak is
+    that of the process while the block ran, which includes overlapping
+    profiled requests.
+
+    Args:
+        name (str): Label of the section in the profile summary.
+    """
+    if not has_request_context() or g.get("profile") is None:
+        yield
+        return
+
+    TRACING.acquire()
+    try:
+        tracemalloc.reset_peak()
+        before = tracemalloc.take_snapshot()
+    except RuntimeError as error:
+        TRACING.release()
+        print(f"Could not profile section {name}: {error}")
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed_ms = (time.perf_counter() - start) * 1000
+        try:
+            after = tracemalloc.take_snapshot()
+            _, peak = tracemalloc.get_traced_memory()
+            top = after.compare_to(before, "lineno")[:10]
+            g.profile_sections.append(
+                {
+                    "name": name,
+                    "ms": round(elapsed_ms, 3),
+                    "peak_kb": round(peak / 1024, 1),
+                    "top_allocations": [str(stat) for stat in top],
+                }
+            )
+        except RuntimeError as error:
+            print(f"Could not profile section {name}: {error}")
+        finally:
+            TRACING.release()
@@ -0,0 +1,304 @@
+"""
+Full-text search over a user's plant entries and identifications.
+
+Each searched collection has a MongoDB text index whose first key is the
+user, so a search only reads index entries of that user and its latency
+depends on the user's own entries, not on the size of the collection:
+
+- db.plants: the entry name and the care instructions from new_entry();
+- db.predictions: the predicted species.
+
+Both collections are queried for their best matches by text score. Text
+scores of different collections are not on the same scale (they depend on
+the fields and weights indexed), so each collection's scores are divided
+by its best score before the hits are merged into one ranked, paginated
+list.
+
+If a text index cannot be created (e.g. the collection already has another
+text index), that collection is searched with a case-insensitive regex over
+the same fields instead, scored by the weighted number of query terms each
+field contains, and index creation is retried every SEARCH_INDEX_RETRY
+seconds. Regex matches have no score to sort by in the database, so the
+same SEARCH_MAX_PAGES * SEARCH_PAGE_SIZE + 1 most recent matches are read
+for every page and ranked before paginating; older matches beyond them are
+not searched. The query builders are shared with the async app in asgi_app.py.
+"""
+
+import os
+import re
+import time
+
+import pymongo
+
+SEARCH_PAGE_SIZE = int(os.getenv("SEARCH_PAGE_SIZE", "10"))
+
+# Deep pages cost more to rank, so stop paginating after this many
+SEARCH_MAX_PAGES = int(os.getenv("SEARCH_MAX_PAGES", "20"))
+
+SEARCH_MAX_QUERY_LENGTH = 200
+
+# Seconds between attempts to create a text index that could not be created
+SEARCH_INDEX_RETRY = float(os.getenv("SEARCH_INDEX_RETRY", "300"))
+
+# Text index per collection: (indexed fields, weights)
+TEXT_INDEXES = {
+    "plants": (["name", "instructions"], {"name": 3, "instructions": 1}),
+    "predictions": (["plant_name"], {"plant_name": 1}),
+}
+
+TEXT_SORT = [("score", {"$meta": "textScore"})]
+REGEX_SORT = [("_id", pymongo.DESCENDING)]
+
+
+def index_keys(fields):
+    """Return the keys of a per-user text index over fields."""
+    return [("user", pymongo.ASCENDING)] + [(field, pymongo.TEXT) for field in fields]
+
+
+def text_index(collection):
+    """Return the create_index() arguments of a collection's text index."""
+    fields, weights = TEXT_INDEXES[collection]
+    return index_keys(fields), {"name": "user_text_search", "weights": weights}
+
+
+def ensure_search_indexes(db):
+    """
+    Create the per-user text indexes if they do not exist yet.
+
+    Returns:
+        set: The collections that have their text index.
+    """
+    ready = set()
+    for collection in TEXT_INDEXES:
+        keys, options = text_index(collection)
+        try:
+            getattr(db, collection).create_index(keys, **options)
+        except pymongo.errors.OperationFailure as error:
+            # e.g. a different text index already exists on the collection
+            print(f"Could not create the search index on {collection}: {error}")
+        else:
+            ready.add(collection)
+    return ready
+
+
+class SearchIndexes:
+    """Which collections can be searched by text index, rechecked while some cannot."""
+
+    def __init__(self, retry_interval=SEARCH_INDEX_RETRY):
+        self.retry_interval = retry_interval
+        self.ready = set()
+        self.checked_at = None
+
+    def due(self, now=None):
+        """True if the text indexes should be (re)created before searching."""
+        if len(self.ready) == len(TEXT_INDEXES):
+            return False
+        now = time.monotonic() if now is None else now
+        return self.checked_at is None or now - self.checked_at >= self.retry_interval
+
+    def update(self, ready, now=None):
+        """Record the result of ensure_search_indexes."""
+        self.ready = set(ready)
+        self.checked_at = time.monotonic() if now is None else now
+
+
+def clean_query(query):
+    """Normalize a search query; returns an empty string for blank input."""
+    return " ".join((query or "").split())[:SEARCH_MAX_QUERY_LENGTH]
+
+
+def clamp_page(page):
+    """Parse a 1-based page number, clamped to 1..SEARCH_MAX_PAGES."""
+    try:
+        page = int(page)
+    except (TypeError, ValueError):
+        page = 1
+    return max(1, min(page, SEARCH_MAX_PAGES))
+
+
+def search_params(args):
+    """Read the query and page number from request arguments."""
+    return args.get("q", ""), args.get("page", 1)
+
+
+def text_filter(username, query):
+    """Build the find() filter matching a user's documents against query."""
+    return {"user": username, "$text": {"$search": query}}
+
+
+def text_projection(collection):
+    """Build the find() projection: the indexed fields, photo and text score."""
+    fields, _ = TEXT_INDEXES[collection]
+    projection = {field: 1 for field in fields}
+    projection.update({"photo": 1, "score": {"$meta": "textScore"}})
+    return projection
+
+
+def query_terms(query):
+    """Split a search query into lowercase terms."""
+    return [term.lower() for term in query.split()]
+
+
+def regex_filter(collection, username, query):
+    """Build the find() filter matching any query term in the indexed fields."""
+    fields, _ = TEXT_INDEXES[collection]
+    pattern = "|".join(re.escape(term) for term in query_terms(query))
+    return {
+        "user": username,
+        "$or": [{field: {"$regex": pattern, "$options": "i"}} for field in fields],
+    }
+
+
+def regex_score(collection, document, terms):
+    """Score a regex match by the weighted number of terms in each field."""
+    fields, weights = TEXT_INDEXES[collection]
+    return float(
+        sum(
+            weights[field]
+            for field in fields
+            for term in terms
+            if term in str(document.get(field) or "").lower()
+        )
+    )
+
+
+def search_query(collection, username, query, text=True):
+    """
+    Build the find() arguments searching a collection.
+
+    Args:
+        text (bool): Whether the collection has its text index; if not, it
+            is searched by regex.
+
+    Returns:
+        tuple: (filter, projection, sort)
+    """
+    if text:
+        return text_filter(username, query), text_projection(collection), TEXT_SORT
+    fields, _ = TEXT_INDEXES[collection]
+    projection = {field: 1 for field in fields}
+    projection["photo"] = 1
+    return regex_filter(collection, username, query), projection, REGEX_SORT
+
+
+def match_limit(page, per_page=SEARCH_PAGE_SIZE, text=True):
+    """
+    Return how many matches of a collection to read for a page of results.
+
+    Text matches are read in score order, so the first page * per_page + 1
+    hold the page. Regex matches are scored only once read, so every page
+    reads the same fixed number of the most recent ones and pages are
+    ranked within that set rather than within a window that grows with
+    the page.
+    """
+    if text:
+        return page * per_page + 1
+    return SEARCH_MAX_PAGES * per_page + 1
+
+
+def scored_hits(collection, documents, query, text=True):
+    """
+    Shape a collection's matches as search results with normalized scores.
+
+    Scores are divided by the collection's best score, so the best match of
+    every collection scores 1.0 and hits of different collections compare.
+    """
+    hits = [search_hit(collection, document) for document in documents]
+    if not text:
+        terms = query_terms(query)
+        for hit, document in zip(hits, documents):
+            hit["score"] = regex_score(collection, document, terms)
+    best = max((hit["score"] for hit in hits), default=0.0)
+    for hit in hits:
+        hit["score"] = hit["score"] / best if best > 0 else 0.0
+    return hits
+
+
+def search_hit(collection, document):
+    """Shape a matched document as a search result."""
+    photo = document.get("photo") or ""
+    if collection == "plants":
+        return {
+            "kind": "plant",
+            "id": str(document["_id"]),
+            "title": document.get("name") or "Untitled plant",
+            "snippet": document.get("instructions") or "",
+            "photo": photo if photo.startswith("/") else f"/static/uploads/{photo}",
+            "score": document.get("score", 0.0),
+        }
+    return {
+        "kind": "identification",
+        "id": str(document["_id"]),
+        "title": document.get("plant_name") or "Unknown",
+        "snippet": "",
+        "photo": f"/static/uploads/{photo}",
+        "filename": photo,
+        "score": document.get("score", 0.0),
+    }
+
+
+def results_page(  # pylint: disable=too-many-arguments,too-many-positional-arguments
+    hits_by_collection, query, page, per_page=SEARCH_PAGE_SIZE, text_ready=None
+):
+    """
+    Merge the ranked hits of each collection into one page of results.
+
+    Args:
+        hits_by_collection (dict): Collection name to its matched documents,
+            each list holding at least match_limit() documents if that
+            many match.
+        query (str): The search query.
+        page (int): 1-based page number.
+        per_page (int): Results per page.
+        text_ready (set): Collections searched by text index; the others
+            were searched by regex. All of them by default.
+
+    Returns:
+        dict: The query, page number, results and whether a next page exists.
+    """
+    text_ready = TEXT_INDEXES if text_ready is None else text_ready
+    hits = [
+        hit
+        for collection, documents in hits_by_collection.items()
+        for hit in scored_hits(collection, documents, query, collection in text_ready)
+    ]
+    hits.sort(key=lambda hit: hit["score"], reverse=True)
+    start = (page - 1) * per_page
+    return {
+        "query": query,
+        "page": page,
+        "results": hits[start : start + per_page],
+        "has_next": len(hits) > start + per_page and page < SEARCH_MAX_PAGES,
+    }
+
+
+def search_entries(  # pylint: disable=too-many-arguments,too-many-positional-arguments
+    db, username, query, page=1, per_page=SEARCH_PAGE_SIZE, text_ready=None
+):
+    """
+    Search a user's plant entries and identifications.
+
+    Args:
+        text_ready (set): Collections with their text index, as returned by
+            ensure_search_indexes; the others are searched by regex. All of
+            them by default.
+
+    Returns:
+        dict: See results_page; no results for a blank query.
+    """
+    text_ready = TEXT_INDEXES if text_ready is None else text_ready
+    query = clean_query(query)
+    page = clamp_page(page)
+    if not query:
+        return results_page({}, query, page, per_page)
+    hits = {}
+    for collection in TEXT_INDEXES:
+        text = collection in text_ready
+        find_filter, projection, sort = search_query(collection, username, query, text)
+        hits[collection] = list(
+            getattr(db, collection)
+            .find(find_filter, projection)
+            .sort(sort)
+            .limit(match_limit(page, per_page, text))
+        )
+    return results_page(hits, query, page, per_page, text_ready)
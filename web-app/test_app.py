@@ -2,14 +2,25 @@
 Extended test suite for the Flask application using MagicMock.
 """
 
+import io
 import os
-from unittest.mock import patch, mock_open, MagicMock
+import time
+from unittest.mock import ANY, patch, mock_open, MagicMock
 
 import pytest
 from werkzeug.security import generate_password_hash
 from bson import ObjectId
+from PIL import Image
 
-from app import create_app, decode_photo, save_photo, process_photo
+from app import (
+    UPLOAD_MAX_EDGE,
+    create_app,
+    decode_photo,
+    normalize_photo,
+    save_photo,
+    process_photo,
+)
+from user_stats import week_key
 
 
 @pytest.fixture
@@ -28,6 +39,10 @@ def app_fixture():
         with patch("app.pymongo.MongoClient") as mock_mongo_client:
             # Mock database and collection
             mock_db = MagicMock()
+            # pymongo adds the _id to inserted documents
+            mock_db.predictions.insert_one.side_effect = lambda doc: doc.setdefault(
+                "_id", ObjectId()
+            )
             mock_mongo_client.return_value = {"plant_identifier": mock_db}
             app = create_app()
             app.config.update(
@@ -93,19 +108,54 @@ def test_decode_photo_invalid():
 
 
 def test_save_photo():
-    """Test save_photo function."""
-    photo_binary = b"test binary data"
+    """Test save_photo re-encodes the photo as a size-bounded JPEG."""
+    buffer = io.BytesIO()
+    Image.new("RGBA", (2000, 1000), color="green").save(buffer, format="PNG")
     uploads_dir = os.path.join("static", "uploads")
     os.makedirs(uploads_dir, exist_ok=True)
 
-    filepath, filename = save_photo(photo_binary)
+    filepath, filename = save_photo(buffer.getvalue())
     assert os.path.exists(filepath)
-    assert filename.endswith(".png")
+    assert filename.endswith(".jpg")
+    with Image.open(filepath) as saved:
+        assert saved.format == "JPEG"
+        assert max(saved.size) == UPLOAD_MAX_EDGE
 
     # Cleanup
     os.remove(filepath)
 
 
+def test_normalize_photo_applies_exif_orientation():
+    """Test normalize_photo rotates according to the EXIF orientation tag."""
+    image = Image.new("RGB", (300, 100), color="red")
+    exif = Image.Exif()
+    exif[0x0112] = 6  # Rotate 90 degrees clockwise
+    buffer = io.BytesIO()
+    image.save(buffer, format="JPEG", exif=exif)
+
+    derivative, extension, original_extension = normalize_photo(buffer.getvalue())
+    assert (extension, original_extension) == ("jpg", "jpg")
+    with Image.open(io.BytesIO(derivative)) as normalized:
+        assert normalized.size == (100, 300)
+
+
+def test_normalize_photo_invalid():
+    """Test normalize_photo rejects bytes that are not an image."""
+    with pytest.raises(ValueError) as excinfo:
+        normalize_photo(b"test binary data")
+    assert "Invalid photo data" in str(excinfo.value)
+
+
+def test_normalize_photo_decompression_bomb(monkeypatch):
+    """Test normalize_photo rejects images with too many pixels to decode."""
+    buffer = io.BytesIO()
+    Image.new("RGB", (100, 100)).save(buffer, format="PNG")
+    monkeypatch.setattr(Image, "MAX_IMAGE_PIXELS", 1000)
+    with pytest.raises(ValueError) as excinfo:
+        normalize_photo(buffer.getvalue())
+    assert "Invalid photo data" in str(excinfo.value)
+
+
 def test_new_entry_no_id(client):  # pylint: disable=redefined-outer-name
     """Test new_entry route with no ID provided."""
     response = client.get("/new_entry")
@@ -151,17 +201,53 @@ def test_process_photo(app_fixture):  # pylint: disable=redefined-outer-name
                     mock_post.assert_called_once_with(
                         "http://ml-client:3001/predict",
                         files={"image": (test_filename, mock_file(), "image/png")},
+                        headers={"X-Request-Deadline": ANY},
                         timeout=10,
                     )
+                    deadline = mock_post.call_args[1]["headers"]["X-Request-Deadline"]
+                    assert 0 < float(deadline) - time.time() <= 10
 
                     mock_db.predictions.insert_one.assert_called_once_with(
                         {
+                            "_id": ANY,
                             "photo": test_filename,
                             "filepath": test_filepath,
                             "plant_name": "Rose",
                             "user": "testuser",
                         }
                     )
+                    # Counted in the week the prediction was created
+                    started, counted = mock_db.user_stats.update_one.call_args_list
+                    assert started.kwargs["update"]["$inc"]["pending"] == 1
+                    created = mock_db.predictions.insert_one.call_args[0][0]["_id"]
+                    week = week_key(created.generation_time)
+                    assert counted.args[0] == {"_id": "testuser"}
+                    assert counted.args[1]["$inc"][f"weeks.{week}"] == 1
+
+
+def test_process_photo_shared(
+    app_fixture, tmp_path
+):  # pylint: disable=redefined-outer-name
+    """Test that the shared transport sends a reference instead of the photo."""
+    app, mock_db = app_fixture
+    test_filepath = tmp_path / "test_photo.png"
+    test_filepath.write_bytes(b"mock_image_data")
+    with app.test_request_context():
+        with patch.dict("flask.session", {"username": "testuser"}), patch(
+            "app.ML_TRANSPORT", "shared"
+        ), patch("requests.post") as mock_post:
+            mock_post.return_value.json.return_value = {"plant_name": "Rose"}
+            process_photo(str(test_filepath), "test_photo.png")
+
+            mock_post.assert_called_once_with(
+                "http://ml-client:3001/predict",
+                json={"path": "test_photo.png", "size": 15},
+                headers={"X-Request-Deadline": ANY},
+                timeout=10,
+            )
+            assert mock_db.predictions.insert_one.call_args[0][0]["plant_name"] == (
+                "Rose"
+            )
 
 
 def test_history_page(client):  # pylint: disable=redefined-outer-name
@@ -199,9 +285,12 @@ def test_upload_post_success(
 ):  # pylint: disable=redefined-outer-name
     """Test successful photo upload."""
     _, _ = app_fixture
+    normalized = (b"derivative", "jpg", "png")
     with patch("app.decode_photo") as mock_decode_photo, patch(
-        "app.save_photo"
-    ) as mock_save_photo, patch("app.process_photo") as mock_process_photo:
+        "app.normalize_photo", return_value=normalized
+    ), patch("app.save_photo") as mock_save_photo, patch(
+        "app.process_photo"
+    ) as mock_process_photo:
 
         mock_decode_photo.return_value = b"decoded_image_data"
         mock_save_photo.return_value = ("uploads/test_photo.png", "test_photo.png")
@@ -216,12 +305,56 @@ def test_upload_post_success(
         )
         assert response.status_code == 302  # Redirect to results
         mock_decode_photo.assert_called_once()
-        mock_save_photo.assert_called_once_with(b"decoded_image_data")
+        mock_save_photo.assert_called_once_with(b"decoded_image_data", normalized)
         mock_process_photo.assert_called_once_with(
             "uploads/test_photo.png", "test_photo.png"
         )
 
 
+def test_upload_rate_limited(app_fixture):  # pylint: disable=redefined-outer-name
+    """Test uploads over the per-IP limit get a 429 before any processing."""
+    _, _ = app_fixture  # for its environment
+    with patch.dict(os.environ, {"UPLOAD_IP_BURST": "1", "UPLOAD_IP_RATE": "0.01"}):
+        with patch("app.pymongo.MongoClient"):
+            limited = create_app()
+    limited_client = limited.test_client()
+    with patch("app.decode_photo") as mock_decode_photo, patch(
+        "app.normalize_photo", return_value=(b"derivative", "jpg", "jpg")
+    ), patch("app.save_photo", return_value=("uploads/a.jpg", "a.jpg")), patch(
+        "app.process_photo"
+    ):
+        assert limited_client.post("/upload", data={"photo": "x"}).status_code == 302
+        response = limited_client.post("/upload", data={"photo": "x"})
+        assert response.status_code == 429
+        assert int(response.headers["Retry-After"]) > 0
+        assert mock_decode_photo.call_count == 1
+
+
+def test_upload_quota_counts_stored_size(
+    app_fixture,
+):  # pylint: disable=redefined-outer-name
+    """Test the storage quota is checked with the normalized size, not the upload's."""
+    _, _ = app_fixture  # for its environment
+    with patch.dict(os.environ, {"UPLOAD_DAILY_BYTES": "100"}):
+        with patch("app.pymongo.MongoClient"):
+            limited = create_app()
+    limited_client = limited.test_client()
+    with limited_client.session_transaction() as sess:
+        sess["username"] = "alice"
+    with patch("app.decode_photo", return_value=b"x" * 1000), patch(
+        "app.normalize_photo", return_value=(b"d" * 10, "jpg", "png")
+    ), patch("app.save_photo", return_value=("uploads/a.jpg", "a.jpg")), patch(
+        "app.check_storage"
+    ) as mock_check_storage, patch(
+        "app.record_storage"
+    ) as mock_record_storage, patch(
+        "app.process_photo"
+    ):
+        assert limited_client.post("/upload", data={"photo": "x"}).status_code == 302
+        mock_check_storage.assert_called_once_with(ANY, ANY, "alice", 10)
+        mock_record_storage.assert_called_once_with(ANY, ANY, "alice", 10)
+
+
 def test_upload_post_error(app_fixture, client):  # pylint: disable=redefined-outer-name
     """Test photo upload with processing error."""
     _, _ = app_fixture
@@ -272,6 +405,43 @@ def test_history_logged_in(client, app_fixture):  # pylint: disable=redefined-ou
     assert b"test_photo.png" in response.data
 
 
+def test_export_history(client, app_fixture):  # pylint: disable=redefined-outer-name
+    """Test the history exports as NDJSON, CSV and a resumable ZIP."""
+    _, mock_db = app_fixture
+    document = {"_id": ObjectId(), "photo": "test_photo.png", "plant_name": "Rose"}
+    mock_db.predictions.find.side_effect = lambda *args, **kwargs: iter([document])
+    assert client.get("/history/export.ndjson").status_code == 302
+    with client.session_transaction() as session:
+        session["username"] = "testuser"
+
+    response = client.get("/history/export.ndjson")
+    assert response.mimetype == "application/x-ndjson"
+    assert b'"plant_name": "Rose"' in response.data
+    assert mock_db.predictions.find.call_args[0][0] == {"user": "testuser"}
+    response = client.get("/history/export.csv")
+    assert response.data.splitlines()[1].startswith(str(document["_id"]).encode())
+    assert client.get("/history/export.xml").status_code == 404
+
+    response = client.get("/history/export.zip")
+    assert response.status_code == 200
+    assert response.headers["Accept-Ranges"] == "bytes"
+    archive = response.data
+    assert len(archive) == response.content_length
+    etag = response.headers["ETag"]
+    response = client.get(
+        "/history/export.zip", headers={"Range": "bytes=100-", "If-Range": etag}
+    )
+    assert response.status_code == 206
+    assert response.headers["Content-Range"] == (
+        f"bytes 100-{len(archive) - 1}/{len(archive)}"
+    )
+    assert response.data == archive[100:]
+    response = client.get(
+        "/history/export.zip", headers={"Range": f"bytes={len(archive)}-"}
+    )
+    assert response.status_code == 416
+
+
 def test_login_valid_user(client, app_fixture):  # pylint: disable=redefined-outer-name
     """Test login with a valid user."""
     _, mock_db = app_fixture
@@ -285,6 +455,39 @@ def test_login_valid_user(client, app_fixture):  # pylint: disable=redefined-out
     assert response.status_code == 302  # Redirect to home
 
 
+def test_login_rehashes_outdated_hash(
+    client, app_fixture
+):  # pylint: disable=redefined-outer-name
+    """Test a successful login upgrades a hash made with another method."""
+    _, mock_db = app_fixture
+    mock_db.users.find_one.return_value = {
+        "_id": ObjectId(),
+        "username": "testuser",
+        "password": generate_password_hash("password", "pbkdf2:sha256:1000"),
+    }
+    response = client.post(
+        "/login", data={"username": "testuser", "password": "password"}
+    )
+    assert response.status_code == 302
+    mock_db.users.update_one.assert_called_once()
+    new_hash = mock_db.users.update_one.call_args[0][1]["$set"]["password"]
+    assert new_hash.startswith("scrypt:")
+
+
+def test_login_throttled(client, app_fixture):  # pylint: disable=redefined-outer-name
+    """Test repeated login attempts are rejected before hashing."""
+    _, mock_db = app_fixture
+    mock_db.users.find_one.return_value = None
+    for _ in range(5):
+        response = client.post(
+            "/login", data={"username": "victim", "password": "guess"}
+        )
+        assert response.status_code == 200
+    response = client.post("/login", data={"username": "victim", "password": "guess"})
+    assert response.status_code == 429
+    assert mock_db.users.find_one.call_count == 5
+
+
 def test_logout(client):  # pylint: disable=redefined-outer-name
     """Test logout."""
     with client.session_transaction() as session:
@@ -316,15 +519,130 @@ def test_results_valid(client, app_fixture):  # pylint: disable=redefined-outer-
     assert b"Rose" in response.data
 
 
+def test_results_conditional_get(
+    client, app_fixture
+):  # pylint: disable=redefined-outer-name
+    """Test a results page is cached and revalidated with its ETag."""
+    _, mock_db = app_fixture
+    mock_db.predictions.find_one.return_value = {
+        "_id": ObjectId(),
+        "photo": "cached.png",
+        "plant_name": "Rose",
+        "user": "testuser",
+    }
+    response = client.get("/results/cached.png")
+    assert response.status_code == 200
+    assert response.last_modified is not None
+    etag, _ = response.get_etag()
+    response = client.get("/results/cached.png", headers={"If-None-Match": etag})
+    assert response.status_code == 304
+    assert mock_db.predictions.find_one.call_count == 1
+    assert client.get("/api/cache").get_json()["hits"] == 1
+
+
+def test_delete_entry_invalidates_history(
+    client, app_fixture
+):  # pylint: disable=redefined-outer-name
+    """Test deleting an entry drops the cached history of its user."""
+    _, mock_db = app_fixture
+    entry_id = ObjectId()
+    mock_db.predictions.find.return_value = [
+        {"_id": entry_id, "photo": "gone.png", "plant_name": "Rose"}
+    ]
+    with client.session_transaction() as session:
+        session["username"] = "testuser"
+    assert b"gone.png" in client.get("/history").data
+    assert b"gone.png" in client.get("/history").data
+    assert mock_db.predictions.find.call_count == 1
+
+    mock_db.predictions.find_one_and_delete.return_value = {
+        "_id": entry_id,
+        "user": "testuser",
+        "plant_name": "Rose",
+    }
+    mock_db.predictions.find.return_value = []
+    client.post(f"/delete/{entry_id}")
+    assert b"gone.png" not in client.get("/history").data
+
+
+def test_history_changed_by_another_worker(
+    client, app_fixture
+):  # pylint: disable=redefined-outer-name
+    """Test a cached history is re-rendered once another process changed it."""
+    _, mock_db = app_fixture
+    mock_db.user_stats.find_one.return_value = {"_id": "testuser", "version": 2}
+    mock_db.predictions.find.return_value = [
+        {"_id": ObjectId(), "photo": "old.png", "plant_name": "Rose"}
+    ]
+    with client.session_transaction() as session:
+        session["username"] = "testuser"
+    assert b"old.png" in client.get("/history").data
+    assert b"old.png" in client.get("/history").data
+    assert mock_db.predictions.find.call_count == 1
+
+    # An upload handled elsewhere bumps the version of the user's predictions
+    mock_db.user_stats.find_one.return_value = {"_id": "testuser", "version": 4}
+    mock_db.predictions.find.return_value = [
+        {"_id": ObjectId(), "photo": "new.png", "plant_name": "Tulip"}
+    ]
+    assert b"new.png" in client.get("/history").data
+
+
+def test_uploads_cached_as_immutable(
+    client, tmp_path, monkeypatch
+):  # pylint: disable=redefined-outer-name
+    """Test uploaded images are served with validators and a long max-age."""
+    app = client.application
+    monkeypatch.setattr(app, "static_folder", str(tmp_path))
+    (tmp_path / "uploads").mkdir()
+    (tmp_path / "uploads" / "photo.jpg").write_bytes(b"jpeg")
+    response = client.get("/static/uploads/photo.jpg")
+    assert response.status_code == 200
+    assert response.cache_control.immutable
+    assert response.cache_control.max_age == 31536000
+    etag, _ = response.get_etag()
+    response = client.get("/static/uploads/photo.jpg", headers={"If-None-Match": etag})
+    assert response.status_code == 304
+
+
 def test_delete_entry(client, app_fixture):  # pylint: disable=redefined-outer-name
     """Test deleting an entry."""
     _, mock_db = app_fixture
     mock_entry_id = ObjectId()  # Use a valid ObjectId
-    mock_db.predictions.delete_one.return_value = None
+    mock_db.predictions.find_one_and_delete.return_value = {
+        "_id": mock_entry_id,
+        "user": "testuser",
+        "plant_name": "Rose",
+    }
     with client.session_transaction() as session:
         session["username"] = "testuser"
     response = client.post(f"/delete/{mock_entry_id}")
     assert response.status_code == 302  # Redirect to history
+    started, forgotten = mock_db.user_stats.update_one.call_args_list
+    assert started.kwargs["update"]["$inc"]["pending"] == 1
+    _, update = forgotten.args
+    assert update["$inc"]["total"] == -1
+    assert update["$inc"]["species.Rose"] == -1
+    assert update["$inc"]["pending"] == -1
+
+
+def test_stats_logged_in(client, app_fixture):  # pylint: disable=redefined-outer-name
+    """Test the stats page reads the materialized summary document."""
+    _, mock_db = app_fixture
+    mock_db.user_stats.find_one.return_value = {
+        "user": "testuser",
+        "total": 3,
+        "species": {"Rose": 2, "Tulip": 1},
+        "weeks": {"2024-W07": 3},
+        "built": True,
+    }
+    with client.session_transaction() as session:
+        session["username"] = "testuser"
+    response = client.get("/stats")
+    assert response.status_code == 200
+    assert b"Rose (2)" in response.data
+    assert b"2024-W07: 3" in response.data
+    mock_db.predictions.find.assert_not_called()
 
 
 def test_new_entry_get(client, app_fixture):  # pylint: disable=redefined-outer-name
@@ -357,3 +675,32 @@ def test_handle_error(client):  # pylint: disable=redefined-outer-name
     """Test the handle_error function."""
     response = client.get("/nonexistent_route")
     assert response.status_code == 404
+
+
+def test_search_logged_in(client, app_fixture):  # pylint: disable=redefined-outer-name
+    """Test the search page lists ranked matches for the logged-in user."""
+    _, mock_db = app_fixture
+    mock_db.plants.find.return_value.sort.return_value.limit.return_value = [
+        {"_id": ObjectId(), "name": "Fern", "instructions": "Mist weekly", "score": 2}
+    ]
+    mock_db.predictions.find.return_value.sort.return_value.limit.return_value = []
+    with client.session_transaction() as session:
+        session["username"] = "testuser"
+    response = client.get("/search?q=fern")
+    assert response.status_code == 200
+    assert b"Mist weekly" in response.data
+    assert mock_db.plants.find.call_args[0][0]["user"] == "testuser"
+    mock_db.plants.create_index.assert_called_once()
+    assert client.get("/api/search?q=fern").get_json()["results"][0]["title"] == "Fern"
+    mock_db.plants.create_index.assert_called_once()
+
+
+def test_history_stream(client):  # pylint: disable=redefined-outer-name
+    """Test the history event stream requires a login and streams SSE."""
+    assert client.get("/history/stream").status_code == 401
+    with client.session_transaction() as session:
+        session["username"] = "testuser"
+    response = client.get("/history/stream", buffered=False)
+    assert response.mimetype == "text/event-stream"
+    assert next(response.response) == b"retry: 5000\n\n"
+    response.close()
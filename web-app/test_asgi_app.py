@@ -0,0 +1,257 @@
+"""
+Tests for the async (ASGI) serving mode.
+"""
+
+import asyncio
+import base64
+import io
+import os
+import zipfile
+
+import httpx
+import pytest
+from PIL import Image
+
+from asgi_app import create_async_app, zip_export
+
+mongomock = pytest.importorskip("mongomock")
+
+
+class AsyncCursor:  # pylint: disable=too-few-public-methods
+    """Async cursor over a mongomock cursor."""
+
+    def __init__(self, cursor):
+        self.cursor = cursor
+
+    async def to_list(self, _length=None):
+        """Return all remaining documents."""
+        return list(self.cursor)
+
+    async def __aiter__(self):
+        for document in self.cursor:
+            yield document
+
+
+class AsyncCollection:
+    """Async facade over a mongomock collection."""
+
+    def __init__(self, collection):
+        self.collection = collection
+
+    def find(self, *args, **kwargs):
+        """Mirror AsyncCollection.find, which returns a cursor synchronously."""
+        return AsyncCursor(self.collection.find(*args, **kwargs))
+
+    async def aggregate(self, *args, **kwargs):
+        """Mirror AsyncCollection.aggregate, which awaits to a cursor."""
+        return AsyncCursor(self.collection.aggregate(*args, **kwargs))
+
+    def __getattr__(self, name):
+        method = getattr(self.collection, name)
+
+        async def call(*args, **kwargs):
+            return method(*args, **kwargs)
+
+        return call
+
+
+class AsyncDatabase:  # pylint: disable=too-few-public-methods
+    """Async facade over a mongomock database."""
+
+    def __init__(self):
+        self.database = mongomock.MongoClient().db
+
+    def __getattr__(self, name):
+        return AsyncCollection(self.database[name])
+
+
+def ml_client_stub(request):
+    """Answer like the ML client's /predict route."""
+    assert request.url.path == "/predict"
+    return httpx.Response(200, json={"plant_name": "Sunflower"})
+
+
+def photo_data_url():
+    """Return a small JPEG as the data URL the upload form posts."""
+    buffer = io.BytesIO()
+    Image.new("RGB", (64, 64), color="yellow").save(buffer, format="JPEG")
+    return "data:image/jpeg;base64," + base64.b64encode(buffer.getvalue()).decode()
+
+
+def test_async_upload_flow(tmp_path, monkeypatch):
+    """Test signup, upload, results and history on the async app."""
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setitem(os.environ, "SECRET_KEY", "testsecretkey")
+    http_client = httpx.AsyncClient(transport=httpx.MockTransport(ml_client_stub))
+    db = AsyncDatabase()
+    # mongomock cannot run the $toDate stats rebuild, so start with a summary
+    db.database.user_stats.insert_one({"_id": "testuser", "built": True})
+    app = create_async_app(db=db, http_client=http_client, sync_db=db.database)
+
+    async def scenario():
+        client = app.test_client()
+        response = await client.post(
+            "/signup", form={"username": "testuser", "password": "password"}
+        )
+        assert response.status_code == 302
+
+        response = await client.post("/upload", form={"photo": photo_data_url()})
+        assert response.status_code == 302
+        location = response.headers["Location"]
+        assert location.startswith("/results/")
+
+        response = await client.get(location)
+        assert b"Sunflower" in await response.get_data()
+
+        response = await client.get("/history")
+        assert b"Sunflower" in await response.get_data()
+        response = await client.get(
+            "/history", headers={"If-None-Match": response.headers["ETag"]}
+        )
+        assert response.status_code == 304
+        response = await client.get("/api/cache")
+        assert (await response.get_json())["hits"] == 1
+
+        response = await client.get("/history/export.ndjson")
+        assert b'"plant_name": "Sunflower"' in await response.get_data()
+        response = await client.get("/history/export.zip")
+        archive = await response.get_data()
+        with zipfile.ZipFile(io.BytesIO(archive)) as exported:
+            assert len(exported.namelist()) == 2  # the photo and history.ndjson
+        response = await client.get(
+            "/history/export.zip",
+            headers={"Range": "bytes=10-", "If-Range": response.headers["ETag"]},
+        )
+        assert response.status_code == 206
+        assert await response.get_data() == archive[10:]
+
+        response = await client.get("/api/stats")
+        stats = await response.get_json()
+        assert stats["total"] == 1
+        assert stats["top_species"] == [{"name": "Sunflower", "count": 1}]
+
+        prediction = db.database.predictions.find_one({"user": "testuser"})
+        response = await client.post(f"/delete/{prediction['_id']}")
+        assert response.status_code == 302
+        response = await client.get("/api/stats")
+        assert (await response.get_json())["total"] == 0
+        assert db.database.user_stats.find_one({"_id": "testuser"})["pending"] == 0
+        response = await client.get("/history")
+        assert b"Sunflower" not in await response.get_data()
+        response = await client.get(location)
+        assert response.status_code == 404
+
+        response = await client.post("/upload", form={})
+        assert response.status_code == 400
+
+    asyncio.run(scenario())
+
+
+def test_async_zip_export_row_limit(monkeypatch):
+    """Test the async app refuses ZIP exports over the row limit."""
+    monkeypatch.setitem(os.environ, "SECRET_KEY", "testsecretkey")
+    monkeypatch.setattr("asgi_app.EXPORT_BATCH_SIZE", 2)
+    db = AsyncDatabase()
+    for index in range(5):
+        db.database.predictions.insert_one(
+            {"user": "testuser", "photo": f"{index}.jpg", "plant_name": "Rose"}
+        )
+    app = create_async_app(db=db, http_client=httpx.AsyncClient(), sync_db=db.database)
+
+    async def scenario():
+        client = app.test_client()
+        async with client.session_transaction() as session:
+            session["username"] = "testuser"
+        response = await client.get("/history/export.zip")
+        with zipfile.ZipFile(io.BytesIO(await response.get_data())) as exported:
+            assert exported.read("history.ndjson").count(b"\n") == 5
+        assert (await zip_export(db, "testuser", max_rows=4))[1] == 413
+
+    asyncio.run(scenario())
+
+
+def test_async_history_requires_login():
+    """Test the async history route redirects anonymous users."""
+    db = AsyncDatabase()
+    app = create_async_app(db=db, http_client=httpx.AsyncClient(), sync_db=db.database)
+
+    async def scenario():
+        response = await app.test_client().get("/history")
+        assert response.status_code == 302
+
+    asyncio.run(scenario())
+
+
+def test_async_history_stream(monkeypatch):
+    """Test the async history event stream requires a login and streams SSE."""
+    monkeypatch.setitem(os.environ, "SECRET_KEY", "testsecretkey")
+    db = AsyncDatabase()
+    app = create_async_app(db=db, http_client=httpx.AsyncClient(), sync_db=db.database)
+
+    async def scenario():
+        client = app.test_client()
+        assert (await client.get("/history/stream")).status_code == 401
+        async with client.session_transaction() as session:
+            session["username"] = "testuser"
+        async with client.request("/history/stream") as connection:
+            await connection.send_complete()
+            assert await connection.receive() == b"retry: 5000\n\n"
+            await connection.disconnect()
+
+    asyncio.run(scenario())
+
+
+def test_async_shared_upload_limit(tmp_path, monkeypatch):
+    """Test the async app counts uploads in the cross-replica limit."""
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setitem(os.environ, "SECRET_KEY", "testsecretkey")
+    monkeypatch.setitem(os.environ, "UPLOAD_SHARED_LIMIT", "1")
+    monkeypatch.setitem(os.environ, "UPLOAD_SHARED_SYNC", "0.01")
+    http_client = httpx.AsyncClient(transport=httpx.MockTransport(ml_client_stub))
+    db = AsyncDatabase()
+    app = create_async_app(db=db, http_client=http_client, sync_db=db.database)
+
+    async def scenario():
+        client = app.test_client()
+        async with client.session_transaction() as session:
+            session["username"] = "testuser"
+        response = await client.post("/upload", form={"photo": photo_data_url()})
+        assert response.status_code == 302
+        await asyncio.sleep(0.2)  # Let the counter sync
+        assert db.database.upload_counters.find_one({"key": "testuser"})["count"] == 1
+        response = await client.post("/upload", form={"photo": photo_data_url()})
+        assert response.status_code == 429
+
+    asyncio.run(scenario())
+
+
+def test_async_profiling(tmp_path, monkeypatch):
+    """Test a request to the async app with the profiling header writes a report."""
+    monkeypatch.setitem(os.environ, "PROFILE_TOKEN", "secret")
+    monkeypatch.setitem(os.environ, "PROFILE_DIR", str(tmp_path))
+    db = AsyncDatabase()
+    app = create_async_app(db=db, http_client=httpx.AsyncClient(), sync_db=db.database)
+
+    async def scenario():
+        client = app.test_client()
+        response = await client.get("/", headers={"X-Profile": "secret"})
+        profile_id = response.headers["X-Profile-Id"]
+        summary = (tmp_path / f"{profile_id}.txt").read_text(encoding="utf-8")
+        assert "GET / -> 200" in summary
+        response = await client.get(f"/_profiles/{profile_id}.txt?token=secret")
+        assert (await response.get_data()).decode() == summary
+        assert (await client.get(f"/_profiles/{profile_id}.txt")).status_code == 404
+
+    asyncio.run(scenario())
+
+
+def test_async_upload_gc(monkeypatch):
+    """Test the async app starts the upload sweeper when an interval is set."""
+    monkeypatch.setitem(os.environ, "UPLOAD_GC_INTERVAL", "60")
+    started = []
+    monkeypatch.setattr(
+        "asgi_app.start_sweeper", lambda *args, **kwargs: started.append(args)
+    )
+    db = AsyncDatabase()
+    create_async_app(db=db, http_client=httpx.AsyncClient(), sync_db=db.database)
+    assert started == [(db.database, 60.0)]
@@ -0,0 +1,73 @@
+"""
+Tests for password hashing policy, login throttling and the hashing pool.
+"""
+
+import threading
+
+import pytest
+from werkzeug.security import generate_password_hash
+
+from auth_guard import AuthBusy, AuthGuard
+from rate_limit import TokenBucket
+
+
+def test_token_bucket_refills():
+    """Test a bucket allows its burst, then refills at its rate."""
+    bucket = TokenBucket(rate=1.0, burst=2)
+    assert bucket.allow("alice", now=0.0)
+    assert bucket.allow("alice", now=0.0)
+    assert not bucket.allow("alice", now=0.0)
+    assert bucket.retry_after("alice", now=0.0) == pytest.approx(1.0)
+    assert bucket.allow("bob", now=0.0)
+    assert bucket.allow("alice", now=1.0)
+
+
+def test_token_bucket_bounded_keys():
+    """Test only the most recently used keys are kept."""
+    bucket = TokenBucket(rate=0.0, burst=1, max_keys=2)
+    for key in ("a", "b", "c"):
+        bucket.allow(key, now=0.0)
+    assert not bucket.allow("c", now=0.0)
+    assert bucket.allow("a", now=0.0)  # evicted, so it starts full again
+
+
+def test_needs_rehash_on_method_change():
+    """Test hashes made with another method or cost are flagged for rehash."""
+    guard = AuthGuard(method="pbkdf2:sha256:1000")
+    assert guard.method == "pbkdf2:sha256:1000"
+    assert guard.needs_rehash(generate_password_hash("password"))
+    new_hash = guard.hash_password("password")
+    assert not guard.needs_rehash(new_hash)
+    assert guard.verify_password(new_hash, "password")
+
+
+def test_guard_throttles_by_username_and_ip():
+    """Test attempts are rejected once the username or IP bucket is empty."""
+    guard = AuthGuard(
+        method="pbkdf2:sha256:1000", limits={"user": (0.0, 2), "ip": (0.0, 3)}
+    )
+    assert guard.allow("alice", "10.0.0.1")
+    assert guard.allow("alice", "10.0.0.1")
+    assert not guard.allow("alice", "10.0.0.1")
+    assert not guard.allow("bob", "10.0.0.1")
+    assert guard.allow("bob", "10.0.0.2")
+
+
+def test_pool_rejects_when_saturated():
+    """Test hashing raises AuthBusy once workers and queue are full."""
+    guard = AuthGuard(method="pbkdf2:sha256:1000", workers=1, queue=0)
+    started, release = threading.Event(), threading.Event()
+
+    def slow():
+        started.set()
+        release.wait(5)
+        return "done"
+
+    worker = threading.Thread(target=guard.run, args=(slow,))
+    worker.start()
+    started.wait(5)
+    with pytest.raises(AuthBusy):
+        guard.run(lambda: None)
+    release.set()
+    worker.join()
+    assert guard.run(lambda: "ok") == "ok"
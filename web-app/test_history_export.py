@@ -0,0 +1,116 @@
+"""
+Tests for the streaming history export.
+"""
+
+import io
+import json
+import zipfile
+from types import SimpleNamespace
+
+import pytest
+from bson import ObjectId
+from werkzeug.datastructures import IfRange, Range
+
+from history_export import (
+    CrcCache,
+    ZipExport,
+    archive_members,
+    byte_range,
+    coalesce,
+    csv_lines,
+    export_row,
+    ndjson_line,
+)
+
+
+@pytest.fixture(name="documents")
+def documents_fixture(tmp_path):
+    """Three predictions; the photo of the last one is missing."""
+    documents = []
+    for index, size in enumerate((70000, 150000, 0)):
+        photo = f"photo{index}.jpg"
+        if size:
+            (tmp_path / photo).write_bytes(bytes(range(256)) * (size // 256))
+        documents.append({"_id": ObjectId(), "photo": photo, "plant_name": "Rose"})
+    return documents
+
+
+def test_ndjson_and_csv_rows(documents):
+    """Test rows are encoded one per line with a CSV header."""
+    rows = [export_row(document) for document in documents]
+    records = [json.loads(ndjson_line(row)) for row in rows]
+    assert records[0]["id"] == str(documents[0]["_id"])
+    assert records[0]["created"].startswith(str(ObjectId().generation_time.year))
+
+    lines = list(csv_lines(rows))
+    assert lines[0] == "id,photo,plant_name,created\r\n"
+    assert lines[1].startswith(f"{documents[0]['_id']},photo0.jpg,Rose,")
+    assert len(lines) == 4
+
+
+def test_coalesce():
+    """Test short lines are joined into chunks without losing any."""
+    chunks = list(coalesce((f"{i}\n" for i in range(1000)), size=100))
+    assert all(len(chunk) >= 100 for chunk in chunks[:-1])
+    assert "".join(chunks) == "".join(f"{i}\n" for i in range(1000))
+
+
+def test_zip_export(documents, tmp_path):
+    """Test the archive is a valid ZIP of the photos and the NDJSON rows."""
+    archive = ZipExport(archive_members(documents, str(tmp_path)), CrcCache())
+    data = b"".join(archive.chunks())
+    assert len(data) == archive.length
+
+    with zipfile.ZipFile(io.BytesIO(data)) as exported:
+        assert exported.testzip() is None
+        assert exported.namelist() == [
+            "photos/photo0.jpg",
+            "photos/photo1.jpg",
+            "history.ndjson",
+        ]
+        assert (
+            exported.read("photos/photo1.jpg") == (tmp_path / "photo1.jpg").read_bytes()
+        )
+        rows = exported.read("history.ndjson").decode().splitlines()
+        assert [json.loads(row)["photo"] for row in rows] == [
+            "photo0.jpg",
+            "photo1.jpg",
+            "photo2.jpg",
+        ]
+
+
+@pytest.mark.parametrize("cached", [False, True])
+def test_zip_export_ranges(documents, tmp_path, cached):
+    """Test any byte range matches the same bytes of the whole archive."""
+    members = archive_members(documents, str(tmp_path))
+    crc_cache = CrcCache()
+    data = b"".join(ZipExport(members, crc_cache).chunks())
+    archive = ZipExport(members, crc_cache if cached else CrcCache())
+    for start in (0, 10, 70000, 70100, archive.central_offset - 5, archive.length - 1):
+        for stop in (start + 1, start + 100000, archive.length):
+            assert b"".join(archive.chunks(start, stop)) == data[start:stop]
+
+
+def test_byte_range(documents, tmp_path):
+    """Test ranges are honored unless If-Range names another archive."""
+    archive = ZipExport(archive_members(documents, str(tmp_path)))
+    no_condition = IfRange()
+    assert byte_range(archive, None, no_condition) == (0, archive.length)
+    resume = Range("bytes", [(100, None)])
+    assert byte_range(archive, resume, no_condition) == (100, archive.length)
+    assert byte_range(archive, resume, IfRange(archive.etag)) == (100, archive.length)
+    assert byte_range(archive, resume, IfRange("stale")) == (0, archive.length)
+    beyond = Range("bytes", [(archive.length, None)])
+    assert byte_range(archive, beyond, no_condition) is None
+
+
+def test_archive_members_row_limit(documents, tmp_path):
+    """Test exports of more predictions than the limit are not planned."""
+    assert len(archive_members(documents, str(tmp_path), max_rows=3)) == 3
+    assert archive_members(iter(documents), str(tmp_path), max_rows=2) is None
+
+
+def test_zip_export_too_large():
+    """Test archives that would need ZIP64 are refused."""
+    member = SimpleNamespace(name="photos/huge.jpg", size=2**32)
+    assert ZipExport([member]).too_large
@@ -0,0 +1,51 @@
+"""
+Tests for the fragment cache.
+"""
+
+from http_cache import Fragment, FragmentCache
+
+
+def test_lru_eviction_and_hit_ratio():
+    """Test the least recently used fragment is evicted and hits are counted."""
+    cache = FragmentCache(max_entries=2)
+    cache.put("a", "alice", Fragment("A", None))
+    cache.put("b", "alice", Fragment("B", None))
+    assert cache.get("a").html == "A"
+    cache.put("c", "bob", Fragment("C", None))
+    assert cache.get("b") is None
+    assert cache.get("c").html == "C"
+    stats = cache.stats()
+    assert stats["entries"] == 2
+    assert (stats["hits"], stats["misses"]) == (2, 1)
+    assert stats["hit_ratio"] == 2 / 3
+
+
+def test_invalidate_user():
+    """Test invalidating a user drops only that user's fragments."""
+    cache = FragmentCache()
+    cache.put(("history", "alice"), "alice", Fragment("A", None))
+    cache.put(("results", "a.jpg"), "alice", Fragment("A1", None))
+    cache.put(("history", "bob"), "bob", Fragment("B", None))
+    cache.invalidate_user("alice")
+    assert cache.get(("history", "alice")) is None
+    assert cache.get(("results", "a.jpg")) is None
+    assert cache.get(("history", "bob")).html == "B"
+    assert cache.stats()["invalidations"] == 2
+
+
+def test_disabled_cache():
+    """Test a cache of size 0 stores nothing."""
+    cache = FragmentCache(max_entries=0)
+    cache.put("a", "alice", Fragment("A", None))
+    assert cache.get("a") is None
+
+
+def test_stale_generation():
+    """Test a fragment of another generation of its user's data is not served."""
+    cache = FragmentCache()
+    cache.put(("history", "alice"), "alice", Fragment("A", None, 2))
+    assert cache.owner(("history", "alice")) == "alice"
+    assert cache.get(("history", "alice"), 2).html == "A"
+    assert cache.get(("history", "alice"), 4) is None
+    assert cache.get(("history", "alice"), 2) is None  # dropped
+    assert cache.stats()["stale"] == 1
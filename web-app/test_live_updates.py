@@ -0,0 +1,163 @@
+"""
+Tests for the live prediction feed.
+"""
+
+import asyncio
+import json
+
+import pytest
+from bson import ObjectId
+
+from live_updates import AsyncEvents, PredictionFeed, format_sse
+
+mongomock = pytest.importorskip("mongomock")
+
+
+def drain(events):
+    """Return every event waiting in a stream queue."""
+    items = []
+    while not events.empty():
+        items.append(events.get_nowait())
+    return items
+
+
+def test_change_events_reach_only_their_user():
+    """Test inserts and deletes are routed to the streams of their user."""
+    feed = PredictionFeed(collection=None)
+    alice = feed.subscribe("alice")
+    bob = feed.subscribe("bob")
+    prediction_id = ObjectId()
+    feed.handle_change(
+        {
+            "operationType": "insert",
+            "fullDocument": {
+                "_id": prediction_id,
+                "user": "alice",
+                "photo": "a.jpg",
+                "plant_name": "Rose",
+            },
+        }
+    )
+    feed.handle_change(
+        {"operationType": "delete", "documentKey": {"_id": prediction_id}}
+    )
+    # A delete of an unknown prediction without a pre-image has no user
+    feed.handle_change({"operationType": "delete", "documentKey": {"_id": ObjectId()}})
+    feed.handle_change(
+        {
+            "operationType": "delete",
+            "documentKey": {"_id": ObjectId()},
+            "fullDocumentBeforeChange": {"user": "bob"},
+        }
+    )
+
+    assert [event["type"] for event in drain(alice)] == ["insert", "delete"]
+    assert [event["type"] for event in drain(bob)] == ["delete"]
+
+
+def test_polling_fallback_detects_inserts_and_deletes():
+    """Test polling reports changes to subscribed users after the first poll."""
+    collection = mongomock.MongoClient().db.predictions
+    old_id = collection.insert_one({"user": "alice", "photo": "old.jpg"}).inserted_id
+    feed = PredictionFeed(collection)
+    events = feed.subscribe("alice")
+    known = {}
+    feed.poll_once(known)
+    assert not drain(events)
+
+    new_id = collection.insert_one(
+        {"user": "alice", "photo": "new.jpg", "plant_name": "Tulip"}
+    ).inserted_id
+    collection.insert_one({"user": "bob", "photo": "bob.jpg"})
+    collection.delete_one({"_id": old_id})
+    feed.poll_once(known)
+    assert drain(events) == [
+        {
+            "type": "insert",
+            "id": str(new_id),
+            "photo": "new.jpg",
+            "plant_name": "Tulip",
+        },
+        {"type": "delete", "id": str(old_id)},
+    ]
+
+
+def test_polling_reads_only_new_predictions():
+    """Test a poll without deletes does not list the users' predictions again."""
+    collection = mongomock.MongoClient().db.predictions
+    for index in range(3):
+        collection.insert_one({"user": "alice", "photo": f"{index}.jpg"})
+    feed = PredictionFeed(collection)
+    events = feed.subscribe("alice")
+    known = {}
+    feed.poll_once(known)
+
+    reads = []
+    find = collection.find
+
+    def spy(*args, **kwargs):
+        if args:  # mongomock's aggregate calls find() too
+            reads.append(args[0])
+        return find(*args, **kwargs)
+
+    collection.find = spy
+    new_id = collection.insert_one({"user": "alice", "photo": "new.jpg"}).inserted_id
+    feed.poll_once(known)
+    assert [event["id"] for event in drain(events)] == [str(new_id)]
+    assert len(reads) == 1 and "$gt" in str(reads[0])
+
+    # A prediction with an older _id is found through the count
+    late_id = ObjectId.from_datetime(new_id.generation_time.replace(year=2020))
+    collection.insert_one({"_id": late_id, "user": "alice", "photo": "late.jpg"})
+    feed.poll_once(known)
+    assert [event["id"] for event in drain(events)] == [str(late_id)]
+    feed.unsubscribe("alice", events)
+    feed.poll_once(known)
+    assert not known
+
+
+def test_stream_limit():
+    """Test streams beyond max_streams are refused."""
+    feed = PredictionFeed(collection=None, max_streams=2)
+    feed.subscribe("alice")
+    assert feed.accepting()
+    feed.subscribe("bob")
+    assert not feed.accepting()
+
+
+def test_slow_stream_is_reset():
+    """Test a stream whose queue overflows is told to reload."""
+    feed = PredictionFeed(collection=None, queue_size=2)
+    events = feed.subscribe("alice")
+    for _ in range(3):
+        feed.publish("alice", {"type": "delete", "id": "x"})
+    assert drain(events) == [{"type": "reset"}]
+    feed.unsubscribe("alice", events)
+    assert not feed.users()
+
+
+def test_async_stream_receives_events_from_the_feed_thread():
+    """Test events published by the feed thread reach an async stream."""
+    feed = PredictionFeed(collection=None, queue_size=2)
+
+    async def scenario():
+        events = feed.subscribe("alice", AsyncEvents(feed.queue_size))
+        feed.publish("alice", {"type": "delete", "id": "x"})
+        assert await asyncio.wait_for(events.queue.get(), 1) == {
+            "type": "delete",
+            "id": "x",
+        }
+        for _ in range(3):
+            feed.publish("alice", {"type": "delete", "id": "y"})
+        await asyncio.sleep(0)
+        assert events.queue.get_nowait() == {"type": "reset"}
+
+    asyncio.run(scenario())
+
+
+def test_format_sse():
+    """Test events are encoded as named server-sent events."""
+    message = format_sse({"type": "delete", "id": "abc"})
+    assert message.startswith("event: delete\ndata: ")
+    assert json.loads(message.splitlines()[1][len("data: ") :])["id"] == "abc"
+    assert message.endswith("\n\n")
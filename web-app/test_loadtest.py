@@ -0,0 +1,101 @@
+"""
+Tests for the load-testing harness.
+"""
+
+import os
+from types import SimpleNamespace
+from unittest.mock import patch
+
+import pytest
+
+from loadtest import (
+    Timings,
+    parse_args,
+    percentile,
+    run_load_test,
+    run_user,
+    summarize,
+)
+
+
+def test_percentile_nearest_rank():
+    """Test percentile picks the nearest-rank sample."""
+    samples = list(range(1, 101))
+    assert percentile(samples, 50) == 50
+    assert percentile(samples, 95) == 95
+    assert percentile(samples, 99) == 99
+    assert percentile([], 50) == 0.0
+
+
+def test_summarize_reports_milliseconds():
+    """Test summarize converts seconds to milliseconds."""
+    stats = summarize([0.001, 0.002, 0.003])
+    assert stats["count"] == 3
+    assert stats["p50_ms"] == 2.0
+    assert stats["max_ms"] == 3.0
+
+
+def test_timings_measure():
+    """Test Timings records one sample per measured block."""
+    timings = Timings()
+    with timings.measure("stage"):
+        pass
+    assert timings.report()["stage"]["count"] == 1
+
+
+def test_run_load_test_smoke(tmp_path):
+    """Test a tiny in-process run against mongomock and the stub model."""
+    pytest.importorskip("mongomock")
+    image_dir = os.path.join(
+        "..", "machine-learning-client", "data", "flowers-102", "jpg"
+    )
+    args = parse_args(
+        ["--users", "2", "--iterations", "2", "--images", "2"]
+        + ["--image-dir", image_dir, "--output", str(tmp_path / "report.json")]
+    )
+    cwd = os.getcwd()
+    report = run_load_test(args)
+    assert os.getcwd() == cwd
+    assert report["errors"] == 0
+    assert report["throttled"] == 0
+    assert report["breakdown"]["route:/upload"]["count"] == 4
+    assert report["breakdown"]["stage:predict"]["count"] == 4
+    assert report["breakdown"]["stage:normalize_photo"]["count"] == 4
+    assert report["breakdown"]["route:/history"]["count"] == 4
+
+
+def test_run_load_test_predict_mode():
+    """Test --predict-url posts the images straight to the ML client."""
+    image_dir = os.path.join(
+        "..", "machine-learning-client", "data", "flowers-102", "jpg"
+    )
+    posted = []
+
+    def post(url, files=None, **_kwargs):
+        posted.append((url, files["image"][0]))
+        return SimpleNamespace(status_code=200)
+
+    args = parse_args(
+        ["--users", "2", "--iterations", "3", "--images", "2"]
+        + ["--image-dir", image_dir, "--predict-url", "http://ml:3001/predict"]
+    )
+    with patch("loadtest.requests.Session", return_value=SimpleNamespace(post=post)):
+        report = run_load_test(args)
+    assert report["errors"] == 0
+    assert report["config"]["server"] == "http://ml:3001/predict"
+    assert report["breakdown"]["route:/predict"]["count"] == 6
+    assert {url for url, _ in posted} == {"http://ml:3001/predict"}
+    assert all(name.endswith(".jpg") for _, name in posted)
+
+
+def test_rate_limited_uploads_are_counted():
+    """Test uploads answered with 429 are reported by route and status."""
+    statuses = iter([200, 302, 429])
+    client = SimpleNamespace(
+        post=lambda *_args, **_kwargs: SimpleNamespace(
+            status_code=next(statuses), headers={"Location": "/results/a.jpg"}
+        ),
+        get=lambda _path: SimpleNamespace(status_code=200),
+    )
+    errors = run_user(client, "user", ["data:"], 2, Timings())
+    assert errors == {"/upload 429": 1}
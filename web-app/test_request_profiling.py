@@ -0,0 +1,133 @@
+"""
+Tests for the opt-in request profiling hooks.
+"""
+
+import os
+import threading
+import tracemalloc
+from unittest.mock import patch
+
+from flask import Flask
+
+from request_profiling import init_profiling, profiled_section
+
+
+def make_app():
+    """Create a small app with one route that uses profiled_section."""
+    app = Flask(__name__)
+
+    @app.route("/work")
+    def work():
+        with profiled_section("allocate"):
+            data = [bytes(1024) for _ in range(100)]
+        return str(len(data))
+
+    return app
+
+
+def test_profiling_disabled_by_default():
+    """Test no hooks are registered when profiling is not configured."""
+    app = make_app()
+    with patch.dict(os.environ, {}, clear=True):
+        assert init_profiling(app) is False
+    response = app.test_client().get("/work")
+    assert response.status_code == 200
+    assert "X-Profile-Id" not in response.headers
+
+
+def test_profiling_by_header(tmp_path):
+    """Test a request with the profiling header writes a report."""
+    app = make_app()
+    env = {"PROFILE_TOKEN": "secret", "PROFILE_DIR": str(tmp_path)}
+    with patch.dict(os.environ, env, clear=True):
+        assert init_profiling(app) is True
+    client = app.test_client()
+
+    response = client.get("/work")
+    assert "X-Profile-Id" not in response.headers
+
+    response = client.get("/work", headers={"X-Profile": "secret"})
+    profile_id = response.headers["X-Profile-Id"]
+    assert (tmp_path / f"{profile_id}.prof").exists()
+    summary = (tmp_path / f"{profile_id}.txt").read_text(encoding="utf-8")
+    assert "GET /work -> 200" in summary
+    assert '"name": "allocate"' in summary
+
+    assert client.get("/_profiles").status_code == 404
+    index = client.get("/_profiles", headers={"X-Profile": "secret"})
+    link = f"/_profiles/{profile_id}.txt?token=secret"
+    assert f'href="{link}"'.encode() in index.data
+    assert client.get(link).data.decode() == summary
+
+
+def test_overlapping_profiled_requests(tmp_path):
+    """Test the request that started tracing can finish before another one."""
+    app = Flask(__name__)
+    first_in, second_in, first_done = (threading.Event() for _ in range(3))
+
+    @app.route("/first")
+    def first():
+        with profiled_section("first"):  # starts tracing
+            first_in.set()
+            second_in.wait(5)
+        return "first"
+
+    @app.route("/second")
+    def second():
+        first_in.wait(5)
+        with profiled_section("second"):
+            second_in.set()
+            first_done.wait(5)
+        return "second"
+
+    env = {"PROFILE_SAMPLE_RATE": "1", "PROFILE_DIR": str(tmp_path)}
+    with patch.dict(os.environ, env, clear=True):
+        init_profiling(app)
+    statuses = {}
+
+    def get(path):
+        statuses[path] = app.test_client().get(path).status_code
+        if path == "/first":
+            first_done.set()
+
+    threads = [
+        threading.Thread(target=get, args=(path,)) for path in ("/first", "/second")
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join(10)
+    assert statuses == {"/first": 200, "/second": 200}
+    assert not tracemalloc.is_tracing()
+
+
+def test_profiles_need_a_token(tmp_path):
+    """Test sampled profiles are kept on disk, pruned, and never served without a token."""
+    app = make_app()
+    env = {
+        "PROFILE_SAMPLE_RATE": "1",
+        "PROFILE_DIR": str(tmp_path),
+        "PROFILE_MAX_REPORTS": "2",
+    }
+    with patch.dict(os.environ, env, clear=True):
+        init_profiling(app)
+    client = app.test_client()
+    profile_ids = [client.get("/work").headers["X-Profile-Id"] for _ in range(3)]
+
+    assert client.get("/_profiles").status_code == 404
+    assert client.get(f"/_profiles/{profile_ids[-1]}.txt").status_code == 404
+    reports = sorted(path.name for path in tmp_path.glob("*.txt"))
+    assert len(reports) == 2
+    assert not list(tmp_path.glob(f"{profile_ids[0]}.*"))
+
+
+def test_profiler_failure_does_not_fail_request(tmp_path):
+    """Test a request is still served when its profile cannot be written."""
+    app = make_app()
+    env = {"PROFILE_SAMPLE_RATE": "1", "PROFILE_DIR": str(tmp_path)}
+    with patch.dict(os.environ, env, clear=True):
+        init_profiling(app)
+    with patch("request_profiling.write_profile", side_effect=OSError("disk full")):
+        response = app.test_client().get("/work")
+    assert response.status_code == 200
+    assert "X-Profile-Id" not in response.headers
@@ -0,0 +1,161 @@
+"""
+Tests for full-text search over plant entries and identifications.
+"""
+
+from unittest.mock import MagicMock
+
+import pymongo
+from bson import ObjectId
+
+from search import (
+    REGEX_SORT,
+    SEARCH_MAX_PAGES,
+    SearchIndexes,
+    clamp_page,
+    clean_query,
+    ensure_search_indexes,
+    results_page,
+    search_entries,
+)
+
+
+def test_clean_query_and_page():
+    """Test queries are normalized and pages clamped."""
+    assert clean_query("  rose   watering ") == "rose watering"
+    assert clean_query(None) == ""
+    assert clamp_page("3") == 3
+    assert clamp_page("0") == 1
+    assert clamp_page("abc") == 1
+    assert clamp_page(10**6) == 20
+
+
+def test_results_page_merges_by_score():
+    """Test hits from both collections are ranked together and paginated."""
+    plants = [
+        {"_id": ObjectId(), "name": "Kitchen rose", "photo": "/static/uploads/a.jpg"},
+        {"_id": ObjectId(), "name": "Balcony rose", "instructions": "Water daily"},
+    ]
+    plants[0]["score"], plants[1]["score"] = 3.0, 1.0
+    predictions = [{"_id": ObjectId(), "plant_name": "rose", "photo": "b.jpg"}]
+    predictions[0]["score"] = 2.0
+
+    page = results_page({"plants": plants, "predictions": predictions}, "rose", 1, 2)
+    assert [hit["title"] for hit in page["results"]] == ["Kitchen rose", "rose"]
+    assert page["results"][0]["photo"] == "/static/uploads/a.jpg"
+    assert page["results"][1]["photo"] == "/static/uploads/b.jpg"
+    assert page["results"][1]["filename"] == "b.jpg"
+    assert page["has_next"]
+
+    page = results_page({"plants": plants, "predictions": predictions}, "rose", 2, 2)
+    assert [hit["snippet"] for hit in page["results"]] == ["Water daily"]
+    assert not page["has_next"]
+
+
+def test_results_page_normalizes_scores_per_collection():
+    """Test each collection's best match scores 1.0 before the hits are merged."""
+    plants = [
+        {"_id": ObjectId(), "name": "Rose bush", "score": 12.0},
+        {"_id": ObjectId(), "name": "Rose hedge", "score": 6.0},
+    ]
+    predictions = [{"_id": ObjectId(), "plant_name": "rose", "score": 1.5}]
+    page = results_page({"plants": plants, "predictions": predictions}, "rose", 1)
+    assert [(hit["title"], hit["score"]) for hit in page["results"]] == [
+        ("Rose bush", 1.0),
+        ("rose", 1.0),
+        ("Rose hedge", 0.5),
+    ]
+
+
+def test_search_entries_scoped_to_user():
+    """Test both collections are queried by user and text score."""
+    db = MagicMock()
+    cursor = db.plants.find.return_value.sort.return_value
+    cursor.limit.return_value = [{"_id": ObjectId(), "name": "Fern", "score": 1.0}]
+    db.predictions.find.return_value.sort.return_value.limit.return_value = []
+
+    page = search_entries(db, "alice", " fern ", page=2, per_page=5)
+
+    query, projection = db.plants.find.call_args[0]
+    assert query == {"user": "alice", "$text": {"$search": "fern"}}
+    assert projection["score"] == {"$meta": "textScore"}
+    cursor.limit.assert_called_once_with(11)
+    assert page["page"] == 2 and page["results"] == []
+
+
+def test_blank_query_skips_database():
+    """Test a blank query returns no results without querying."""
+    db = MagicMock()
+    assert search_entries(db, "alice", "   ")["results"] == []
+    db.plants.find.assert_not_called()
+
+
+def test_ensure_search_indexes():
+    """Test the text indexes are prefixed with the user field."""
+    db = MagicMock()
+    db.predictions.create_index.side_effect = pymongo.errors.OperationFailure("dup")
+    assert ensure_search_indexes(db) == {"plants"}
+    keys = db.plants.create_index.call_args[0][0]
+    assert keys == [
+        ("user", pymongo.ASCENDING),
+        ("name", pymongo.TEXT),
+        ("instructions", pymongo.TEXT),
+    ]
+
+
+def test_regex_fallback_without_text_index():
+    """Test a collection without its text index is searched by regex."""
+    db = MagicMock()
+    db.plants.find.return_value.sort.return_value.limit.return_value = []
+    db.predictions.find.return_value.sort.return_value.limit.return_value = [
+        {"_id": ObjectId(), "plant_name": "Wild rose", "photo": "a.jpg"},
+        {"_id": ObjectId(), "plant_name": "Rose", "photo": "b.jpg"},
+    ]
+
+    page = search_entries(db, "alice", "wild rose", text_ready={"plants"})
+
+    assert "$text" in db.plants.find.call_args[0][0]
+    query, projection = db.predictions.find.call_args[0]
+    assert query == {
+        "user": "alice",
+        "$or": [{"plant_name": {"$regex": "wild|rose", "$options": "i"}}],
+    }
+    assert "score" not in projection
+    db.predictions.find.return_value.sort.assert_called_once_with(REGEX_SORT)
+    assert [(hit["title"], hit["score"]) for hit in page["results"]] == [
+        ("Wild rose", 1.0),
+        ("Rose", 0.5),
+    ]
+
+
+def test_regex_fallback_ranks_before_paginating():
+    """Test regex matches are ranked within the same set on every page."""
+    db = MagicMock()
+    db.plants.find.return_value.sort.return_value.limit.return_value = []
+    # Newest first, as REGEX_SORT returns them; the best match is the oldest
+    db.predictions.find.return_value.sort.return_value.limit.return_value = [
+        {"_id": ObjectId(), "plant_name": "Rose", "photo": "b.jpg"},
+        {"_id": ObjectId(), "plant_name": "Rose", "photo": "c.jpg"},
+        {"_id": ObjectId(), "plant_name": "Wild rose", "photo": "a.jpg"},
+    ]
+    limit = db.predictions.find.return_value.sort.return_value.limit
+
+    for page in (1, 2):
+        search_entries(
+            db, "alice", "wild rose", page=page, per_page=1, text_ready={"plants"}
+        )
+        limit.assert_called_with(SEARCH_MAX_PAGES + 1)
+    page = search_entries(db, "alice", "wild rose", per_page=1, text_ready={"plants"})
+
+    assert [hit["title"] for hit in page["results"]] == ["Wild rose"]
+    assert page["has_next"]
+
+
+def test_search_indexes_retry():
+    """Test index creation is retried while a text index is missing."""
+    indexes = SearchIndexes(retry_interval=60)
+    assert indexes.due(now=0)
+    indexes.update({"plants"}, now=0)
+    assert not indexes.due(now=30)
+    assert indexes.due(now=60)
+    indexes.update({"plants", "predictions"}, now=60)
+    assert not indexes.due(now=1000)
@@ -0,0 +1,109 @@
+"""
+Tests for the uploads garbage collector.
+"""
+
+import os
+import time
+
+import pytest
+
+from upload_gc import Pacer, referenced_ids, sweep_uploads
+
+mongomock = pytest.importorskip("mongomock")
+
+HOUR = 3600
+
+
+def make_file(directory, name, age_seconds, size=10):
+    """Create a file of the given size whose mtime is age_seconds ago."""
+    path = directory / name
+    path.write_bytes(b"x" * size)
+    mtime = time.time() - age_seconds
+    os.utime(path, (mtime, mtime))
+    return path
+
+
+@pytest.fixture(name="uploads")
+def uploads_fixture(tmp_path):
+    """An uploads directory with referenced, orphaned and fresh files."""
+    make_file(tmp_path, "kept.jpg", 2 * HOUR)
+    make_file(tmp_path, "kept.original.png", 2 * HOUR)
+    make_file(tmp_path, "plant.jpg", 2 * HOUR)
+    make_file(tmp_path, "linked.webp", 2 * HOUR)
+    make_file(tmp_path, "orphan.jpg", 2 * HOUR, size=100)
+    make_file(tmp_path, "orphan.original.png", 2 * HOUR, size=1000)
+    make_file(tmp_path, "fresh.jpg", 60)
+    return tmp_path
+
+
+@pytest.fixture(name="db")
+def db_fixture():
+    """A database referencing kept.jpg, plant.jpg and linked.webp."""
+    db = mongomock.MongoClient().db
+    db.predictions.insert_one({"photo": "kept.jpg", "user": "alice"})
+    db.plants.insert_one({"photo": "/static/uploads/plant.jpg", "user": "alice"})
+    db.plants.insert_one(
+        {
+            "photo": "https://plants.example.com/media/linked.webp?v=2",
+            "user": "alice",
+        }
+    )
+    return db
+
+
+def test_dry_run_reports_without_deleting(uploads, db):
+    """Test a dry run lists orphans past the grace period and deletes nothing."""
+    report = sweep_uploads(db, str(uploads), dry_run=True, batch_size=2)
+    assert report["scanned"] == 7
+    assert report["referenced"] == 4
+    assert sorted(report["orphans"]) == ["orphan.jpg", "orphan.original.png"]
+    assert report["bytes_freed"] == 1100
+    assert len(os.listdir(uploads)) == 7
+
+
+def test_sweep_deletes_orphans_and_expired_originals(uploads, db):
+    """Test a sweep removes orphans and originals past their TTL."""
+    report = sweep_uploads(
+        db,
+        str(uploads),
+        original_retention_days=1 / 24,
+        max_deletes_per_second=0,
+    )
+    assert sorted(report["expired_originals"]) == [
+        "kept.original.png",
+        "orphan.original.png",
+    ]
+    assert report["orphans"] == ["orphan.jpg"]
+    assert sorted(os.listdir(uploads)) == [
+        "fresh.jpg",
+        "kept.jpg",
+        "linked.webp",
+        "plant.jpg",
+    ]
+
+
+def test_pacer_limits_rate():
+    """Test the pacer sleeps to keep actions under its rate.
+
+    The fake sleep does not advance the clock, so waits accumulate."""
+    sleeps = []
+    pacer = Pacer(rate=10, sleep=sleeps.append)
+    for _ in range(3):
+        pacer.wait()
+    assert len(sleeps) == 2
+    assert 0 < sleeps[0] <= 0.1 < sleeps[1] <= 0.2
+
+
+def test_referenced_ids_from_any_photo_value():
+    """Test upload ids are read from names, paths and absolute URLs alike."""
+    db = mongomock.MongoClient().db
+    db.predictions.insert_many(
+        [
+            {"photo": "a1.jpg"},
+            {"photo": "/static/uploads/b2.jpg"},
+            {"photo": "http://localhost:5000/static/uploads/c3.png?cache=1"},
+            {"photo": "uploads/d4.original.png#top"},
+            {"photo": None},
+        ]
+    )
+    assert referenced_ids(db) == {"a1", "b2", "c3", "d4"}
@@ -0,0 +1,83 @@
+"""
+Tests for upload rate limits, storage quotas and the shared upload counter.
+"""
+
+import pytest
+
+from upload_limits import (
+    SharedCounter,
+    StorageQuota,
+    UploadLimiter,
+    UploadRejected,
+    usage_day,
+    usage_upsert,
+)
+
+mongomock = pytest.importorskip("mongomock")
+
+DAY = 86400
+
+
+def test_limiter_per_ip_and_user():
+    """Test uploads are limited per IP and per user, anonymous ones per IP only."""
+    limiter = UploadLimiter(limits={"user": (1.0, 2), "ip": (1.0, 3)})
+    limiter.check("alice", "10.0.0.1", now=0.0)
+    limiter.check("alice", "10.0.0.2", now=0.0)
+    with pytest.raises(UploadRejected) as rejected:
+        limiter.check("alice", "10.0.0.3", now=0.0)
+    assert rejected.value.reason == "rate"
+    assert rejected.value.headers() == {"Retry-After": "1"}
+
+    limiter.check(None, "10.0.0.1", now=0.0)
+    limiter.check(None, "10.0.0.1", now=0.0)
+    with pytest.raises(UploadRejected):
+        limiter.check(None, "10.0.0.1", now=0.0)
+    limiter.check("alice", "10.0.0.4", now=1.0)
+
+
+def test_storage_quota():
+    """Test the quota admits uploads up to the daily limit, then resets tomorrow."""
+    quota = StorageQuota(daily_bytes=100, max_users=1)
+    quota.check(60, 40)
+    with pytest.raises(UploadRejected) as rejected:
+        quota.check(60, 41, now=DAY - 30)
+    assert rejected.value.reason == "storage"
+    assert rejected.value.retry_after == pytest.approx(30)
+
+    quota.remember("alice", "2024-01-01", 60)
+    assert quota.cached("alice", "2024-01-01") == 60
+    quota.remember("bob", "2024-01-01", 10)
+    assert quota.cached("alice", "2024-01-01") is None  # evicted
+
+
+def test_usage_upsert_counts_bytes_per_day():
+    """Test stored bytes add up per user and UTC day."""
+    usage = mongomock.MongoClient().db.upload_usage
+    day = usage_day(now=DAY + 5)
+    assert day == "1970-01-02"
+    usage.find_one_and_update(**usage_upsert("alice", day, 300))
+    document = usage.find_one_and_update(**usage_upsert("alice", day, 200))
+    assert document["bytes"] == 500
+    assert document["user"] == "alice"
+    assert document["expires_at"].isoformat().startswith("1970-01-04")
+    other = usage.find_one_and_update(**usage_upsert("alice", "1970-01-03", 1))
+    assert other["bytes"] == 1
+
+
+def test_shared_counter_across_replicas():
+    """Test replicas block a user once their combined uploads reach the limit."""
+    counters = mongomock.MongoClient().db.upload_counters
+    replicas = [SharedCounter(counters, limit=3, window=60) for _ in range(2)]
+    assert replicas[0].allow("alice", now=0.0) == 0
+    assert replicas[0].allow("alice", now=0.0) == 0
+    assert replicas[1].allow("alice", now=0.0) == 0
+    for replica in replicas:
+        replica.sync(now=1.0)
+    assert replicas[1].allow("alice", now=1.0) == pytest.approx(59)
+
+    # Replica 0 sees the uploads through replica 1 on its next sync
+    assert replicas[0].allow("alice", now=1.5) == 0
+    replicas[0].sync(now=2.0)
+    assert replicas[0].allow("alice", now=2.0) == pytest.approx(58)
+    assert replicas[0].allow("bob", now=2.0) == 0
+    assert replicas[0].allow("alice", now=60.0) == 0  # next window
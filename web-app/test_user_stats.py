@@ -0,0 +1,156 @@
+"""
+Tests for the materialized per-user statistics.
+"""
+
+from datetime import datetime, timezone
+from types import SimpleNamespace
+from unittest.mock import MagicMock
+
+import pytest
+from bson import ObjectId
+
+import user_stats
+from user_stats import (
+    begin_change,
+    change_started,
+    forget_prediction,
+    get_user_stats,
+    record_prediction,
+    species_key,
+    week_key,
+)
+
+mongomock = pytest.importorskip("mongomock")
+
+CREATED = datetime(2024, 2, 14, tzinfo=timezone.utc)
+
+
+def insert_prediction(db, user, plant_name, created=CREATED):
+    """Insert a prediction and count it, the way process_photo does."""
+    begin_change(db, user)
+    # A unique _id created at created
+    prediction = {
+        "_id": ObjectId(
+            ObjectId.from_datetime(created).binary[:4] + ObjectId().binary[4:]
+        ),
+        "user": user,
+        "plant_name": plant_name,
+    }
+    db.predictions.insert_one(prediction)
+    record_prediction(db, prediction)
+
+
+def facets(count):
+    """Build rebuild_pipeline output for count lilies in 2024-W07."""
+    return {
+        "species": [{"_id": "lily", "count": count}],
+        "weeks": [{"_id": {"year": 2024, "week": 7}, "count": count}],
+    }
+
+
+def test_week_and_species_keys():
+    """Test summary field names are ISO weeks and dot-free species names."""
+    assert week_key(CREATED) == "2024-W07"
+    assert species_key("st. john's wort") == "st_ john's wort"
+
+
+def test_stats_are_incremental():
+    """Test inserts and deletes keep the summary document up to date."""
+    db = mongomock.MongoClient().db
+    db.user_stats.insert_many(
+        [{"_id": name, "built": True, "version": 0} for name in ("alice", "bob")]
+    )
+    insert_prediction(db, "alice", "rose")
+    insert_prediction(db, "alice", "rose", datetime(2024, 3, 1, tzinfo=timezone.utc))
+    insert_prediction(db, "alice", "tulip")
+    insert_prediction(db, "bob", "tulip")
+
+    stats = get_user_stats(db, "alice")
+    assert stats["total"] == 3
+    assert stats["top_species"][0] == {"name": "rose", "count": 2}
+    # Counted in the week each prediction was created
+    assert stats["weeks"] == [
+        {"week": "2024-W07", "count": 2},
+        {"week": "2024-W09", "count": 1},
+    ]
+
+    begin_change(db, "alice")
+    deleted = db.predictions.find_one_and_delete(
+        {"user": "alice", "plant_name": "tulip"}
+    )
+    forget_prediction(db, deleted)
+    stats = get_user_stats(db, "alice")
+    assert stats["total"] == 2
+    assert stats["top_species"] == [{"name": "rose", "count": 2}]
+    assert db.user_stats.find_one({"_id": "alice"})["pending"] == 0
+
+
+def test_missing_summary_is_rebuilt():
+    """Test the summary of a user without one is built by aggregation."""
+    db = MagicMock()
+    db.user_stats.find_one.return_value = None
+    db.predictions.aggregate.return_value = iter([facets(4)])
+    stats = get_user_stats(db, "carol")
+    assert stats["total"] == 4
+    assert stats["weeks"] == [{"week": "2024-W07", "count": 4}]
+    assert db.predictions.aggregate.call_args[0][0][0] == {"$match": {"user": "carol"}}
+    stored = db.user_stats.insert_one.call_args[0][0]
+    assert stored["_id"] == "carol" and stored["built"]
+
+
+def test_rebuild_retries_after_a_concurrent_insert():
+    """Test a prediction counted during the aggregation makes the rebuild retry."""
+    db = SimpleNamespace(
+        user_stats=mongomock.MongoClient().db.user_stats, predictions=MagicMock()
+    )
+    results = iter([facets(1), facets(2)])
+
+    def aggregate(_pipeline):
+        if db.predictions.aggregate.call_count == 1:
+            begin_change(db, "carol")
+            record_prediction(
+                db,
+                {
+                    "_id": ObjectId.from_datetime(CREATED),
+                    "user": "carol",
+                    "plant_name": "lily",
+                },
+            )
+        return iter([next(results)])
+
+    db.predictions.aggregate.side_effect = aggregate
+    assert get_user_stats(db, "carol")["total"] == 2
+    assert db.predictions.aggregate.call_count == 2
+    stored = db.user_stats.find_one({"_id": "carol"})
+    assert (stored["total"], stored["built"], stored["pending"]) == (2, True, 0)
+
+    # Later predictions are counted on top of the rebuilt summary
+    begin_change(db, "carol")
+    record_prediction(db, {"_id": ObjectId(), "user": "carol", "plant_name": "rose"})
+    assert get_user_stats(db, "carol")["total"] == 3
+
+
+def test_rebuild_with_pending_change_is_not_stored(monkeypatch):
+    """Test stats are served but not stored while a change is still pending."""
+    monkeypatch.setattr(user_stats, "REBUILD_RETRY_DELAY", 0)
+    db = SimpleNamespace(
+        user_stats=mongomock.MongoClient().db.user_stats, predictions=MagicMock()
+    )
+    db.predictions.aggregate.side_effect = lambda _pipeline: iter([facets(3)])
+    begin_change(db, "carol")
+    assert get_user_stats(db, "carol")["total"] == 3
+    assert not db.user_stats.find_one({"_id": "carol"}).get("built")
+
+
+def test_abandoned_pending_change_is_reset(monkeypatch):
+    """Test a rebuild is stored once a pending change is too old to finish."""
+    monkeypatch.setattr(user_stats, "REBUILD_RETRY_DELAY", 0)
+    db = SimpleNamespace(
+        user_stats=mongomock.MongoClient().db.user_stats, predictions=MagicMock()
+    )
+    db.predictions.aggregate.side_effect = lambda _pipeline: iter([facets(3)])
+    db.user_stats.update_one(**change_started("carol", now=0.0))
+    assert get_user_stats(db, "carol")["total"] == 3
+    stored = db.user_stats.find_one({"_id": "carol"})
+    assert (stored["built"], stored["pending"]) == (True, 0)
+    assert db.predictions.aggregate.call_count == 1
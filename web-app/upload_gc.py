@@ -0,0 +1,232 @@
+"""
+Garbage collection for the uploads directory.
+
+Reconciles the files in static/uploads against db.predictions and db.plants
+and deletes files that no document references (e.g. left behind by
+delete_entry or a failed process_photo). A file is referenced when the
+upload id in its name (the part before the first dot) is the base name of
+any document's photo value, whatever its form: a bare file name, a path, an
+absolute URL or a URL with a query string. Retention policies:
+
+- orphans are only deleted once they are older than a grace period, so
+  uploads still being processed are never touched;
+- kept originals (<id>.original.<ext>) can be expired after a TTL even when
+  their derivative is still referenced.
+
+Deletes are paced to a maximum rate so a sweep does not compete with
+foreground I/O. Run it once with a dry-run report:
+
+    python upload_gc.py --dry-run
+
+or in the background of the web app by setting UPLOAD_GC_INTERVAL (seconds).
+"""
+
+import argparse
+import json
+import os
+import re
+import threading
+import time
+
+import pymongo
+from dotenv import load_dotenv
+
+UPLOADS_DIR = os.path.join("static", "uploads")
+REPORT_NAME_LIMIT = 1000
+
+# The upload id in a photo value: its base name up to the first dot, ignoring
+# a query string or fragment
+PHOTO_VALUE_ID = re.compile(r"(?:^|/)([^/?#.]+)[^/?#]*(?:[?#].*)?$")
+
+
+def photo_id(filename):
+    """Return the upload id shared by a derivative and its kept original."""
+    return os.path.basename(filename).split(".", 1)[0]
+
+
+def is_original(filename):
+    """True for kept originals, named <id>.original.<ext>."""
+    return ".original." in filename
+
+
+def referenced_ids(db):
+    """
+    Return the upload ids referenced by any document's photo value.
+
+    Reads the photo of every document of db.predictions and db.plants once
+    per sweep. Documents created during the sweep only reference uploads
+    younger than the orphan grace period, which are never deleted.
+    """
+    found = set()
+    for collection in (db.predictions, db.plants):
+        for document in collection.find(
+            {"photo": {"$type": "string"}}, {"photo": 1, "_id": 0}
+        ):
+            match = PHOTO_VALUE_ID.search(document["photo"])
+            if match:
+                found.add(match.group(1))
+    return found
+
+
+def scan_batches(uploads_dir, batch_size):
+    """Yield lists of os.DirEntry for regular files, batch_size at a time."""
+    batch = []
+    with os.scandir(uploads_dir) as entries:
+        for entry in entries:
+            if not entry.is_file():
+                continue
+            batch.append(entry)
+            if len(batch) >= batch_size:
+                yield batch
+                batch = []
+    if batch:
+        yield batch
+
+
+class Pacer:  # pylint: disable=too-few-public-methods
+    """Sleeps as needed to keep actions under a rate per second."""
+
+    def __init__(self, rate, sleep=time.sleep):
+        self.interval = 1.0 / rate if rate > 0 else 0.0
+        self.sleep = sleep
+        self.next_time = 0.0
+
+    def wait(self):
+        """Block until the next action is allowed."""
+        if not self.interval:
+            return
+        now = time.monotonic()
+        if now < self.next_time:
+            self.sleep(self.next_time - now)
+        self.next_time = max(now, self.next_time) + self.interval
+
+
+def sweep_uploads(  # pylint: disable=too-many-arguments,too-many-locals
+    db,
+    uploads_dir=UPLOADS_DIR,
+    *,
+    orphan_grace_seconds=3600,
+    original_retention_days=0,
+    dry_run=False,
+    batch_size=500,
+    max_deletes_per_second=50,
+    now=None,
+):
+    """
+    Delete orphaned uploads and expired originals.
+
+    Args:
+        db: Database with the predictions and plants collections.
+        uploads_dir (str): Directory to sweep.
+        orphan_grace_seconds (float): Minimum age of an orphan before deletion.
+        original_retention_days (float): TTL of kept originals; 0 keeps them.
+        dry_run (bool): Report what would be deleted without deleting.
+        batch_size (int): Files listed from the directory at a time.
+        max_deletes_per_second (float): Delete rate cap; 0 disables pacing.
+        now (float): Current time, for tests.
+
+    Returns:
+        dict: Report of what was scanned and deleted (or would be, for a
+            dry run), listing at most REPORT_NAME_LIMIT names per kind.
+    """
+    now = time.time() if now is None else now
+    pacer = Pacer(max_deletes_per_second)
+    report = {
+        "dry_run": dry_run,
+        "scanned": 0,
+        "referenced": 0,
+        "deleted": 0,
+        "bytes_freed": 0,
+        "orphans": [],
+        "expired_originals": [],
+    }
+    if not os.path.isdir(uploads_dir):
+        return report
+
+    referenced = referenced_ids(db)
+    for batch in scan_batches(uploads_dir, batch_size):
+        report["scanned"] += len(batch)
+        for entry in batch:
+            stat = entry.stat()
+            age = now - stat.st_mtime
+            if (
+                is_original(entry.name)
+                and original_retention_days
+                and age > original_retention_days * 86400
+            ):
+                kind = "expired_originals"
+            elif photo_id(entry.name) in referenced:
+                report["referenced"] += 1
+                continue
+            elif age > orphan_grace_seconds:
+                kind = "orphans"
+            else:
+                continue
+
+            if len(report[kind]) < REPORT_NAME_LIMIT:
+                report[kind].append(entry.name)
+            report["deleted"] += 1
+            report["bytes_freed"] += stat.st_size
+            if not dry_run:
+                pacer.wait()
+                try:
+                    os.remove(entry.path)
+                except FileNotFoundError:
+                    pass
+    return report
+
+
+def start_sweeper(db, interval, **options):
+    """
+    Run sweep_uploads every interval seconds in a daemon thread.
+
+    Returns:
+        threading.Thread: The started thread.
+    """
+
+    def run():
+        while True:
+            time.sleep(interval)
+            try:
+                report = sweep_uploads(db, **options)
+                print(
+                    f"Upload GC: scanned {report['scanned']}, deleted "
+                    f"{report['deleted']} files ({report['bytes_freed']} bytes)"
+                )
+            except (OSError, pymongo.errors.PyMongoError) as error:
+                print(f"Upload GC failed: {error}")
+
+    thread = threading.Thread(target=run, name="upload-gc", daemon=True)
+    thread.start()
+    return thread
+
+
+def options_from_env():
+    """Read sweep options from the UPLOAD_GC_* environment variables."""
+    return {
+        "orphan_grace_seconds": float(os.getenv("UPLOAD_GC_GRACE_SECONDS", "3600")),
+        "original_retention_days": float(
+            os.getenv("UPLOAD_ORIGINAL_RETENTION_DAYS", "0")
+        ),
+        "batch_size": int(os.getenv("UPLOAD_GC_BATCH_SIZE", "500")),
+        "max_deletes_per_second": float(os.getenv("UPLOAD_GC_MAX_DELETES", "50")),
+    }
+
+
+def main(argv=None):
+    """Run one sweep from the command line and print the report."""
+    load_dotenv()
+    parser = argparse.ArgumentParser(description="Delete orphaned upload files.")
+    parser.add_argument("--dry-run", action="store_true")
+    parser.add_argument("--uploads-dir", default=UPLOADS_DIR)
+    args = parser.parse_args(argv)
+    db = pymongo.MongoClient(os.getenv("MONGO_URI"))[os.getenv("MONGO_DBNAME")]
+    report = sweep_uploads(
+        db, args.uploads_dir, dry_run=args.dry_run, **options_from_env()
+    )
+    print(json.dumps(report, indent=2))
+    return report
+
+
+if __name__ == "__main__":
+    main()
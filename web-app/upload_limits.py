@@ -0,0 +1,301 @@
+"""
+Upload rate limits and daily storage quotas.
+
+Every upload is decoded, written to disk and classified by the ML client, so
+/upload is throttled per user and per client IP with in-process token
+buckets before any of that work happens. Optional limits:
+
+- a daily storage quota per user (UPLOAD_DAILY_BYTES), counted in
+  db.upload_usage. A user's usage is read once per day and then kept in
+  memory, and every stored upload updates it with $inc, so checking the
+  quota does not wait on MongoDB;
+- a limit on uploads per user per window across all replicas
+  (UPLOAD_SHARED_LIMIT), counted in db.upload_counters. Each replica adds
+  its uploads to the shared count in the background every
+  UPLOAD_SHARED_SYNC seconds and blocks users over the limit until the
+  window ends. The check stays in memory; in exchange, a user can go over
+  the limit by the uploads made before every replica has synced.
+
+The usage query builders are shared with the async app in asgi_app.py.
+"""
+
+import math
+import os
+import threading
+import time
+from collections import Counter, OrderedDict
+from datetime import datetime, timedelta, timezone
+
+import pymongo
+
+from rate_limit import TokenBucket
+
+# Usage documents outlive their day by this much, for inspection
+USAGE_RETENTION = timedelta(days=2)
+
+
+class UploadRejected(Exception):
+    """Raised when an upload is over a rate limit or the storage quota."""
+
+    MESSAGES = {
+        "rate": "Too many uploads, please try again later.",
+        "storage": "Daily upload storage quota reached, please try again tomorrow.",
+    }
+
+    def __init__(self, reason, retry_after):
+        super().__init__(self.MESSAGES[reason])
+        self.reason = reason
+        self.retry_after = retry_after
+
+    def headers(self):
+        """Return the Retry-After header of the 429 response."""
+        return {"Retry-After": str(max(1, math.ceil(self.retry_after)))}
+
+
+def usage_day(now=None):
+    """Return the UTC day an upload at now counts toward, e.g. '2024-02-14'."""
+    when = datetime.fromtimestamp(time.time() if now is None else now, timezone.utc)
+    return when.date().isoformat()
+
+
+def seconds_until_tomorrow(now=None):
+    """Return the seconds until the next UTC day, when quotas reset."""
+    now = time.time() if now is None else now
+    return 86400 - now % 86400
+
+
+def usage_id(username, day):
+    """Return the _id of a user's usage document for day."""
+    return f"{username}|{day}"
+
+
+def usage_upsert(username, day, size):
+    """Build the find_one_and_update arguments adding size bytes to a day's usage."""
+    expires = datetime.fromisoformat(day).replace(tzinfo=timezone.utc)
+    return {
+        "filter": {"_id": usage_id(username, day)},
+        "update": {
+            "$inc": {"bytes": size},
+            "$setOnInsert": {
+                "user": username,
+                "day": day,
+                "expires_at": expires + USAGE_RETENTION,
+            },
+        },
+        "upsert": True,
+        "return_document": pymongo.ReturnDocument.AFTER,
+    }
+
+
+class StorageQuota:
+    """In-memory view of the bytes each user has stored today."""
+
+    def __init__(self, daily_bytes, max_users=10000):
+        """
+        Args:
+            daily_bytes (int): Bytes a user may store per UTC day.
+            max_users (int): Users whose usage is kept in memory.
+        """
+        self.daily_bytes = daily_bytes
+        self.max_users = max_users
+        self._used = OrderedDict()
+        self._lock = threading.Lock()
+
+    def cached(self, username, day):
+        """Return the known usage of username on day, or None to read it."""
+        with self._lock:
+            return self._used.get((username, day))
+
+    def remember(self, username, day, used):
+        """Record the usage of username on day, as read or returned by $inc."""
+        with self._lock:
+            self._used.pop((username, day), None)
+            self._used[(username, day)] = used
+            while len(self._used) > self.max_users:
+                self._used.popitem(last=False)
+
+    def check(self, used, size, now=None):
+        """
+        Check that size more bytes fit in the quota.
+
+        Raises:
+            UploadRejected: If they do not, to be retried tomorrow.
+        """
+        if used + size > self.daily_bytes:
+            raise UploadRejected("storage", seconds_until_tomorrow(now))
+
+
+class SharedCounter:  # pylint: disable=too-many-instance-attributes
+    """Uploads per user per window, counted across replicas in MongoDB."""
+
+    def __init__(self, collection, limit, window=60, sync_interval=1.0):
+        """
+        Args:
+            collection: The db.upload_counters collection.
+            limit (int): Uploads allowed per user per window on all replicas.
+            window (float): Window length in seconds.
+            sync_interval (float): Seconds between syncs with MongoDB.
+        """
+        self.collection = collection
+        self.limit = limit
+        self.window = window
+        self.sync_interval = sync_interval
+        self._pending = Counter()
+        self._active = {}
+        self._blocked = {}
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def window_start(self, now):
+        """Return the start of the window now falls in."""
+        return now - now % self.window
+
+    def allow(self, key, now=None):
+        """
+        Count an upload of key unless it is blocked for this window.
+
+        Returns:
+            float: 0 if allowed, else the seconds until the window ends.
+        """
+        now = time.time() if now is None else now
+        with self._lock:
+            blocked_until = self._blocked.get(key, 0)
+            if blocked_until > now:
+                return blocked_until - now
+            self._pending[key] += 1
+        return 0.0
+
+    def sync(self, now=None):
+        """
+        Add the uploads counted since the last sync to the shared counts.
+
+        Users active in the current window are re-read even without new
+        uploads here, so uploads through other replicas block them too.
+        """
+        now = time.time() if now is None else now
+        start = self.window_start(now)
+        with self._lock:
+            pending, self._pending = self._pending, Counter()
+            self._active = {
+                key: window for key, window in self._active.items() if window == start
+            }
+            self._active.update(dict.fromkeys(pending, start))
+            idle = [key for key in self._active if key not in pending]
+            self._blocked = {
+                key: until for key, until in self._blocked.items() if until > now
+            }
+        counts = {}
+        for key, count in pending.items():
+            document = self.collection.find_one_and_update(
+                {"_id": f"{key}|{int(start)}"},
+                {
+                    "$inc": {"count": count},
+                    "$setOnInsert": {
+                        "key": key,
+                        "expires_at": datetime.fromtimestamp(
+                            start + 2 * self.window, timezone.utc
+                        ),
+                    },
+                },
+                upsert=True,
+                return_document=pymongo.ReturnDocument.AFTER,
+            )
+            counts[key] = document["count"]
+        if idle:
+            ids = [f"{key}|{int(start)}" for key in idle]
+            for document in self.collection.find({"_id": {"$in": ids}}):
+                counts[document["key"]] = document["count"]
+        with self._lock:
+            for key, count in counts.items():
+                if count >= self.limit:
+                    self._blocked[key] = start + self.window
+
+    def start(self):
+        """Create the expiry index and sync in a daemon thread."""
+        self.collection.create_index("expires_at", expireAfterSeconds=0)
+
+        def run():
+            while True:
+                time.sleep(self.sync_interval)
+                try:
+                    self.sync()
+                except pymongo.errors.PyMongoError as error:
+                    print(f"Upload counter sync failed: {error}")
+
+        self._thread = threading.Thread(target=run, name="upload-counters", daemon=True)
+        self._thread.start()
+
+
+class UploadLimiter:
+    """Per-user and per-IP upload rate limits and the storage quota."""
+
+    def __init__(self, limits=None, daily_bytes=0, shared=None):
+        """
+        Args:
+            limits (dict): (rate per second, burst) for "user" and "ip".
+            daily_bytes (int): Daily storage quota per user; 0 disables it.
+            shared (SharedCounter): Cross-replica limit per user, or None.
+        """
+        limits = {"user": (0.2, 10), "ip": (1.0, 30), **(limits or {})}
+        self.user_uploads = TokenBucket(*limits["user"])
+        self.ip_uploads = TokenBucket(*limits["ip"])
+        self.quota = StorageQuota(daily_bytes) if daily_bytes > 0 else None
+        self.shared = shared
+
+    @classmethod
+    def from_env(cls, counters=None):
+        """
+        Build an UploadLimiter from the UPLOAD_* variables.
+
+        Args:
+            counters: The db.upload_counters collection, needed for
+                UPLOAD_SHARED_LIMIT; the shared counter is started here.
+        """
+        shared = None
+        shared_limit = int(os.getenv("UPLOAD_SHARED_LIMIT", "0"))
+        if shared_limit > 0 and counters is not None:
+            shared = SharedCounter(
+                counters,
+                shared_limit,
+                window=float(os.getenv("UPLOAD_SHARED_WINDOW", "60")),
+                sync_interval=float(os.getenv("UPLOAD_SHARED_SYNC", "1")),
+            )
+            shared.start()
+        return cls(
+            limits={
+                "user": (
+                    float(os.getenv("UPLOAD_USER_RATE", "0.2")),
+                    float(os.getenv("UPLOAD_USER_BURST", "10")),
+                ),
+                "ip": (
+                    float(os.getenv("UPLOAD_IP_RATE", "1")),
+                    float(os.getenv("UPLOAD_IP_BURST", "30")),
+                ),
+            },
+            daily_bytes=int(os.getenv("UPLOAD_DAILY_BYTES", "0")),
+            shared=shared,
+        )
+
+    def check(self, username, client_ip, now=None):
+        """
+        Take one upload from the client IP's and the user's limits.
+
+        Anonymous uploads are only limited per IP.
+
+        Raises:
+            UploadRejected: If a limit is exhausted.
+        """
+        if not self.ip_uploads.allow(client_ip, now=now):
+            raise UploadRejected(
+                "rate", self.ip_uploads.retry_after(client_ip, now=now)
+            )
+        if username is None:
+            return
+        if not self.user_uploads.allow(username, now=now):
+            raise UploadRejected(
+                "rate", self.user_uploads.retry_after(username, now=now)
+            )
+        if self.shared is not None:
+            retry_after = self.shared.allow(username)
+            if retry_after:
+                raise UploadRejected("rate", retry_after)
@@ -0,0 +1,268 @@
+"""
+Materialized per-user statistics for the Plant Identifier project.
+
+Each user has one summary document in db.user_stats, keyed by username,
+holding the total number of identifications, a count per species and a
+count per ISO week of the prediction's creation time. It is updated
+incrementally with $inc when a prediction is inserted or deleted, so
+reading stats costs a single find_one however long the history is. The
+summary is built from db.predictions with an aggregation pipeline the first
+time a user's stats are read.
+
+A rebuild must not lose or double count a prediction inserted or deleted
+while it aggregates. Every change therefore brackets its write to
+db.predictions: begin_change() adds one to the summary's "pending" count
+before it, record_prediction() or forget_prediction() applies the $inc and
+takes the pending count back down after it, and both bump "version". A
+rebuild only aggregates when nothing is pending and only stores its result
+if the version is unchanged, retrying otherwise. Each begin_change() also
+records when it happened in "pending_since". A change that is still pending
+STATS_PENDING_TIMEOUT seconds later is treated as abandoned, e.g. because a
+process died mid-change. The rebuild then stores its result anyway, which
+resets the pending count to 0, so reads of that user become single
+find_one calls again.
+
+The query builders are shared with the async app in asgi_app.py.
+"""
+
+import os
+import time
+
+import pymongo
+
+REBUILD_ATTEMPTS = 5
+REBUILD_RETRY_DELAY = 0.05
+# Seconds after which a pending change is taken to be abandoned; a change
+# only brackets a single insert or delete, so this is generous
+STATS_PENDING_TIMEOUT = float(os.getenv("STATS_PENDING_TIMEOUT", "60"))
+
+
+def week_key(when):
+    """Return the ISO week of a datetime as e.g. '2024-W07'."""
+    iso_year, iso_week, _ = when.isocalendar()
+    return f"{iso_year}-W{iso_week:02d}"
+
+
+def species_key(plant_name):
+    """Make a plant name safe to use as a MongoDB field name."""
+    return str(plant_name).replace(".", "_").replace("$", "_")
+
+
+def change_started(username, now=None):
+    """Build the upsert marking a change of a user's predictions as pending."""
+    return {
+        "filter": {"_id": username},
+        "update": {
+            "$inc": {"pending": 1, "version": 1},
+            "$max": {"pending_since": time.time() if now is None else now},
+        },
+        "upsert": True,
+    }
+
+
+def change_cancelled():
+    """Build the update ending a pending change that wrote nothing."""
+    return {"$inc": {"pending": -1, "version": 1}}
+
+
+def stats_increment(plant_name, when, step=1):
+    """Build the $inc update that counts one prediction (or uncounts it)."""
+    return {
+        "$inc": {
+            "total": step,
+            f"species.{species_key(plant_name)}": step,
+            f"weeks.{week_key(when)}": step,
+            "pending": -1,
+            "version": 1,
+        }
+    }
+
+
+def prediction_increment(prediction, step=1):
+    """Build the $inc update for a prediction document, dated by its _id."""
+    return stats_increment(
+        prediction.get("plant_name"), prediction["_id"].generation_time, step=step
+    )
+
+
+def rebuild_pipeline(username):
+    """Build the aggregation pipeline that summarizes a user's predictions."""
+    created = {"$toDate": "$_id"}
+    return [
+        {"$match": {"user": username}},
+        {
+            "$facet": {
+                "species": [{"$group": {"_id": "$plant_name", "count": {"$sum": 1}}}],
+                "weeks": [
+                    {
+                        "$group": {
+                            "_id": {
+                                "year": {"$isoWeekYear": created},
+                                "week": {"$isoWeek": created},
+                            },
+                            "count": {"$sum": 1},
+                        }
+                    }
+                ],
+            }
+        },
+    ]
+
+
+def summary_from_facets(username, facets, version=0):
+    """Turn the output of rebuild_pipeline into a summary document."""
+    species = {
+        species_key(row["_id"]): row["count"] for row in facets.get("species", [])
+    }
+    weeks = {
+        f"{row['_id']['year']}-W{row['_id']['week']:02d}": row["count"]
+        for row in facets.get("weeks", [])
+    }
+    return {
+        "_id": username,
+        "user": username,
+        "total": sum(species.values()),
+        "species": species,
+        "weeks": weeks,
+        "built": True,
+        "pending": 0,
+        "version": version,
+    }
+
+
+def is_built(summary):
+    """True if a summary document holds the user's full counts."""
+    return summary is not None and summary.get("built", False)
+
+
+def can_rebuild(summary, now=None):
+    """
+    True if a rebuilt summary may replace a (possibly missing) summary document.
+
+    That is when no change is pending on it, or when the newest pending change
+    began more than STATS_PENDING_TIMEOUT seconds ago and is abandoned.
+    """
+    if summary is None or summary.get("pending", 0) <= 0:
+        return True
+    now = time.time() if now is None else now
+    return now - summary.get("pending_since", 0) > STATS_PENDING_TIMEOUT
+
+
+def present_stats(summary, top=5, recent_weeks=12):
+    """
+    Shape a summary document for the stats page and API.
+
+    Returns:
+        dict: total, top species and recent weekly upload counts.
+    """
+    species = sorted(
+        ((name, count) for name, count in summary.get("species", {}).items() if count),
+        key=lambda item: item[1],
+        reverse=True,
+    )
+    weeks = sorted(
+        (week, count) for week, count in summary.get("weeks", {}).items() if count
+    )
+    return {
+        "total": summary.get("total", 0),
+        "top_species": [
+            {"name": name, "count": count} for name, count in species[:top]
+        ],
+        "weeks": [
+            {"week": week, "count": count} for week, count in weeks[-recent_weeks:]
+        ],
+    }
+
+
+def predictions_version(db, username):
+    """
+    Reads the generation of a user's predictions, bumped by every change.
+
+    Returns:
+        int: The version of the user's summary (0 without one), or None for
+        anonymous predictions, which never change.
+    """
+    if username is None:
+        return None
+    summary = db.user_stats.find_one({"_id": username}, {"version": 1})
+    return summary.get("version", 0) if summary else 0
+
+
+def begin_change(db, username):
+    """Marks a change of the user's predictions as pending, before writing it."""
+    if username is not None:
+        db.user_stats.update_one(**change_started(username))
+
+
+def cancel_change(db, username):
+    """Ends a pending change whose write to db.predictions did not happen."""
+    if username is not None:
+        db.user_stats.update_one({"_id": username}, change_cancelled())
+
+
+def record_prediction(db, prediction):
+    """Counts an inserted prediction document in its user's summary."""
+    if prediction.get("user") is not None:
+        db.user_stats.update_one(
+            {"_id": prediction["user"]}, prediction_increment(prediction)
+        )
+
+
+def forget_prediction(db, prediction):
+    """Removes a deleted prediction document from its user's summary."""
+    if prediction.get("user") is not None:
+        db.user_stats.update_one(
+            {"_id": prediction["user"]}, prediction_increment(prediction, step=-1)
+        )
+
+
+def store_summary(db, current, summary):
+    """
+    Stores a rebuilt summary unless the user's predictions changed meanwhile.
+
+    Args:
+        current (dict): The summary document read before aggregating, or None.
+        summary (dict): The rebuilt summary document.
+
+    Returns:
+        bool: Whether the summary was stored.
+    """
+    if current is None:
+        try:
+            db.user_stats.insert_one(summary)
+        except pymongo.errors.DuplicateKeyError:
+            return False
+        return True
+    result = db.user_stats.replace_one(
+        {"_id": summary["_id"], "version": current.get("version", 0)}, summary
+    )
+    return result.matched_count == 1
+
+
+def rebuild_user_stats(db, username):
+    """
+    Recomputes a user's summary document from db.predictions.
+
+    Returns:
+        dict: The rebuilt summary document.
+    """
+    for attempt in range(REBUILD_ATTEMPTS):
+        current = db.user_stats.find_one({"_id": username})
+        if is_built(current):
+            return current
+        facets = next(iter(db.predictions.aggregate(rebuild_pipeline(username))), {})
+        version = current.get("version", 0) if current else 0
+        summary = summary_from_facets(username, facets, version)
+        if can_rebuild(current) and store_summary(db, current, summary):
+            return summary
+        if attempt + 1 < REBUILD_ATTEMPTS:
+            time.sleep(REBUILD_RETRY_DELAY)
+    return summary
+
+
+def get_user_stats(db, username):
+    """Reads a user's stats, rebuilding the summary if it is not built yet."""
+    summary = db.user_stats.find_one({"_id": username})
+    if not is_built(summary):
+        summary = rebuild_user_stats(db, username)
+    return present_stats(summary)